@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -52,6 +53,10 @@ INSTALLED_APPS = [
     ]
 
 MIDDLEWARE = [
+    # first, so its timings cover every other middleware
+    "users.middleware.timing_middleware",
+    # a pool timeout becomes a 503, see users.utils.db_pool
+    "users.middleware.DatabaseBusyMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     
     'django.middleware.security.SecurityMiddleware',
@@ -81,10 +86,30 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
+# Route /api/users/ to the async views (users/async_views.py). Turn on only when
+# serving backend.asgi with an ASGI server, e.g.
+#   gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker
+USE_ASYNC_VIEWS = os.getenv("USE_ASYNC_VIEWS", "False").lower() == "true"
 
 
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
+# DATABASE_POOL picks how production connects (users/utils/db_pool.py):
+#   psycopg   - a pool of DATABASE_POOL_MAX_SIZE connections per process, size it so that
+#               gunicorn workers * DATABASE_POOL_MAX_SIZE stays below the server's connection cap
+#   pgbouncer - through a pgbouncer in transaction pooling mode
+#   unset     - one persistent connection per thread
+DATABASE_POOL = os.getenv("DATABASE_POOL", "").lower()
+DATABASE_POOL_MIN_SIZE = int(os.getenv("DATABASE_POOL_MIN_SIZE", "2"))
+DATABASE_POOL_MAX_SIZE = int(os.getenv("DATABASE_POOL_MAX_SIZE", "10"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "5"))  # seconds a request waits for a connection, then 503
+DATABASE_POOL_MAX_IDLE = float(os.getenv("DATABASE_POOL_MAX_IDLE", "300"))  # seconds before an idle connection is closed
+DATABASE_POOL_MAX_LIFETIME = float(os.getenv("DATABASE_POOL_MAX_LIFETIME", "1800"))
+DATABASE_CONN_MAX_AGE = int(os.getenv("DATABASE_CONN_MAX_AGE", "600"))  # without the psycopg pool
+# check a connection before use, drops the ones the server or a proxy closed while idle
+DATABASE_HEALTH_CHECKS = os.getenv("DATABASE_HEALTH_CHECKS", "True").lower() == "true"
+
 if DEBUG:#` development
     DATABASES = {
         'default': {
@@ -96,15 +121,45 @@ else:# production
     DATABASES = {
     'default': dj_database_url.config(
         default=os.getenv("DATABASE_URL"),
-        conn_max_age=600,
+        # the psycopg pool owns its connections, Django must not keep them
+        conn_max_age=0 if DATABASE_POOL == "psycopg" else DATABASE_CONN_MAX_AGE,
+        conn_health_checks=DATABASE_HEALTH_CHECKS,
         ssl_require=os.getenv("DATABASE_SSL", "False").lower() == "true",
     )
 }
+    if DATABASE_POOL == "psycopg":
+        DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+            "min_size": DATABASE_POOL_MIN_SIZE,
+            "max_size": DATABASE_POOL_MAX_SIZE,
+            "timeout": DATABASE_POOL_TIMEOUT,
+            "max_idle": DATABASE_POOL_MAX_IDLE,
+            "max_lifetime": DATABASE_POOL_MAX_LIFETIME,
+        }
+    elif DATABASE_POOL == "pgbouncer":
+        # transaction pooling: a transaction may land on another server
+        # connection than the last one, so no named cursors (iterator() then
+        # fetches the whole result) and no server-side prepared statements
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+        DATABASES['default'].setdefault('OPTIONS', {})['prepare_threshold'] = None
+
+# Redis - one pool per process shared by OTPManager, the cache and rate limiting
+# (users/utils/redis_pool.py). Size REDIS_MAX_CONNECTIONS so that
+# gunicorn workers * REDIS_MAX_CONNECTIONS stays below the server's maxclients.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "2"))  # seconds to wait for a free connection
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_USE_HIREDIS = os.getenv("REDIS_USE_HIREDIS", "True").lower() == "true"  # used only if hiredis is installed
 
 CACHES = {
         "default": {
             "BACKEND": "django_redis.cache.RedisCache",
-            "LOCATION": os.getenv("REDIS_URL"),
+            "LOCATION": REDIS_URL,
+            "OPTIONS": {
+                "CONNECTION_FACTORY": "users.utils.redis_pool.SharedConnectionFactory",
+            },
         }
     }
 
@@ -148,6 +203,8 @@ STATIC_URL = 'static/'
 #cors
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_ORIGINS = False
+# the waiting room admission, see users/utils/waiting_room.py
+CORS_ALLOW_HEADERS = (*default_headers, "x-admission-token")
 if DEBUG:
     CORS_ALLOWED_ORIGINS = [
         "http://localhost:3000",
@@ -169,19 +226,21 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.AllowAny',
     ),
-    "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.AnonRateThrottle",
-        "rest_framework.throttling.UserRateThrottle",
-    ],
-    "DEFAULT_THROTTLE_RATES": {
-        "anon": "10/min",
-        "user": "100/min",
-    },
+    # no DRF throttles: the users endpoints rate limit in users.utils.rate_limit
+    "DEFAULT_THROTTLE_CLASSES": [],
 }
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
 REGISTRATION_AMOUNT = int(os.getenv("REGISTRATION_AMOUNT", "10000"))  # Default to 10000 INR if not set  in rupees:100 = 1 INR
 RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET")
+# users.utils.payment_gateway.FakeGateway keeps orders in memory, for tests and load runs
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "users.utils.payment_gateway.RazorpayGateway")
+RAZORPAY_CONNECT_TIMEOUT = float(os.getenv("RAZORPAY_CONNECT_TIMEOUT", "3"))
+RAZORPAY_READ_TIMEOUT = float(os.getenv("RAZORPAY_READ_TIMEOUT", "10"))
+RAZORPAY_POOL_SIZE = int(os.getenv("RAZORPAY_POOL_SIZE", "10"))
+RAZORPAY_MAX_RETRIES = int(os.getenv("RAZORPAY_MAX_RETRIES", "2"))
+RAZORPAY_RETRY_BACKOFF = float(os.getenv("RAZORPAY_RETRY_BACKOFF", "0.5"))  # seconds, doubled every retry
+FAKE_GATEWAY_LATENCY = float(os.getenv("FAKE_GATEWAY_LATENCY", "0"))  # seconds added to each fake call
 # Security settings
 SECURE_SSL_REDIRECT = os.getenv("SECURE_SSL_REDIRECT", "False") == "True"
 SESSION_COOKIE_SECURE = os.getenv("SESSION_COOKIE_SECURE", "False") == "True"
@@ -198,6 +257,15 @@ RECAPTCHA_SECRET_KEY = os.getenv("RECAPTCHA_SECRET_KEY")
 RECAPTCHA_SCORE_THRESHOLD = float(
     os.getenv("RECAPTCHA_SCORE_THRESHOLD", "0.5")
 )
+RECAPTCHA_CONNECT_TIMEOUT = float(os.getenv("RECAPTCHA_CONNECT_TIMEOUT", "2"))
+RECAPTCHA_READ_TIMEOUT = float(os.getenv("RECAPTCHA_READ_TIMEOUT", "3"))
+RECAPTCHA_POOL_SIZE = int(os.getenv("RECAPTCHA_POOL_SIZE", "10"))
+RECAPTCHA_ACTION = os.getenv("RECAPTCHA_ACTION", "create_order")  # action the frontend names for payment-initiation
+RECAPTCHA_CACHE_TTL = int(os.getenv("RECAPTCHA_CACHE_TTL", "120"))  # seconds a used token is remembered, as long as Google accepts it
+RECAPTCHA_BREAKER_THRESHOLD = int(os.getenv("RECAPTCHA_BREAKER_THRESHOLD", "5"))  # consecutive failures
+RECAPTCHA_BREAKER_RESET = float(os.getenv("RECAPTCHA_BREAKER_RESET", "30"))  # seconds before a trial call
+# What to answer while Google is unreachable: False rejects the request, True lets it through
+RECAPTCHA_FAIL_OPEN = os.getenv("RECAPTCHA_FAIL_OPEN", "False").lower() == "true"
 # email settings
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "smtp.gmail.com"
@@ -205,3 +273,72 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
+# /api/users/metrics/ (Prometheus), scrape with "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Several worker processes: a directory they all write their metrics to, the endpoint serves the sum.
+# gunicorn.conf.py empties it when the server starts and archives the files of exited workers.
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# Server-Timing header with the per-request breakdown (db, redis, recaptcha, razorpay, serializer)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "True").lower() == "true"
+# OTP mail queue worker (python manage.py send_otp_mails)
+OTP_MAIL_MAX_RETRIES = int(os.getenv("OTP_MAIL_MAX_RETRIES", "3"))
+OTP_MAIL_RETRY_BACKOFF = float(os.getenv("OTP_MAIL_RETRY_BACKOFF", "2"))  # seconds, doubled every retry
+OTP_MAIL_SMTP_IDLE_TIMEOUT = float(os.getenv("OTP_MAIL_SMTP_IDLE_TIMEOUT", "60"))
+# Payment status cache and push (users.utils.payment_status)
+PAYMENT_STATUS_CACHE_TTL = int(os.getenv("PAYMENT_STATUS_CACHE_TTL", "600"))  # seconds, bounds staleness after edits outside the webhook path
+PAYMENT_STATUS_MAX_WAIT = float(os.getenv("PAYMENT_STATUS_MAX_WAIT", "25"))  # longest long-poll, keep below proxy read timeouts
+PAYMENT_STATUS_STREAM_TIMEOUT = float(os.getenv("PAYMENT_STATUS_STREAM_TIMEOUT", "120"))  # seconds an SSE stream stays open
+# College identity (users.utils.verification): email is <first name><student number>@COLLEGE_EMAIL_DOMAIN,
+# student numbers start with one of the batch years, e.g. STUDENT_BATCH_YEARS=24,25
+STUDENT_BATCH_YEARS = [year.strip() for year in os.getenv("STUDENT_BATCH_YEARS", "25").split(",") if year.strip()]
+COLLEGE_EMAIL_DOMAIN = os.getenv("COLLEGE_EMAIL_DOMAIN", "akgec.ac.in")
+# Rate limiting (users.utils.rate_limit)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() == "true"
+# Proxies whose X-Forwarded-For entries are believed, comma separated networks.
+# The default covers the private ranges load balancers (Render, nginx, ...) connect from.
+TRUSTED_PROXIES = [
+    network.strip()
+    for network in os.getenv("TRUSTED_PROXIES", "127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128,fc00::/7").split(",")
+    if network.strip()
+]
+# Event day check-in (users.utils.checkin): bearer token of the gate devices, scans per request
+CHECKIN_TOKEN = os.getenv("CHECKIN_TOKEN")
+CHECKIN_MAX_BATCH = int(os.getenv("CHECKIN_MAX_BATCH", "500"))
+CHECKIN_SYNC_LAG = float(os.getenv("CHECKIN_SYNC_LAG", "5"))  # seconds the sync cursor trails now, covers in-flight writes
+CHECKIN_PRESENT_TTL = int(os.getenv("CHECKIN_PRESENT_TTL", "172800"))  # seconds the checked-in id set lives after its last write
+# Student admin (users.admin): seconds the row count of a filter combination is reused
+STUDENT_ADMIN_COUNT_TTL = int(os.getenv("STUDENT_ADMIN_COUNT_TTL", "60"))
+# orders the admin re-sync action asks Razorpay about in one request; at RECONCILE_RATE 10/s
+# 150 take about 15s, inside gunicorn's 30s worker timeout. Bigger selections: manage.py reconcile_payments
+STUDENT_ADMIN_RESYNC_MAX = int(os.getenv("STUDENT_ADMIN_RESYNC_MAX", "150"))
+# Payment re-sync from Razorpay (users.utils.reconcile) and admin bulk actions: rows per batch
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "10"))  # Razorpay calls per second while re-syncing, 0 for no limit
+CONFIRMATION_MAIL_TTL = int(os.getenv("CONFIRMATION_MAIL_TTL", "86400"))  # seconds a queued confirmation mail stays sendable
+# Waiting room (users.utils.waiting_room): turn on for registration opening, send-otp and
+# payment-initiation then need an admission, handed out at WAITING_ROOM_RATE visitors per second
+WAITING_ROOM_ENABLED = os.getenv("WAITING_ROOM_ENABLED", "False").lower() == "true"
+WAITING_ROOM_RATE = float(os.getenv("WAITING_ROOM_RATE", "5"))
+WAITING_ROOM_BURST = int(os.getenv("WAITING_ROOM_BURST", "20"))  # admissions saved up while nobody waits
+WAITING_ROOM_ADMISSION_TTL = int(os.getenv("WAITING_ROOM_ADMISSION_TTL", "900"))  # seconds an admission lasts, covers the funnel
+WAITING_ROOM_ADMISSION_USES = int(os.getenv("WAITING_ROOM_ADMISSION_USES", "5"))  # requests an admission lets through: send-otp, a resend, payment-initiation, retries
+# Registration tickets (users.utils.tickets): rendered by the render_tickets worker into
+# STORAGES["tickets"], served by the ticket/ endpoint
+TICKET_DIR = os.getenv("TICKET_DIR", str(BASE_DIR / "tickets"))
+TICKET_BASE_URL = os.getenv("TICKET_BASE_URL", "")  # public URL of this backend, for the link in the confirmation mail
+TICKET_PROCESSES = int(os.getenv("TICKET_PROCESSES", "0"))  # render processes, 0 for one per core
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "tickets": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        "OPTIONS": {"location": TICKET_DIR, "allow_overwrite": True},
+    },
+}
+# Order reuse on payment-initiation (users.utils.orders): seconds an unpaid order is handed out
+# again, seconds the per-student creation lock lives (covers the Razorpay call with its retries),
+# seconds a concurrent initiation waits for that order before answering 503
+ORDER_REUSE_TTL = int(os.getenv("ORDER_REUSE_TTL", "3600"))
+ORDER_LOCK_TTL = float(os.getenv("ORDER_LOCK_TTL", "45"))
+ORDER_LOCK_WAIT = float(os.getenv("ORDER_LOCK_WAIT", "10"))
@@ -14,12 +14,15 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 from django.urls import include
+import users.async_urls
 import users.urls
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('api/users/', include(users.urls)),
+    # async views under ASGI (USE_ASYNC_VIEWS=True), sync APIViews under WSGI
+    path('api/users/', include(users.async_urls if settings.USE_ASYNC_VIEWS else users.urls)),
 ]
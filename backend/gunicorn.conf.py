@@ -0,0 +1,22 @@
+import os
+
+# Read by gunicorn when started from this directory, e.g.
+#   gunicorn backend.asgi:application -k uvicorn.workers.UvicornWorker
+# The hooks run in the master and keep METRICS_DIR (users/utils/metrics.py)
+# to one file per live worker plus the archive of exited ones.
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+
+def on_starting(server):
+    from django.conf import settings
+    if settings.METRICS_DIR:
+        from users.utils import metrics
+        metrics.clear()
+
+
+def child_exit(server, worker):
+    from django.conf import settings
+    if settings.METRICS_DIR:
+        from users.utils import metrics
+        metrics.mark_process_dead(worker.pid)
@@ -1,4 +1,161 @@
-from django.contrib import admin
-from .models import Student
-# Register your models here.
-admin.site.register(Student)
\ No newline at end of file
+import hashlib
+import json
+from datetime import datetime
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from .models import PaymentOrder, Student
+from .utils import mail_queue, reconcile
+from .utils.tickets import confirmation_mail
+
+# Student admin for a table of tens of thousands of rows:
+#   - keyset pagination on (created_at, id) instead of OFFSET: every page is
+#     an index range scan of student_created_idx (or the filter's index),
+#     however far back it is
+#   - no COUNT(*) per page load: the count of a filter combination is cached
+#     for STUDENT_ADMIN_COUNT_TTL seconds, the unfiltered total is never taken
+#   - filters and search only on indexed columns, search by exact value
+#   - bulk actions that work in batches
+
+CURSOR_VAR = "cursor"
+COUNT_KEY_PREFIX = "StudentAdmin:count:"
+
+
+def encode_cursor(student):
+    return f"{student.created_at.isoformat()},{student.pk}"
+
+
+def decode_cursor(cursor):
+    """(created_at, id) of the last row of the previous page"""
+    try:
+        created_at, pk = cursor.rsplit(",", 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError:
+        raise IncorrectLookupParameters(f"Invalid cursor: {cursor}")
+
+
+class KeysetChangeList(ChangeList):
+    """ChangeList paging by cursor, "?cursor=<created_at>,<id>" instead of "?p=<page>"
+
+    The admin's ordering must be ('-created_at', '-id') and not sortable,
+    the cursor is a position in that order.
+    """
+
+    def get_ordering(self, request, queryset):
+        # ignores "?o=", a column sort would break the cursor
+        return list(self.model_admin.get_ordering(request))
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def count_key(self):
+        # same filters and search, same count
+        params = sorted((key, value) for key, value in self.get_filters_params().items())
+        return COUNT_KEY_PREFIX + hashlib.md5(json.dumps([params, self.query]).encode()).hexdigest()
+
+    def cached_count(self):
+        key = self.count_key()
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, settings.STUDENT_ADMIN_COUNT_TTL)
+        return count
+
+    def get_results(self, request):
+        queryset = self.queryset
+        self.cursor = request.GET.get(CURSOR_VAR)
+        if self.cursor:
+            created_at, pk = decode_cursor(self.cursor)
+            queryset = queryset.filter(created_at__lte=created_at).exclude(created_at=created_at, pk__gte=pk)
+
+        # one row more than a page tells whether there is a next one
+        rows = list(queryset[:self.list_per_page + 1])
+        self.next_cursor = encode_cursor(rows[self.list_per_page - 1]) if len(rows) > self.list_per_page else None
+        self.result_list = rows[:self.list_per_page]
+
+        self.result_count = self.cached_count()
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = None
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[CURSOR_VAR])
+
+    def next_page_url(self):
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+def batches(values, size):
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@admin.register(Student)
+class StudentAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'email', 'student_number', 'branch', 'payment_status', 'is_present', 'created_at']
+    list_filter = ['payment_status', 'branch', 'is_present']
+    # exact matches on unique or indexed columns, no LIKE '%...%' scans
+    search_fields = ['email__exact', 'student_number__exact', 'razorpay_order_id__exact']
+    search_help_text = "Exact email, student number or Razorpay order id"
+    ordering = ['-created_at', '-id']
+    sortable_by = []  # see KeysetChangeList.get_ordering
+    list_per_page = 50
+    show_full_result_count = False
+    actions = ['resync_payment_status', 'resend_confirmation']
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    @admin.action(description="Re-sync payment status with Razorpay")
+    def resync_payment_status(self, request, queryset):
+        # SUCCESS is final, only the others can move; any of their orders may have been paid
+        unpaid = queryset.exclude(payment_status='SUCCESS').order_by()
+        # Razorpay is asked inside this request, a selection that would outlast the worker timeout is refused
+        limit = settings.STUDENT_ADMIN_RESYNC_MAX
+        order_ids = set(unpaid.exclude(razorpay_order_id=None).values_list('razorpay_order_id', flat=True)[:limit + 1])
+        order_ids.update(PaymentOrder.objects.filter(student__in=unpaid.values('id')).values_list('order_id', flat=True)[:limit + 1])
+        if len(order_ids) > limit:
+            self.message_user(
+                request,
+                f"The selection has more than {limit} orders to check, select fewer students "
+                f"or run manage.py reconcile_payments.",
+                messages.ERROR,
+            )
+            return
+        counts = reconcile.resync(order_ids)
+        self.message_user(
+            request,
+            f"Checked {counts[reconcile.CHECKED]} orders with Razorpay, recorded {counts[reconcile.EVENTS]} payment events.",
+        )
+        if counts[reconcile.ERRORS]:
+            self.message_user(request, f"{counts[reconcile.ERRORS]} orders could not be fetched, try again later.", messages.WARNING)
+
+    @admin.action(description="Resend confirmation mail")
+    def resend_confirmation(self, request, queryset):
+        rows = (
+            queryset.filter(payment_status='SUCCESS').order_by()
+            .values_list('email', 'name', 'student_number', 'id')
+            .iterator(chunk_size=settings.RECONCILE_BATCH_SIZE)
+        )
+        sent = 0
+        for batch in batches(rows, settings.RECONCILE_BATCH_SIZE):
+            mail_queue.enqueue_many(
+                [(email, *confirmation_mail(name, number, student_id)) for email, name, number, student_id in batch],
+                settings.CONFIRMATION_MAIL_TTL,
+                mail_queue.CONFIRMATION,
+            )
+            sent += len(batch)
+        self.message_user(request, f"Queued {sent} confirmation mails, unpaid students were skipped.")
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class UsersConfig(AppConfig):
     name = 'users'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .utils import checkin, timing
+        from .utils.otp_manager import OTPManager
+        OTPManager.register_scripts()
+        connection_created.connect(timing.install_db_wrapper, dispatch_uid="users.timing")
+        checkin.connect_signals()
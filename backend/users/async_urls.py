@@ -0,0 +1,24 @@
+from django.urls import path
+from django.views.decorators.csrf import csrf_exempt
+from .async_views import SendOTPAsyncView, VerifyOTPAsyncView, PaymentInitiationAsyncView, RazorpayWebhookAsyncView, PaymentStatusAsyncView, PaymentStatusEventsAsyncView
+from .views import CheckinSyncView, CheckinView, MetricsView, OTPStatusView, TicketView, WaitingRoomStatusView, WaitingRoomView, export_students
+
+# Same routes and names as users/urls.py, served by the async views, plus
+# the payment status stream which needs an ASGI server to hold connections.
+# csrf_exempt matches DRF's APIView, which the sync views rely on.
+urlpatterns = [
+    path('send-otp/', csrf_exempt(SendOTPAsyncView.as_view()), name='send-otp'),
+    path('otp-status/', OTPStatusView.as_view(), name='otp-status'),
+    path('verify-otp/', csrf_exempt(VerifyOTPAsyncView.as_view()), name='verify-otp'),
+    path('payment-initiation/', csrf_exempt(PaymentInitiationAsyncView.as_view()), name='payment-initiation'),
+    path('razorpay-webhook/', csrf_exempt(RazorpayWebhookAsyncView.as_view()), name='razorpay-webhook'),
+    path('payment-status/<int:student_id>/', PaymentStatusAsyncView.as_view(), name='payment-status'),
+    path('payment-status/<int:student_id>/events/', PaymentStatusEventsAsyncView.as_view(), name='payment-status-events'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('checkin/', CheckinView.as_view(), name='checkin'),
+    path('checkin/sync/', CheckinSyncView.as_view(), name='checkin-sync'),
+    path('export/', export_students, name='export-students'),
+    path('waiting-room/', WaitingRoomView.as_view(), name='waiting-room'),
+    path('waiting-room/status/', WaitingRoomStatusView.as_view(), name='waiting-room-status'),
+    path('ticket/', TicketView.as_view(), name='ticket'),
+]
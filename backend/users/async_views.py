@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views import View
+from .models import Student
+from .serializers import StudentSerializer
+from .utils.otp_manager import OTPManager
+from .utils.payment_gateway import get_gateway
+from .utils import orders, payment_status, timing, verification, webhook_stream
+from .utils.webhooks import apply_payment_event, parse_payment_event
+from .utils.rate_limit import client_ip
+from .views import (
+    PAYMENT_INITIATION_CHECKS, PAYMENT_STATUS_CHECKS, PAYMENT_STATUS_EVENTS_CHECKS, SEND_OTP_CHECKS,
+    VERIFY_OTP_CHECKS, VERIFY_OTP_FIELDS, admission, order_busy, rejected, save_student, student_number,
+    webhook_response,
+)
+
+# Async (ASGI-native) versions of the views in views.py, routed instead of them
+# when settings.USE_ASYNC_VIEWS is on. Redis, the ORM and outbound HTTP are all
+# awaited so one process can hold many registrations waiting on I/O.
+
+logger = logging.getLogger(__name__)
+
+
+def json_body(request):
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+class SendOTPAsyncView(View):
+    async def post(self, request):
+        try:
+            data = json_body(request)
+            ip_address = client_ip(request)
+            rejection = await SEND_OTP_CHECKS.arun({"data": data, "ip": ip_address, "admission": admission(request)})
+            if rejection:
+                return rejected(rejection, JsonResponse)
+
+            success, message = await OTPManager.asend_otp(data['email'], ip_address)
+            return JsonResponse({'success': success, 'message': message}, status=200 if success else 429)
+
+        except Exception as e:
+            logger.error(f"SendOTPAsyncView error: {str(e)}")
+            return JsonResponse({'success': False, 'message': f"Error sending OTP: {str(e)}"}, status=500)
+
+
+class VerifyOTPAsyncView(View):
+    async def post(self, request):
+        data = json_body(request)
+        email = data.get('email')
+        otp = data.get('otp')
+
+        rejection = await VERIFY_OTP_CHECKS.arun({"data": data, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection, JsonResponse)
+
+        existing = await Student.objects.filter(email=email).only(*VERIFY_OTP_FIELDS).afirst()
+        if existing:
+            if existing.payment_status == 'SUCCESS':
+                return JsonResponse({"detail": "Payment already completed for this email"}, status=400)
+
+            if existing.is_email_verified and existing.payment_status in ['PENDING', 'FAILED']:
+                return JsonResponse({"id": existing.id}, status=200)
+
+            verified, message = await OTPManager.averify_otp(email, otp)
+            if not verified:
+                return JsonResponse({"detail": message}, status=400)
+
+            serializer = StudentSerializer(existing, data=data, partial=True)
+            with timing.span("serializer"):
+                valid = serializer.is_valid()
+            if not valid:
+                return JsonResponse(serializer.errors, status=400)
+            student, error = await sync_to_async(save_student)(serializer)
+            if error:
+                return JsonResponse(error, status=400)
+            return JsonResponse({"id": student.id, "is_email_verified": True}, status=200)
+
+        error = verification.identity_error(email, data.get("name"), student_number(data) or "")
+        if error:
+            return JsonResponse({"error": error}, status=400)
+
+        verified, message = await OTPManager.averify_otp(email, otp)
+        if not verified:
+            return JsonResponse({"detail": message}, status=400)
+
+        serializer = StudentSerializer(data=data)
+        with timing.span("serializer"):
+            valid = serializer.is_valid()
+        if not valid:
+            return JsonResponse(serializer.errors, status=400)
+        student, error = await sync_to_async(save_student)(serializer)
+        if error:
+            return JsonResponse(error, status=400)
+        return JsonResponse({"id": student.id}, status=200)
+
+
+class PaymentInitiationAsyncView(View):
+    async def post(self, request):
+        data = json_body(request)
+        ctx = {"data": data, "ip": client_ip(request), "admission": admission(request)}
+        rejection = await PAYMENT_INITIATION_CHECKS.arun(ctx)
+        if rejection:
+            return rejected(rejection, JsonResponse)
+        student = ctx["student"]
+
+        try:
+            order, _ = await orders.aorder_for(student)
+            return JsonResponse(order, status=200)
+        except orders.OrderBusy:
+            return order_busy(JsonResponse)
+        except Exception as e:
+            return JsonResponse({"detail": str(e)}, status=500)
+
+
+class RazorpayWebhookAsyncView(View):
+    """Not rate limited, see RazorpayWebhookAPIView"""
+    async def post(self, request):
+        signature = request.headers.get('X-Razorpay-Signature')
+
+        # verify signature (local HMAC, no I/O)
+        if not get_gateway().verify_webhook_signature(request.body, signature):
+            return JsonResponse({"detail": "Invalid signature"}, status=400)
+
+        event_id = request.headers.get('X-Razorpay-Event-Id')
+        try:
+            await webhook_stream.aappend(request.body, event_id)
+            return JsonResponse({"detail": "OK , Queued"}, status=200)
+        except Exception as e:
+            logger.error(f"Webhook queue unavailable, applying inline: {str(e)}")
+
+        event, order_id, payment_id = parse_payment_event(json_body(request))
+        result = await sync_to_async(apply_payment_event)(event, order_id, payment_id, event_id)
+        return webhook_response(result, JsonResponse)
+
+
+class PaymentStatusAsyncView(View):
+    """Cached payment status, ?wait=<seconds> long-polls until it changes
+
+    ?since=<status> is the status the client already shows, by default the
+    current one. The answer comes as soon as the webhook moves the status
+    away from it, or with the unchanged status when the wait is over.
+    """
+    async def get(self, request, student_id):
+        rejection = await PAYMENT_STATUS_CHECKS.arun({"data": {}, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection, JsonResponse)
+
+        status = await payment_status.aget_status(student_id)
+        if status is None:
+            return JsonResponse({"detail": "Student not found"}, status=404)
+
+        try:
+            wait = min(float(request.GET.get('wait', 0)), settings.PAYMENT_STATUS_MAX_WAIT)
+        except ValueError:
+            return JsonResponse({"detail": "wait must be a number of seconds"}, status=400)
+        if wait > 0 and status not in payment_status.FINAL_STATUSES:
+            status = await payment_status.wait_for_change(student_id, request.GET.get('since') or status, wait)
+        return JsonResponse({"id": student_id, "payment_status": status}, status=200)
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def status_events(student_id, keepalive=15):
+    """Current status, then every change until it is final or the stream times out"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.PAYMENT_STATUS_STREAM_TIMEOUT
+    async with payment_status.watch(student_id) as changes:
+        status = await payment_status.aget_status(student_id)
+        yield "retry: 3000\n\n" + sse("status", {"id": student_id, "payment_status": status})
+        while status not in payment_status.FINAL_STATUSES:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                async with asyncio.timeout(min(remaining, keepalive)):
+                    changed = await changes.get()
+            except TimeoutError:
+                yield ": keepalive\n\n"  # keeps proxies from closing an idle stream
+                continue
+            if changed != status:
+                status = changed
+                yield sse("status", {"id": student_id, "payment_status": status})
+
+
+class PaymentStatusEventsAsyncView(View):
+    """Server-Sent Events version of PaymentStatusAsyncView, one push per change"""
+    async def get(self, request, student_id):
+        rejection = await PAYMENT_STATUS_EVENTS_CHECKS.arun({"data": {}, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection, JsonResponse)
+        if await payment_status.aget_status(student_id) is None:
+            return JsonResponse({"detail": "Student not found"}, status=404)
+
+        response = StreamingHttpResponse(status_events(student_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # nginx: pass each event through unbuffered
+        return response
@@ -0,0 +1,143 @@
+import contextlib
+import json
+import os
+import random
+import statistics
+import string
+import time
+import redis
+from django.core.management.base import BaseCommand
+from users.utils import mail_queue, otp_manager
+from users.utils.otp_manager import OTPManager
+
+
+class RoundTrips:
+    """Counts packets written to Redis - one per command, one per pipeline"""
+    count = 0
+
+
+class CountingConnection(redis.Connection):
+    def send_packed_command(self, command, check_health=True):
+        RoundTrips.count += 1
+        return super().send_packed_command(command, check_health)
+
+
+class CountingSSLConnection(redis.SSLConnection):
+    def send_packed_command(self, command, check_health=True):
+        RoundTrips.count += 1
+        return super().send_packed_command(command, check_health)
+
+
+class LegacyOTPManager:
+    """OTPManager as it was before the Lua scripts, kept for comparison"""
+
+    @staticmethod
+    def send_otp(client, email):
+        cooldown_key = f"Cooldown:{email}"
+        if client.exists(cooldown_key):
+            ttl = client.ttl(cooldown_key)
+            return False, f"Wait {ttl} seconds before requesting again"
+        otp = ''.join(random.choices(string.digits, k=OTPManager.OTP_LENGTH))
+        client.setex(f"OTP:{email}", OTPManager.OTP_EXPIRY, otp)
+        client.setex(cooldown_key, OTPManager.COOLDOWN, "1")
+        client.setex(f"Attempts:{email}", OTPManager.OTP_EXPIRY, "0")
+        job = mail_queue.build_job(email, "Your OTP Code", f"Your OTP is: {otp}", OTPManager.OTP_EXPIRY)
+        pipe = client.pipeline()
+        pipe.lpush(mail_queue.QUEUE_KEY, json.dumps(job))
+        mail_queue._write_status(pipe, job, mail_queue.QUEUED, OTPManager.OTP_EXPIRY)
+        pipe.execute()
+        return True, "OTP sent successfully"
+
+    @staticmethod
+    def verify_otp(client, email, otp_input):
+        attempts_key = f"Attempts:{email}"
+        attempts = int(client.get(attempts_key) or 0)
+        if attempts >= OTPManager.MAX_ATTEMPTS:
+            return False, "Max attempts reached. Request new OTP"
+        otp_key = f"OTP:{email}"
+        stored_otp = client.get(otp_key)
+        if not stored_otp:
+            return False, "OTP expired or invalid"
+        client.incr(attempts_key)
+        if stored_otp.decode() == otp_input:
+            client.setex(f"Verified:{email}", 60, "1")
+            client.delete(otp_key)
+            client.delete(attempts_key)
+            client.delete(f"Cooldown:{email}")
+            return True, "OTP verified successfully"
+        return False, "Invalid OTP"
+
+
+class Command(BaseCommand):
+    help = "Compare Redis round trips and latency of the legacy and scripted OTP paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=500)
+        parser.add_argument("--redis-url", default=os.getenv("REDIS_URL"))
+
+    def handle(self, *args, **options):
+        url = options["redis_url"]
+        connection_class = CountingSSLConnection if url.startswith("rediss://") else CountingConnection
+        client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+            url, connection_class=connection_class,
+        ))
+        plain = redis.from_url(url, decode_responses=True)
+
+        with self.isolated_keys(plain):
+            OTPManager.register_scripts()
+            results = {
+                "legacy": self.run(
+                    options["iterations"], plain,
+                    issue=lambda email: LegacyOTPManager.send_otp(client, email),
+                    verify=lambda email, otp: LegacyOTPManager.verify_otp(client, email, otp),
+                ),
+                "scripted": self.run(
+                    options["iterations"], plain,
+                    issue=lambda email: OTPManager.send_otp(email, None),
+                    verify=lambda email, otp: OTPManager.verify_otp(email, otp),
+                    client=client,
+                ),
+            }
+
+        self.stdout.write(f"{'impl':<10}{'call':<16}{'trips/call':>12}{'p50 ms':>10}{'p99 ms':>10}")
+        for impl, calls in results.items():
+            for call, (trips, latencies) in calls.items():
+                p50 = statistics.median(latencies) * 1000
+                p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+                self.stdout.write(f"{impl:<10}{call:<16}{trips / len(latencies):>12.2f}{p50:>10.3f}{p99:>10.3f}")
+
+    def run(self, iterations, plain, issue, verify, client=None):
+        calls = {"issue": [0, []], "verify_wrong": [0, []], "verify_ok": [0, []]}
+        previous = otp_manager.redis_client
+        if client is not None:
+            otp_manager.redis_client = client
+        try:
+            for i in range(iterations):
+                email = f"bench{i}@bench.invalid"
+                plain.delete(f"Cooldown:{email}", f"Attempts:{email}", f"OTP:{email}")
+                self.timed(calls["issue"], issue, email)
+                otp = plain.get(f"OTP:{email}")
+                self.timed(calls["verify_wrong"], verify, email, "x")
+                self.timed(calls["verify_ok"], verify, email, otp)
+                plain.delete(f"Verified:{email}", mail_queue.status_key(email))
+        finally:
+            otp_manager.redis_client = previous
+        return calls
+
+    def timed(self, bucket, fn, *args):
+        before = RoundTrips.count
+        start = time.perf_counter()
+        fn(*args)
+        bucket[1].append(time.perf_counter() - start)
+        bucket[0] += RoundTrips.count - before
+
+    @contextlib.contextmanager
+    def isolated_keys(self, plain):
+        """Point the mail queue at a scratch key so no benchmark mail is ever sent"""
+        queue_key = mail_queue.QUEUE_KEY
+        mail_queue.QUEUE_KEY = "Bench:MailQueue"
+        try:
+            yield
+        finally:
+            plain.delete(mail_queue.QUEUE_KEY)
+            mail_queue.QUEUE_KEY = queue_key
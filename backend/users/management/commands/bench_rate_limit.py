@@ -0,0 +1,77 @@
+import os
+import statistics
+import time
+import redis
+from django.core.management.base import BaseCommand
+from users.utils import rate_limit
+from users.utils.rate_limit import BLOCKED_EMAILS_KEY, BLOCKED_IPS_KEY, limit
+from .bench_otp import CountingConnection, CountingSSLConnection, RoundTrips
+
+LIMITS = (limit("ip", "10/m"), limit("email", "5/h"))
+
+
+def legacy_gate(client, ip, email):
+    """The send-otp request checks as they were before rate_limit, kept for comparison
+
+    django_ratelimit per IP and per email (cache add + incr each), DRF's
+    anon throttle (get + set of its history list) and the blocklist and
+    cooldown pipeline.
+    """
+    for key in (f"rl:ip:{ip}", f"rl:email:{email}"):
+        client.set(key, 0, ex=60, nx=True)
+        client.incr(key)
+    history = client.get(f"throttle_anon_{ip}")
+    client.set(f"throttle_anon_{ip}", history or b"[]", ex=86400)
+    pipe = client.pipeline()
+    pipe.sismember(BLOCKED_IPS_KEY, ip)
+    pipe.sismember(BLOCKED_EMAILS_KEY, email)
+    pipe.ttl(f"Cooldown:{email}")
+    return pipe.execute()
+
+
+class Command(BaseCommand):
+    help = "Compare Redis round trips and latency of the legacy rate limiting and the single gate script"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=1000)
+        parser.add_argument("--redis-url", default=os.getenv("REDIS_URL"))
+
+    def handle(self, *args, **options):
+        url = options["redis_url"]
+        connection_class = CountingSSLConnection if url.startswith("rediss://") else CountingConnection
+        client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+            url, connection_class=connection_class,
+        ))
+        iterations = options["iterations"]
+
+        previous = rate_limit.redis_client
+        rate_limit.redis_client = client
+        try:
+            results = {
+                "legacy": self.run(iterations, lambda ctx: legacy_gate(client, ctx["ip"], ctx["data"]["email"])),
+                "gate": self.run(iterations, lambda ctx: rate_limit.gate("bench", LIMITS, ctx, f"Cooldown:{ctx['data']['email']}")),
+            }
+        finally:
+            rate_limit.redis_client = previous
+            keys = list(client.scan_iter("RateLimit:bench:*")) + list(client.scan_iter("rl:*")) + list(client.scan_iter("throttle_anon_*"))
+            if keys:
+                client.delete(*keys)
+
+        self.stdout.write(f"{'impl':<10}{'trips/call':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for impl, (trips, latencies) in results.items():
+            p50 = statistics.median(latencies) * 1000
+            cuts = statistics.quantiles(latencies, n=100)
+            self.stdout.write(
+                f"{impl:<10}{trips / len(latencies):>12.2f}{p50:>10.3f}{cuts[94] * 1000:>10.3f}{cuts[98] * 1000:>10.3f}"
+            )
+
+    def run(self, iterations, fn):
+        trips, latencies = 0, []
+        for i in range(iterations):
+            ctx = {"ip": f"198.51.100.{i % 250}", "data": {"email": f"bench{i}@bench.invalid"}}
+            before = RoundTrips.count
+            start = time.perf_counter()
+            fn(ctx)
+            latencies.append(time.perf_counter() - start)
+            trips += RoundTrips.count - before
+        return trips, latencies
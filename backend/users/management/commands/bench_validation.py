@@ -0,0 +1,45 @@
+import timeit
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.validators import RegexValidator
+from users.utils import verification
+
+# (email, name, student number) samples: accepted, wrong domain, wrong name, garbage
+SAMPLES = {
+    "valid": ("aman250001@akgec.ac.in", "Aman Kumar", "250001"),
+    "other_domain": ("aman250001@gmail.com", "Aman Kumar", "250001"),
+    "name_mismatch": ("amaan250001@akgec.ac.in", "Aman Kumar", "250001"),
+    "garbage": ("x" * 200, "", ""),
+}
+
+
+def legacy_identity_error(email, name, student_number):
+    """The checks as views.py and the model did them before users.utils.verification"""
+    try:
+        # a new validator (and a regex cache lookup) per call, as verify_mail_fail did
+        RegexValidator(regex=r'^[a-zA-Z]+25\d+@akgec\.ac\.in$', message="Invalid email")(email)
+        RegexValidator(regex=r'^25\d{4,6}$', message="Invalid student number")(student_number)
+    except ValidationError as e:
+        return e.messages[0]
+    name_parts = str(name).split()
+    if not name_parts or name_parts[0] + str(student_number) + "@akgec.ac.in" != str(email):
+        return "Email is in wrong format"
+    return None
+
+
+class Command(BaseCommand):
+    help = "Time the identity validation against the per-call RegexValidator checks it replaced"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=100000, help="Calls per timing run")
+        parser.add_argument("--repeat", type=int, default=5, help="Timing runs, the best one is reported")
+
+    def handle(self, *args, **options):
+        number, repeat = options["number"], options["repeat"]
+        impls = {"legacy": legacy_identity_error, "verification": verification.identity_error}
+
+        self.stdout.write(f"{'sample':<16}{'impl':<14}{'ns/call':>10}")
+        for sample, values in SAMPLES.items():
+            for impl, fn in impls.items():
+                best = min(timeit.repeat(lambda: fn(*values), number=number, repeat=repeat))
+                self.stdout.write(f"{sample:<16}{impl:<14}{best / number * 1e9:>10.0f}")
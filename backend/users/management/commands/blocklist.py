@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from users.utils.rate_limit import BLOCKED_EMAILS_KEY, BLOCKED_IPS_KEY, redis_client
+
+
+class Command(BaseCommand):
+    help = "Add, remove or list blocked emails and IPs, refused by the Redis stage of the request checks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["add", "remove", "list"])
+        parser.add_argument("--email", action="append", default=[], help="Email, repeatable")
+        parser.add_argument("--ip", action="append", default=[], help="IP address, repeatable")
+
+    def handle(self, *args, **options):
+        # the gate compares emails lowercased
+        sets = {BLOCKED_EMAILS_KEY: [email.lower() for email in options["email"]], BLOCKED_IPS_KEY: options["ip"]}
+        action = options["action"]
+
+        if action == "list":
+            for key in sets:
+                members = sorted(member.decode() for member in redis_client.smembers(key))
+                self.stdout.write(f"{key} ({len(members)})")
+                for member in members:
+                    self.stdout.write(f"  {member}")
+            return
+
+        if not any(sets.values()):
+            raise CommandError("Give at least one --email or --ip")
+        for key, members in sets.items():
+            if not members:
+                continue
+            if action == "add":
+                changed = redis_client.sadd(key, *members)
+            else:
+                changed = redis_client.srem(key, *members)
+            self.stdout.write(f"{key}: {action} {changed} of {len(members)}")
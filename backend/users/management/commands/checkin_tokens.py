@@ -0,0 +1,31 @@
+import csv
+from django.core.management.base import BaseCommand
+from users.models import Student
+from users.utils import checkin
+
+
+class Command(BaseCommand):
+    help = "Write the check-in token (QR content) of every paid student as CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="CSV file, stdout when left out")
+
+    def handle(self, *args, **options):
+        rows = (
+            Student.objects.filter(payment_status='SUCCESS')
+            .order_by('id')
+            .values_list('id', 'student_number', 'name', 'email')
+            .iterator(chunk_size=2000)
+        )
+        out = open(options["output"], "w", newline="") if options["output"] else self.stdout
+        try:
+            writer = csv.writer(out)
+            writer.writerow(["id", "student_number", "name", "email", "token"])
+            count = 0
+            for student_id, number, name, email in rows:
+                writer.writerow([student_id, number, name, email, checkin.issue_token(student_id)])
+                count += 1
+        finally:
+            if out is not self.stdout:
+                out.close()
+        self.stderr.write(f"{count} tokens")
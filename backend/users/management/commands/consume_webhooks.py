@@ -0,0 +1,107 @@
+import json
+import logging
+import socket
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from users.utils import webhook_stream
+from users.utils.webhook_stream import redis_client
+from users.utils.webhooks import NOT_FOUND, apply_payment_event, apply_payment_events, parse_payment_event
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Apply Razorpay webhook events from the Redis stream to Student in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", default=socket.gethostname(), help="Consumer name inside the group")
+        parser.add_argument("--batch", type=int, default=100, help="Events read and applied per batch")
+        parser.add_argument("--block", type=int, default=2000, help="Milliseconds to wait for new events, keep below REDIS_SOCKET_TIMEOUT")
+        parser.add_argument("--retry-after", type=int, default=30000, help="Milliseconds before a pending event is retried")
+        parser.add_argument("--max-deliveries", type=int, default=5, help="Deliveries before an event goes to the dead letter stream")
+        parser.add_argument("--once", action="store_true", help="Apply what is there and exit")
+
+    def handle(self, *args, **options):
+        self.name = options["name"]
+        self.max_deliveries = options["max_deliveries"]
+        webhook_stream.ensure_group()
+        self.stdout.write(f"Webhook consumer {self.name} started")
+
+        try:
+            while True:
+                # pending events of crashed consumers (or our own failed ones)
+                _, claimed, _ = redis_client.xautoclaim(
+                    webhook_stream.STREAM_KEY, webhook_stream.GROUP, self.name,
+                    min_idle_time=options["retry_after"], start_id="0-0", count=options["batch"],
+                )
+                fresh = redis_client.xreadgroup(
+                    webhook_stream.GROUP, self.name, {webhook_stream.STREAM_KEY: ">"},
+                    count=options["batch"], block=None if options["once"] else options["block"],
+                )
+                messages = claimed + (fresh[0][1] if fresh else [])
+                if messages:
+                    close_old_connections()
+                    self.process(messages)
+                    webhook_stream.trim_acknowledged()
+                elif options["once"]:
+                    break
+        except KeyboardInterrupt:
+            pass
+
+    def process(self, messages):
+        events = {}
+        for message_id, fields in messages:
+            try:
+                data = json.loads(fields[b"body"])
+            except (KeyError, ValueError):
+                self.dead_letter(message_id, fields, "unparseable body")
+                continue
+            event, order_id, payment_id = parse_payment_event(data)
+            events[message_id] = (event, order_id, payment_id, fields.get(b"event_id", b"").decode() or None)
+
+        if not events:
+            return
+        start = time.perf_counter()
+        try:
+            applied, unmatched = apply_payment_events(list(events.values()))
+        except Exception as e:
+            logger.warning(f"Batch of {len(events)} webhook events failed, applying one by one: {e}")
+        else:
+            # an order no student holds yet (its initiation has not committed) is retried later
+            waiting = [message_id for message_id, event in events.items() if event[1] in unmatched]
+            done = [message_id for message_id in events if message_id not in waiting]
+            if done:
+                redis_client.xack(webhook_stream.STREAM_KEY, webhook_stream.GROUP, *done)
+            for message_id in waiting:
+                self.retry_later(message_id, messages, "no student holds the order")
+            logger.info(f"Applied {applied} of {len(events)} webhook events in {time.perf_counter() - start:.3f}s")
+            return
+
+        # find the bad event, the others still go through
+        for message_id, event in events.items():
+            try:
+                result = apply_payment_event(*event)
+            except Exception as e:
+                logger.warning(f"Webhook event {message_id} failed: {e}")
+                self.retry_later(message_id, messages, str(e))
+                continue
+            if result == NOT_FOUND:
+                self.retry_later(message_id, messages, "no student holds the order")
+            else:
+                redis_client.xack(webhook_stream.STREAM_KEY, webhook_stream.GROUP, message_id)
+
+    def retry_later(self, message_id, messages, reason):
+        """Leave the event pending for xautoclaim to retry after --retry-after, up to --max-deliveries"""
+        pending = redis_client.xpending_range(
+            webhook_stream.STREAM_KEY, webhook_stream.GROUP, min=message_id, max=message_id, count=1,
+        )
+        if pending and pending[0]["times_delivered"] >= self.max_deliveries:
+            self.dead_letter(message_id, dict(messages)[message_id], reason)
+
+    def dead_letter(self, message_id, fields, reason):
+        logger.error(f"Webhook event {message_id} moved to {webhook_stream.DEAD_LETTER_KEY}: {reason}")
+        pipe = redis_client.pipeline()
+        pipe.xadd(webhook_stream.DEAD_LETTER_KEY, {**fields, b"reason": reason, b"stream_id": message_id})
+        pipe.xack(webhook_stream.STREAM_KEY, webhook_stream.GROUP, message_id)
+        pipe.execute()
@@ -0,0 +1,276 @@
+import contextlib
+import io
+import json
+import math
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+from urllib.parse import urlparse
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+from users.utils import recaptcha
+from users.utils.payment_gateway import get_gateway, reset_gateway
+from users.utils.standins import CapturingSMTPServer, SiteverifyStub
+
+# The registration funnel, one virtual student at a time per thread:
+# send-otp -> OTP mail -> verify-otp -> payment-initiation -> webhook -> payment-status.
+#
+# Runs in this process through Django's test client (views, middleware, ORM and
+# Redis, no HTTP server) on a throwaway test database. SMTP and siteverify are
+# local stand-ins (users.utils.standins), Razorpay is FakeGateway, the OTP mail
+# and webhook workers run in background threads. Redis is REDIS_URL and must be
+# local: a redis-server or fakeredis' TCP server.
+
+ENDPOINTS = (
+    "waiting-room", "waiting-room-status", "waiting-room-wait",
+    "send-otp", "otp-mail", "verify-otp", "payment-initiation", "razorpay-webhook", "payment-status",
+)
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+STATUS_POLL_INTERVAL = 0.1  # below the payment-status rate limit's burst for a few seconds
+
+
+class Recorder:
+    """Latencies and failures per endpoint, shared by the funnel threads"""
+
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.samples = []  # first few failures, to tell why
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, error=None):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if error is not None:
+                self.errors[endpoint] += 1
+                if len(self.samples) < 5:
+                    self.samples.append(f"{endpoint}: {error}")
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Run the registration funnel against local stand-ins and report throughput and p50/p95/p99 per endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--students", type=int, default=200, help="Funnels to run")
+        parser.add_argument("--concurrency", type=int, default=10, help="Funnels in flight")
+        parser.add_argument("--mail-workers", type=int, default=2, help="send_otp_mails workers")
+        parser.add_argument("--gateway-latency", type=float, default=0.0, help="Seconds added to each fake Razorpay call")
+        parser.add_argument("--siteverify-latency", type=float, default=0.0, help="Seconds the siteverify stub waits")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait in the waiting room, for the OTP mail and for SUCCESS")
+        parser.add_argument("--keepdb", action="store_true", help="Keep the test database between runs")
+        parser.add_argument("--allow-remote-redis", action="store_true", help="Run against a REDIS_URL that is not local")
+
+    def handle(self, *args, **options):
+        host = urlparse(settings.REDIS_URL or "").hostname
+        if host not in LOCAL_HOSTS and not options["allow_remote_redis"]:
+            raise CommandError(f"REDIS_URL points at {host}, run against a local Redis or pass --allow-remote-redis")
+
+        self.options = options
+        self.recorder = Recorder()
+        # student numbers of this run, so reruns do not meet keys of earlier ones in Redis
+        self.first_number = secrets.randbelow(900000 - options["students"])
+        self.batch = settings.STUDENT_BATCH_YEARS[0]
+
+        self.sqlite_file()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options["keepdb"], aliases={"default"})
+        try:
+            with CapturingSMTPServer() as smtp, SiteverifyStub(options["siteverify_latency"], action=settings.RECAPTCHA_ACTION) as siteverify, \
+                    self.overrides(smtp, siteverify), self.workers():
+                self.outbox = smtp.outbox
+                wall, completed = self.run()
+        finally:
+            reset_gateway()
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+
+        self.report(wall, completed)
+
+    def sqlite_file(self):
+        """SQLite tests run in a shared in-memory database, whose table locks fail
+        concurrent writers at once; a file waits for the lock instead"""
+        connection = connections["default"]
+        if connection.vendor == "sqlite" and not connection.settings_dict["TEST"]["NAME"]:
+            connection.settings_dict["TEST"]["NAME"] = f"{tempfile.gettempdir()}/users_loadtest.sqlite3"
+
+    @contextlib.contextmanager
+    def overrides(self, smtp, siteverify):
+        stack = override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=smtp.port,
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_HOST_USER="loadtest@localhost",
+            EMAIL_HOST_PASSWORD="",
+            PAYMENT_GATEWAY="users.utils.payment_gateway.FakeGateway",
+            FAKE_GATEWAY_LATENCY=self.options["gateway_latency"],
+            RAZORPAY_WEBHOOK_SECRET="loadtest",
+        )
+        with stack, mock.patch.object(recaptcha, "SITEVERIFY_URL", siteverify.url):
+            reset_gateway()
+            yield
+
+    @contextlib.contextmanager
+    def workers(self):
+        """The OTP mail and webhook workers, looping in threads until the run ends"""
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self.worker, args=(stop, "send_otp_mails", "--name", f"loadtest-{n}"), daemon=True)
+            for n in range(self.options["mail_workers"])
+        ]
+        threads.append(threading.Thread(target=self.worker, args=(stop, "consume_webhooks", "--name", "loadtest"), daemon=True))
+
+        for thread in threads:
+            thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def worker(self, stop, command, *args):
+        try:
+            while not stop.is_set():
+                call_command(command, "--once", *args, stdout=io.StringIO())
+                stop.wait(0.01)
+        finally:
+            connections.close_all()
+
+    def run(self):
+        concurrency = self.options["concurrency"]
+        completed = [0] * concurrency
+
+        def funnels(t):
+            try:
+                for n in range(t, self.options["students"], concurrency):
+                    completed[t] += self.funnel(n)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=funnels, args=(t,)) for t in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, sum(completed)
+
+    def call(self, endpoint, method, *args, **kwargs):
+        """Response of a 2xx call, None (and a recorded error) otherwise"""
+        start = time.perf_counter()
+        try:
+            response = method(*args, **kwargs)
+        except Exception as e:
+            self.recorder.add(endpoint, time.perf_counter() - start, repr(e))
+            return None
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 300:
+            self.recorder.add(endpoint, elapsed, f"{response.status_code} {response.content[:200]!r}")
+            return None
+        self.recorder.add(endpoint, elapsed)
+        return response
+
+    def admit(self, client, timeout):
+        """Queue in the waiting room until admitted, the client then sends the admission"""
+        start = time.perf_counter()
+        response = self.call("waiting-room", client.post, reverse("waiting-room"))
+        while response is not None:
+            state = response.json()
+            if state["admitted"]:
+                client.defaults["HTTP_X_ADMISSION_TOKEN"] = state["admission_token"]
+                self.recorder.add("waiting-room-wait", time.perf_counter() - start)
+                return True
+            if time.perf_counter() - start > timeout:
+                self.recorder.add("waiting-room-wait", time.perf_counter() - start, "not admitted in time")
+                return False
+            time.sleep(state["retry_after"])
+            response = self.call("waiting-room-status", client.get, reverse("waiting-room-status"), {"token": state["token"]})
+        return False
+
+    def funnel(self, n):
+        """True once the student's payment status reads SUCCESS"""
+        number = f"{self.batch}{self.first_number + n:06d}"
+        email = f"load{number}@{settings.COLLEGE_EMAIL_DOMAIN}"
+        # own address per student, the per IP rate limits would stop a shared one
+        client = Client(REMOTE_ADDR=f"198.18.{n // 250 % 256}.{n % 250 + 1}")
+        timeout = self.options["timeout"]
+
+        if settings.WAITING_ROOM_ENABLED and not self.admit(client, timeout):
+            return False
+        if not self.call("send-otp", client.post, reverse("send-otp"), {"email": email}):
+            return False
+        start = time.perf_counter()
+        otp = self.outbox.wait_for_otp(email, timeout=timeout)
+        self.recorder.add("otp-mail", time.perf_counter() - start, None if otp else "no OTP mail")
+        if not otp:
+            return False
+
+        response = self.call("verify-otp", client.post, reverse("verify-otp"), {
+            "name": "Load Test",
+            "email": email,
+            "student_number": number,
+            "phone": f"98{n:08d}",
+            "branch": "CSE",
+            "gender": "MALE",
+            "otp": otp,
+        })
+        if not response:
+            return False
+        student_id = response.json()["id"]
+
+        response = self.call("payment-initiation", client.post, reverse("payment-initiation"), {
+            "student_id": student_id,
+            "recaptcha_token": f"loadtest-{secrets.token_hex(8)}",
+        })
+        if not response:
+            return False
+
+        body, signature = get_gateway().pay(response.json()["id"])
+        event_id = f"evt_{json.loads(body)['payload']['payment']['entity']['id']}"
+        if not self.call("razorpay-webhook", client.post, reverse("razorpay-webhook"), body,
+                         content_type="application/json",
+                         HTTP_X_RAZORPAY_SIGNATURE=signature, HTTP_X_RAZORPAY_EVENT_ID=event_id):
+            return False
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            response = self.call("payment-status", client.get, reverse("payment-status", args=[student_id]))
+            if response and response.json().get("payment_status") == "SUCCESS":
+                return True
+            time.sleep(STATUS_POLL_INTERVAL)
+        return False
+
+    def report(self, wall, completed):
+        options = self.options
+        self.stdout.write(
+            f"{options['students']} students, concurrency {options['concurrency']}: "
+            f"{completed} paid in {wall:.2f}s ({completed / wall:.1f} funnels/s)"
+        )
+        self.stdout.write(f"{'endpoint':<20}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.recorder.latencies[endpoint])
+            if not latencies:
+                continue
+            p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99))
+            self.stdout.write(
+                f"{endpoint:<20}{len(latencies):>9}{self.recorder.errors[endpoint]:>8}{len(latencies) / wall:>9.1f}"
+                f"{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}"
+            )
+        self.stdout.write("otp-mail is the wait from the send-otp response to the mail arriving, not a request")
+        if settings.WAITING_ROOM_ENABLED:
+            self.stdout.write("waiting-room-wait is the time from joining the waiting room to being admitted")
+        for sample in self.recorder.samples:
+            sys.stderr.write(f"{sample}\n")
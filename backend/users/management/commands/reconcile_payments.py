@@ -0,0 +1,147 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from users.models import PaymentOrder, Student
+from users.utils import reconcile, webhooks
+from users.utils.payment_gateway import get_gateway
+
+# report counters, besides reconcile's checked / events / errors
+TO_SUCCESS = "to_success"
+TO_FAILED = "to_failed"
+UNCHANGED = "unchanged"
+COUNTERS = (reconcile.CHECKED, TO_SUCCESS, TO_FAILED, UNCHANGED, reconcile.EVENTS, reconcile.ERRORS)
+PAGE_FIELDS = ('id', 'razorpay_order_id', 'payment_status')
+
+
+class Command(BaseCommand):
+    help = "Ask Razorpay about unpaid students' orders and apply what it says, for webhooks that never arrived"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--status", dest="statuses", action="append", choices=["PENDING", "FAILED"], help="Only students in this status, repeatable (default both)")
+        parser.add_argument("--min-age", type=int, default=600, help="Skip students updated less than this many seconds ago, their webhook may be on its way")
+        parser.add_argument("--batch", type=int, default=settings.RECONCILE_BATCH_SIZE, help="Students per page, one UPDATE per page")
+        parser.add_argument("--concurrency", type=int, default=settings.RAZORPAY_POOL_SIZE, help="Razorpay calls in flight")
+        parser.add_argument("--rate", type=float, default=settings.RECONCILE_RATE, help="Razorpay calls per second, 0 for no limit")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change, write nothing")
+        parser.add_argument("--restart", action="store_true", help="Forget the checkpoint of an interrupted run and start from the first student")
+        parser.add_argument("--allow-fake-gateway", action="store_true", help="Run against FakeGateway too (tests, load runs), its answers are made up")
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        self.verbosity = options["verbosity"]
+        statuses = ",".join(sorted(options["statuses"] or ["FAILED", "PENDING"]))
+        counts = dict.fromkeys(COUNTERS, 0)
+        after = 0
+        retry = []  # students of an interrupted run whose orders could not be fetched
+        gateway = get_gateway()
+        if gateway.service == "fake" and not (self.dry_run or options["allow_fake_gateway"]):
+            raise CommandError(
+                "PAYMENT_GATEWAY is FakeGateway, it would move students on made-up answers; "
+                "point it at Razorpay, or pass --allow-fake-gateway"
+            )
+
+        if options["restart"] and not self.dry_run:
+            reconcile.clear_checkpoint()
+        checkpoint = {} if options["restart"] else reconcile.load_checkpoint()
+        if checkpoint:
+            if checkpoint.get("statuses") != statuses:
+                raise CommandError(f"An interrupted run for {checkpoint.get('statuses')} is checkpointed, use --restart to drop it")
+            after = int(checkpoint["after"])
+            retry = [int(student_id) for student_id in checkpoint.get("failed", "").split(",") if student_id]
+            # the failed ones are asked again, their errors count again if they still fail
+            counts.update({key: int(checkpoint.get(key, 0)) for key in COUNTERS if key != reconcile.ERRORS})
+            self.stdout.write(f"Resuming after student {after}, {len(retry)} failed students first")
+
+        students = (
+            Student.objects.exclude(payment_status='SUCCESS')  # student_unpaid_order_idx
+            .filter(
+                razorpay_order_id__isnull=False,
+                payment_status__in=statuses.split(","),
+                updated_at__lt=timezone.now() - timedelta(seconds=options["min_age"]),
+            )
+            .order_by('id')
+        )
+        self.stdout.write(f"{'Dry run against' if self.dry_run else 'Reconciling with'} {type(gateway).__name__}")
+        failed_orders, failed_students = [], []
+        start = time.monotonic()
+        pacer = reconcile.Pacer(options["rate"])
+        batch = options["batch"]
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            while True:
+                if retry:
+                    page = list(students.filter(id__in=retry[:batch]).values_list(*PAGE_FIELDS))
+                    retry = retry[batch:]
+                else:
+                    page = list(students.filter(id__gt=after).values_list(*PAGE_FIELDS)[:batch])
+                    if not page:
+                        break
+                    after = page[-1][0]
+                orders, skipped = self.reconcile_page(page, executor, pacer, counts)
+                failed_orders += orders
+                failed_students += skipped
+                if not self.dry_run:
+                    # failed students stay in the checkpoint, a resumed run asks about them again
+                    failed = ",".join(str(student_id) for student_id in failed_students + retry)
+                    reconcile.save_checkpoint({"after": after, "statuses": statuses, "failed": failed, **counts})
+                self.stdout.write(
+                    f"up to student {after}: {counts[reconcile.CHECKED]} checked, {counts[TO_SUCCESS] + counts[TO_FAILED]} "
+                    f"{'to move' if self.dry_run else 'moved'}, {counts[reconcile.ERRORS]} errors"
+                )
+
+        if not self.dry_run:
+            reconcile.clear_checkpoint()
+        self.report(counts, failed_orders, time.monotonic() - start)
+
+    def reconcile_page(self, page, executor, pacer, counts):
+        # orders handed out before the current one may have been paid too
+        earlier = {}
+        for student_id, order_id in (
+            PaymentOrder.objects.filter(student_id__in=[student_id for student_id, _, _ in page])
+            .exclude(order_id__in=[order_id for _, order_id, _ in page])
+            .values_list('student_id', 'order_id')
+        ):
+            earlier.setdefault(student_id, []).append(order_id)
+        order_ids = [order_id for _, order_id, _ in page] + [order_id for ids in earlier.values() for order_id in ids]
+        found, errors = reconcile.fetch_events(order_ids, executor, pacer)
+        unanswered = set(errors)
+
+        events, failed = [], []
+        for student_id, order_id, status in page:
+            # an order we know nothing about may be the paid one, leave the student for the retry
+            if order_id in unanswered or unanswered.intersection(earlier.get(student_id, [])):
+                failed.append(student_id)
+                continue
+            counts[reconcile.CHECKED] += 1
+            event = next(
+                (found[other] for other in earlier.get(student_id, []) if found.get(other) and found[other][0] == "payment.captured"),
+                found[order_id],
+            )
+            target = reconcile.target_status(status, event)
+            if target is None:
+                counts[UNCHANGED] += 1
+                continue
+            counts[TO_SUCCESS if target == 'SUCCESS' else TO_FAILED] += 1
+            events.append(event)
+            if self.verbosity > 1:
+                self.stdout.write(f"  student {student_id} ({order_id}): {status} -> {target}")
+        counts[reconcile.ERRORS] += len(errors)
+        if events and not self.dry_run:
+            counts[reconcile.EVENTS] += webhooks.apply_payment_events(events, replay=True)[0]
+        return errors, failed
+
+    def report(self, counts, failed_orders, elapsed):
+        verb = "would move" if self.dry_run else "moved"
+        self.stdout.write(self.style.SUCCESS(
+            f"{counts[reconcile.CHECKED]} orders checked in {elapsed:.1f}s: {verb} {counts[TO_SUCCESS]} to SUCCESS, "
+            f"{counts[TO_FAILED]} to FAILED, {counts[UNCHANGED]} unchanged"
+        ))
+        if not self.dry_run:
+            self.stdout.write(f"{counts[reconcile.EVENTS]} payment events recorded in the ledger")
+        if counts[reconcile.ERRORS]:
+            shown = ", ".join(failed_orders[:20]) + (" ..." if len(failed_orders) > 20 else "")
+            self.stdout.write(self.style.WARNING(
+                f"{counts[reconcile.ERRORS]} orders could not be fetched, run again to retry them: {shown}"
+            ))
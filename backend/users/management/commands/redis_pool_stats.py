@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from users.utils.redis_pool import get_redis, pool_stats
+
+
+class Command(BaseCommand):
+    help = "Show Redis pool settings, server connection usage and a sizing check for N workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes per instance")
+        parser.add_argument("--instances", type=int, default=1, help="app instances sharing the Redis server")
+        parser.add_argument("--extra", type=int, default=0, help="other clients (mail workers, consumers, ...)")
+
+    def handle(self, *args, **options):
+        client = get_redis()
+        client.ping()
+        clients = client.info("clients")
+        try:
+            maxclients = int(client.config_get("maxclients").get(b"maxclients", 0))
+        except Exception:
+            maxclients = 0  # managed Redis often disables CONFIG
+
+        local = pool_stats()
+        self.stdout.write("This process:")
+        for key, value in local.items():
+            self.stdout.write(f"  {key}: {value}")
+
+        self.stdout.write("Server:")
+        self.stdout.write(f"  connected_clients: {clients.get('connected_clients')}")
+        self.stdout.write(f"  blocked_clients: {clients.get('blocked_clients')}")
+        self.stdout.write(f"  maxclients: {maxclients or 'unknown'}")
+
+        worst_case = settings.REDIS_MAX_CONNECTIONS * options["workers"] * options["instances"] + options["extra"]
+        self.stdout.write(
+            f"Worst case: {settings.REDIS_MAX_CONNECTIONS} per worker x {options['workers']} workers"
+            f" x {options['instances']} instances + {options['extra']} = {worst_case} connections"
+        )
+        if maxclients and worst_case > maxclients:
+            self.stdout.write(self.style.WARNING(
+                f"Exceeds maxclients ({maxclients}), lower REDIS_MAX_CONNECTIONS to "
+                f"{max((maxclients - options['extra']) // (options['workers'] * options['instances']), 1)}"
+            ))
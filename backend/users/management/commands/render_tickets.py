@@ -0,0 +1,99 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from users.utils import ticket_render, tickets
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Render registration tickets (QR png and pdf pass) on a process pool, queued ones or every paid student"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Render the tickets of every paid student and exit, with progress")
+        parser.add_argument("--force", action="store_true", help="With --all, render again tickets that are already stored")
+        parser.add_argument("--processes", type=int, default=tickets.processes(), help="Render processes, one per core by default")
+        parser.add_argument("--batch", type=int, default=settings.RECONCILE_BATCH_SIZE, help="Students per batch")
+        parser.add_argument("--format", dest="formats", action="append", choices=ticket_render.FORMATS, help="Only this format, repeatable")
+        parser.add_argument("--interval", type=float, default=1, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--once", action="store_true", help="Drain the queue and exit")
+
+    def handle(self, *args, **options):
+        self.formats = tuple(options["formats"] or ticket_render.FORMATS)
+        with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+            self.executor = executor
+            if options["all"]:
+                self.render_all(options["batch"], options["force"])
+                return
+            self.stdout.write(f"Ticket worker started, {options['processes']} processes")
+            try:
+                while True:
+                    student_ids = tickets.pop(options["batch"])
+                    if student_ids:
+                        close_old_connections()
+                        self.process(student_ids)
+                    elif options["once"]:
+                        break
+                    else:
+                        time.sleep(options["interval"])
+            except KeyboardInterrupt:
+                pass
+
+    def process(self, student_ids):
+        try:
+            counts, fresh = tickets.render_many(tickets.paid_rows(student_ids), self.formats, self.executor)
+        except Exception as e:
+            # storage or database trouble: put them back, the next batch tries again
+            logger.warning(f"Tickets of {len(student_ids)} students failed, queued again: {str(e)}")
+            tickets.enqueue(student_ids)
+            time.sleep(1)
+            return
+        # mail once, when the tickets first exist; a replayed payment finds them cached
+        mailed = tickets.send_confirmations(fresh) if fresh else 0
+        logger.info(
+            f"Tickets: {counts[tickets.RENDERED]} rendered, {counts[tickets.CACHED]} cached, "
+            f"{counts[tickets.FAILED]} failed, {mailed} confirmation mails queued"
+        )
+
+    def render_all(self, batch_size, force):
+        rows = tickets.paid_rows()
+        self.total = rows.count() * len(self.formats)
+        self.totals = {tickets.RENDERED: 0, tickets.CACHED: 0, tickets.FAILED: 0}
+        self.start = time.monotonic()
+        self.reported = 0
+        self.step = max(batch_size, self.total // 100)
+
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                self.render_batch(batch, force)
+                batch = []
+        if batch:
+            self.render_batch(batch, force)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{self.totals[tickets.RENDERED]} rendered, {self.totals[tickets.CACHED]} already stored, "
+            f"{self.totals[tickets.FAILED]} failed in {time.monotonic() - self.start:.1f}s"
+        ))
+
+    def render_batch(self, batch, force):
+        offset = sum(self.totals.values())
+        counts, _ = tickets.render_many(
+            batch, self.formats, self.executor, force=force,
+            progress=lambda done, _: self.progress(offset + done),
+        )
+        for key, value in counts.items():
+            self.totals[key] += value
+
+    def progress(self, done):
+        if done - self.reported < self.step and done < self.total:
+            return
+        self.reported = done
+        elapsed = time.monotonic() - self.start
+        rate = done / elapsed if elapsed else 0
+        eta = (self.total - done) / rate if rate else 0
+        self.stdout.write(f"{done}/{self.total} tickets ({done * 100 // max(self.total, 1)}%), {rate:.0f}/s, {eta:.0f}s left")
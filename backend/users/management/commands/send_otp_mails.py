@@ -0,0 +1,109 @@
+import json
+import logging
+import socket
+import time
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from users.utils import mail_queue
+from users.utils.otp_manager import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Worker that delivers queued OTP emails over a reused SMTP connection"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", default=f"{socket.gethostname()}", help="Worker name, keeps its in-flight job list stable across restarts")
+        parser.add_argument("--max-retries", type=int, default=settings.OTP_MAIL_MAX_RETRIES)
+        parser.add_argument("--backoff", type=float, default=settings.OTP_MAIL_RETRY_BACKOFF, help="Base retry delay in seconds, doubled on every attempt")
+        parser.add_argument("--idle-timeout", type=float, default=settings.OTP_MAIL_SMTP_IDLE_TIMEOUT, help="Close the SMTP connection after this many idle seconds")
+        parser.add_argument("--once", action="store_true", help="Drain the queue and exit")
+
+    def handle(self, *args, **options):
+        self.max_retries = options["max_retries"]
+        self.backoff = options["backoff"]
+        self.idle_timeout = options["idle_timeout"]
+        self.processing_key = mail_queue.processing_key(options["name"])
+        self.connection = None
+        self.last_used = 0
+
+        self.recover()
+        self.stdout.write(f"OTP mail worker {options['name']} started")
+        try:
+            while True:
+                self.promote_due_retries()
+                raw = redis_client.blmove(mail_queue.QUEUE_KEY, self.processing_key, 1, "RIGHT", "LEFT")
+                if raw is None:
+                    self.close_if_idle()
+                    if options["once"] and not redis_client.zcard(mail_queue.RETRY_KEY):
+                        break
+                    continue
+                self.process(raw)
+                redis_client.lrem(self.processing_key, 1, raw)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def recover(self):
+        """Requeue jobs this worker had in flight when it last stopped"""
+        while redis_client.lmove(self.processing_key, mail_queue.QUEUE_KEY, "RIGHT", "RIGHT"):
+            pass
+
+    def promote_due_retries(self):
+        due = redis_client.zrangebyscore(mail_queue.RETRY_KEY, 0, time.time())
+        for raw in due:
+            # zrem wins only for one worker, so a job is never requeued twice
+            if redis_client.zrem(mail_queue.RETRY_KEY, raw):
+                redis_client.lpush(mail_queue.QUEUE_KEY, raw)
+
+    def process(self, raw):
+        job = json.loads(raw)
+        if not mail_queue.is_current(job):
+            return  # a newer OTP was requested, this one is useless
+        if time.time() > job["expires_at"]:
+            mail_queue.set_status(job, mail_queue.EXPIRED)
+            return
+
+        job["attempts"] += 1
+        try:
+            self.send(job)
+        except Exception as e:
+            self.close()  # broken connection, reopen on next send
+            logger.warning(f"{job.get('kind', mail_queue.OTP).capitalize()} mail to {job['email']} failed (attempt {job['attempts']}): {e}")
+            if job["attempts"] > self.max_retries:
+                mail_queue.set_status(job, mail_queue.FAILED, str(e))
+                return
+            delay = self.backoff * 2 ** (job["attempts"] - 1)
+            mail_queue.set_status(job, mail_queue.RETRYING, str(e))
+            redis_client.zadd(mail_queue.RETRY_KEY, {json.dumps(job): time.time() + delay})
+            return
+
+        mail_queue.set_status(job, mail_queue.SENT)
+
+    def send(self, job):
+        if self.connection is None:
+            self.connection = get_connection(fail_silently=False)
+            self.connection.open()
+        EmailMessage(
+            subject=job["subject"],
+            body=job["message"],
+            from_email=settings.EMAIL_HOST_USER,
+            to=[job["email"]],
+            connection=self.connection,
+        ).send(fail_silently=False)
+        self.last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self.connection is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.close()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
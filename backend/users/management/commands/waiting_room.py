@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from users.utils import waiting_room
+
+
+class Command(BaseCommand):
+    help = "Show the waiting room's queue, or reset it before registration opens"
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["show", "reset"])
+
+    def handle(self, *args, **options):
+        if options["action"] == "reset":
+            waiting_room.reset()
+            self.stdout.write("Waiting room emptied, tickets issued so far no longer work")
+            return
+
+        state = {key.decode(): value.decode() for key, value in waiting_room.redis_client.hgetall(waiting_room.ROOM_KEY).items()}
+        issued = int(state.get("issued", 0))
+        admitted = min(int(float(state.get("admitted", 0))), issued)
+        self.stdout.write(f"enabled: {settings.WAITING_ROOM_ENABLED}")
+        self.stdout.write(f"rate: {settings.WAITING_ROOM_RATE}/s, burst {settings.WAITING_ROOM_BURST}")
+        self.stdout.write(f"tickets issued: {issued}")
+        self.stdout.write(f"admitted: {admitted} (as of the last join or status call)")
+        self.stdout.write(f"waiting: {issued - admitted}")
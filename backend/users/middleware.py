@@ -0,0 +1,69 @@
+import logging
+import time
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.deprecation import MiddlewareMixin
+from .utils import db_pool, metrics, timing
+
+logger = logging.getLogger(__name__)
+
+
+def _endpoint(request):
+    # the URL name, not the path: /payment-status/<id>/ is one series, not one per student
+    match = request.resolver_match
+    return (match.url_name or match.view_name) if match else "unmatched"
+
+
+def _finish(request, response, token, start):
+    total = time.perf_counter() - start
+    breakdown = timing.finish(token)
+    endpoint = _endpoint(request)
+    metrics.request_seconds.observe(total, endpoint=endpoint, method=request.method, status=f"{response.status_code // 100}xx")
+    for name, (seconds, _calls) in breakdown.items():
+        metrics.span_seconds.observe(seconds, endpoint=endpoint, span=name)
+    if settings.SERVER_TIMING:
+        response["Server-Timing"] = timing.server_timing(breakdown, total)
+    metrics.maybe_flush()
+    return response
+
+
+@sync_and_async_middleware
+def timing_middleware(get_response):
+    """Time every request and break it down by dependency, see users.utils.timing
+
+    Adds a Server-Timing header (settings.SERVER_TIMING) and feeds the
+    http_request_seconds and http_request_span_seconds histograms. For a
+    streamed response the time covers building the response only, its body
+    is produced after the middleware has returned.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = timing.start()
+            start = time.perf_counter()
+            response = await get_response(request)
+            return _finish(request, response, token, start)
+    else:
+        def middleware(request):
+            token = timing.start()
+            start = time.perf_counter()
+            response = get_response(request)
+            return _finish(request, response, token, start)
+    return middleware
+
+
+class DatabaseBusyMiddleware(MiddlewareMixin):
+    """503 with Retry-After instead of a 500 when no database connection was free
+
+    The pool's wait ran out (DATABASE_POOL_TIMEOUT) or Postgres / pgbouncer
+    refused one more connection, see users.utils.db_pool.is_exhausted.
+    """
+
+    def process_exception(self, request, exception):
+        if not db_pool.is_exhausted(exception):
+            return None
+        logger.warning(f"No database connection for {request.path}: {str(exception)}")
+        response = JsonResponse({"detail": "Server busy, try again shortly"}, status=503)
+        response["Retry-After"] = str(db_pool.RETRY_AFTER)
+        return response
@@ -0,0 +1,27 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('event', models.CharField(max_length=50)),
+                ('payment_id', models.CharField(max_length=100)),
+                ('order_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('payment_id', 'event'), name='unique_webhook_event')],
+            },
+        ),
+    ]
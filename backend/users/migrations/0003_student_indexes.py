@@ -0,0 +1,33 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='student',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(condition=models.Q(('razorpay_order_id__isnull', False)), fields=['razorpay_order_id'], name='student_order_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['-created_at'], name='student_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['payment_status', '-created_at'], name='student_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(condition=models.Q(('payment_status', 'PENDING'), ('razorpay_order_id__isnull', False)), fields=['id'], name='student_pending_order_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:20
+
+import users.utils.verification
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_student_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='student',
+            name='email',
+            field=models.EmailField(max_length=254, unique=True, validators=[users.utils.verification.validate_college_email]),
+        ),
+        migrations.AlterField(
+            model_name='student',
+            name='student_number',
+            field=models.CharField(max_length=20, unique=True, validators=[users.utils.verification.validate_student_number]),
+        ),
+    ]
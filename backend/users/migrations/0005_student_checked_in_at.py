@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_identity_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='checked_in_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_student_checked_in_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['updated_at'], name='student_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_student_updated_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='student',
+            name='student_created_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='student',
+            name='student_status_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['-created_at', '-id'], name='student_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['payment_status', '-created_at', '-id'], name='student_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['branch', '-created_at', '-id'], name='student_branch_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['is_present', '-created_at', '-id'], name='student_present_created_idx'),
+        ),
+    ]
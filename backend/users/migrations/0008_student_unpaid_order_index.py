@@ -0,0 +1,21 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_student_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='student',
+            name='student_pending_order_idx',
+        ),
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(condition=models.Q(models.Q(('payment_status', 'SUCCESS'), _negated=True), ('razorpay_order_id__isnull', False)), fields=['id'], name='student_unpaid_order_idx'),
+        ),
+    ]
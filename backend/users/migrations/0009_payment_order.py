@@ -0,0 +1,29 @@
+# Generated by Django 6.0.2 on 2026-10-18 20:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_student_unpaid_order_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.CharField(max_length=100, unique=True)),
+                ('amount', models.PositiveIntegerField()),
+                ('currency', models.CharField(default='INR', max_length=3)),
+                ('receipt', models.CharField(blank=True, max_length=40)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_orders', to='users.student')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['student', '-created_at'], name='order_student_created_idx')],
+            },
+        ),
+    ]
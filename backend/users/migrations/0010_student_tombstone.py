@@ -0,0 +1,21 @@
+# Generated by Django 6.0.2 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_payment_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_id', models.BigIntegerField(unique=True)),
+                ('deleted_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.db import models
 from django.core.validators import RegexValidator
+from django.core.exceptions import ValidationError
+from .utils.verification import identity_error, validate_college_email, validate_student_number
 
 
 class Student(models.Model):
@@ -27,29 +29,21 @@ class Student(models.Model):
         ('MALE', 'Male'),
         ('FEMALE', 'Female'),
     ]
-    email_regex = RegexValidator(
-        regex=r'^[a-zA-Z]+25\d+@akgec\.ac\.in$',
-        message="Email must end with @akgec.ac.in"
-    )
-    
     phone_regex = RegexValidator(
         regex=r'^\d{10,12}$',
         message="Phone number must be 10 to 12 digits"
     )
-    student_number_regex = RegexValidator(
-        regex=r'^25\d{4,6}$',
-        message="Student number must start with 25 and be 6 to 8 digits long"
-    )
     name = models.CharField(max_length=100)
-    email = models.EmailField(unique=True, validators=[email_regex],null=False, blank=False)
+    email = models.EmailField(unique=True, validators=[validate_college_email],null=False, blank=False)
     phone = models.CharField(validators=[phone_regex], max_length=12)
-    student_number = models.CharField(max_length=20, unique=True, validators=[student_number_regex] )
+    student_number = models.CharField(max_length=20, unique=True, validators=[validate_student_number] )
     branch = models.CharField(max_length=20, choices=BRANCH_CHOICES)
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES)
     hostler = models.BooleanField(default=False)
     is_email_verified = models.BooleanField(default=False)
     payment_status = models.CharField(max_length=10, choices=PAYMENT_STATUS_CHOICES, default='PENDING')
     is_present = models.BooleanField(default=False)
+    checked_in_at = models.DateTimeField(blank=True, null=True)  # set with is_present by users.utils.checkin
     razorpay_order_id = models.CharField(max_length=100, blank=True, null=True)
     razorpay_payment_id = models.CharField(max_length=100, blank=True, null=True)
     razorpay_signature = models.CharField(max_length=255, blank=True, null=True)
@@ -58,5 +52,81 @@ class Student(models.Model):
     
     def __str__(self):
         return f"{self.name} - {self.student_number}"
+
+    def clean(self):
+        error = identity_error(self.email, self.name, self.student_number)
+        if error:
+            raise ValidationError({'email': error})
+
+    class Meta:
+        # no default ordering: it added ORDER BY created_at to every .first()
+        # on the hot lookups, the admin orders explicitly
+        indexes = [
+            # webhook / reconciliation lookup, rows without an order are left out
+            models.Index(fields=['razorpay_order_id'], condition=models.Q(razorpay_order_id__isnull=False), name='student_order_id_idx'),
+            # admin list and reports: newest first, optionally by a list filter;
+            # id breaks created_at ties for the admin's keyset pagination
+            models.Index(fields=['-created_at', '-id'], name='student_created_idx'),
+            models.Index(fields=['payment_status', '-created_at', '-id'], name='student_status_created_idx'),
+            models.Index(fields=['branch', '-created_at', '-id'], name='student_branch_created_idx'),
+            models.Index(fields=['is_present', '-created_at', '-id'], name='student_present_created_idx'),
+            # unpaid orders, paged by id when reconciling with Razorpay; a small slice of the table
+            models.Index(fields=['id'], condition=~models.Q(payment_status='SUCCESS') & models.Q(razorpay_order_id__isnull=False), name='student_unpaid_order_idx'),
+            # gate device sync: MAX(updated_at) for the ETag, rows changed since a cursor
+            models.Index(fields=['updated_at'], name='student_updated_idx'),
+        ]
+
+
+class StudentTombstone(models.Model):
+    """A deleted student, so gate device sync can list it under "removed"
+
+    Written by users.utils.checkin when a Student row is deleted.
+    """
+    student_id = models.BigIntegerField(unique=True)
+    deleted_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.student_id} deleted {self.deleted_at}"
+
+
+class WebhookEvent(models.Model):
+    """Ledger of received Razorpay webhook deliveries, one row per (event, payment)
+
+    Razorpay re-sends webhooks until it gets a 2xx, the unique constraint turns
+    a re-delivery into a failed insert instead of a second update.
+    """
+    event_id = models.CharField(max_length=100, blank=True, null=True)  # X-Razorpay-Event-Id
+    event = models.CharField(max_length=50)
+    payment_id = models.CharField(max_length=100)
+    order_id = models.CharField(max_length=100, blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.event} - {self.payment_id}"
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['payment_id', 'event'], name='unique_webhook_event'),
+        ]
+
+
+class PaymentOrder(models.Model):
+    """Every Razorpay order created for a student
+
+    Student.razorpay_order_id is only the latest one; a webhook for an
+    earlier order (a second tab, a retry) finds its student here.
+    """
+    order_id = models.CharField(max_length=100, unique=True)
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='payment_orders')
+    amount = models.PositiveIntegerField()  # paise
+    currency = models.CharField(max_length=3, default='INR')
+    receipt = models.CharField(max_length=40, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.order_id} - {self.student_id}"
+
     class Meta:
-        ordering = ['-created_at']
\ No newline at end of file
+        indexes = [
+            # a student's orders, newest first, for reconciliation
+            models.Index(fields=['student', '-created_at'], name='order_student_created_idx'),
+        ]
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import  Student
+from .utils.verification import identity_error, validate_college_email, validate_student_number
 
 # class StudentPaymentSerializer(serializers.ModelSerializer):
 
@@ -63,8 +64,9 @@ class StudentSerializer(serializers.ModelSerializer):
             'email',
             'phone',
             'student_number',
-            'year',
             'branch',
+            'gender',
+            'hostler',
             'is_email_verified',
             'payment_status',
             'is_present',
@@ -85,8 +87,21 @@ class StudentSerializer(serializers.ModelSerializer):
             'created_at',
             'updated_at'
         ]
-    def validate_email(self, value):
-        if Student.objects.filter(email=value).exists():
-            raise serializers.ValidationError("Email already registered")
-        return value
+        # format only, no UniqueValidator: each one is a SELECT per request.
+        # The unique constraints reject duplicates on write, see save_student
+        extra_kwargs = {
+            'email': {'validators': [validate_college_email]},
+            'student_number': {'validators': [validate_student_number]},
+        }
+
+    def validate(self, attrs):
+        # same identity rule as Student.clean, on the values the save would leave
+        values = [
+            attrs[field] if field in attrs else getattr(self.instance, field, None)
+            for field in ('email', 'name', 'student_number')
+        ]
+        error = identity_error(*values)
+        if error:
+            raise serializers.ValidationError({'email': error})
+        return attrs
     
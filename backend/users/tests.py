@@ -1,3 +1,1760 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import csv
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import weakref
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import sync_to_async
+import fakeredis
+import httpx
+import redis
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.core.exceptions import ValidationError
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from . import async_views
+from .admin import StudentAdmin
+from .management.commands import consume_webhooks, send_otp_mails
+from .middleware import DatabaseBusyMiddleware
+from .models import PaymentOrder, Student, WebhookEvent
+from .utils import (
+    checkin, checks, db_pool, mail_queue, metrics, orders, otp_manager, payment_gateway, payment_status, rate_limit,
+    recaptcha, reconcile, redis_pool, ticket_render, tickets, timing, verification, waiting_room, webhook_stream,
+    webhooks,
+)
+from .utils.circuit_breaker import CircuitBreaker
+from .utils.standins import CapturingSMTPServer, SiteverifyStub
+from .serializers import StudentSerializer
+
+# Query budget and plan audit of the Student lookup paths. The budgets are
+# the point: a new .first(), a lazy relation or a dropped index shows up here
+# before it shows up in production latency.
+
+TEST_SETTINGS = dict(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    PAYMENT_GATEWAY="users.utils.payment_gateway.FakeGateway",
+    FAKE_GATEWAY_LATENCY=0,
+)
+
+
+def make_student(n=1, **fields):
+    defaults = dict(
+        name=f"Student {n}",
+        email=f"student25{n:04d}@akgec.ac.in",
+        student_number=f"25{n:04d}",
+        phone=f"98{n:08d}",
+        branch="CSE",
+        gender="MALE",
+        is_email_verified=True,
+    )
+    defaults.update(fields)
+    return Student.objects.create(**defaults)
+
+
+def mock_redis_gate(test, result=(rate_limit.ALLOWED, 0)):
+    """The rate limit / blocklist / cooldown script answers `result` without Redis"""
+    patcher = mock.patch.object(rate_limit, "gate_script", return_value=list(result))
+    gate = patcher.start()
+    test.addCleanup(patcher.stop)
+    return gate
+
+
+def fake_redis(test, *modules):
+    """An empty fakeredis (Lua on lupa, see requirements-dev.txt) as the redis_client of these modules
+
+    Async code reaches the same server through get_async_redis.
+    """
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+
+    def get_async_redis():
+        return fakeredis.FakeAsyncRedis(server=server)
+
+    patchers = [mock.patch.object(redis_pool, "get_async_redis", get_async_redis)]
+    for module in modules:
+        patchers.append(mock.patch.object(module, "redis_client", client))
+        if hasattr(module, "get_async_redis"):
+            patchers.append(mock.patch.object(module, "get_async_redis", get_async_redis))
+    for patcher in patchers:
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return client
+
+
+def statements(ctx):
+    """Captured SQL without the savepoint bookkeeping of atomic()"""
+    return [
+        q["sql"] for q in ctx.captured_queries
+        if not q["sql"].upper().startswith(("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT"))
+    ]
+
+
+@override_settings(**TEST_SETTINGS)
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.addCleanup(payment_gateway.reset_gateway)
+        # payment status cache always misses, no Redis needed
+        patcher = mock.patch.object(payment_status, "redis_client")
+        self.redis = patcher.start()
+        self.redis.get.return_value = None
+        self.addCleanup(patcher.stop)
+        # order cache always misses, the lock is always free
+        patcher = mock.patch.object(orders, "redis_client")
+        patcher.start().get.return_value = None
+        self.addCleanup(patcher.stop)
+        self.gate = mock_redis_gate(self)
+
+    def assertStatements(self, ctx, expected):
+        sql = statements(ctx)
+        self.assertEqual(len(sql), expected, "\n".join(sql))
+        for query in sql:
+            # Student has no default ordering, a unique lookup must not sort by it
+            self.assertNotIn('ORDER BY "users_student"."created_at"', query, query)
+
+    def test_payment_status_is_one_select(self):
+        student = make_student()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f"/api/users/payment-status/{student.id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertStatements(ctx, 1)
+
+    def test_cached_payment_status_skips_the_database(self):
+        self.redis.get.return_value = b"SUCCESS"
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/api/users/payment-status/7/")
+        self.assertEqual(response.json(), {"id": 7, "payment_status": "SUCCESS"})
+        self.assertStatements(ctx, 0)
+
+    def test_verify_otp_for_verified_student_is_one_select(self):
+        student = make_student()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post("/api/users/verify-otp/", {"email": student.email, "otp": "123456"})
+        self.assertEqual(response.status_code, 200)
+        self.assertStatements(ctx, 1)
+
+    def registration(self, n=1, **fields):
+        data = {
+            "name": "Aman Kumar",
+            "email": f"Aman25{n:04d}@akgec.ac.in",
+            "student_no": f"25{n:04d}",
+            "student_number": f"25{n:04d}",
+            "phone": f"98{n:08d}",
+            "branch": "CSE",
+            "gender": "MALE",
+            "otp": "123456",
+        }
+        data.update(fields)
+        return data
+
+    def verify_otp(self, data):
+        with mock.patch("users.views.OTPManager.verify_otp", return_value=(True, "OTP verified")), \
+                CaptureQueriesContext(connection) as ctx:
+            response = self.client.post("/api/users/verify-otp/", data)
+        return response, ctx
+
+    def test_verify_otp_new_student_is_select_and_insert(self):
+        response, ctx = self.verify_otp(self.registration())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertStatements(ctx, 2)
+        self.assertTrue(Student.objects.get(id=response.json()["id"]).is_email_verified)
+
+    def test_verify_otp_unverified_student_is_select_and_update(self):
+        data = self.registration()
+        student = make_student(email=data["email"], student_number=data["student_number"], is_email_verified=False)
+        response, ctx = self.verify_otp(data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertStatements(ctx, 2)
+        student.refresh_from_db()
+        self.assertTrue(student.is_email_verified)
+        self.assertEqual(student.name, "Aman Kumar")
+
+    def test_verify_otp_duplicate_student_number_is_400(self):
+        make_student(2, student_number="250001")
+        response, ctx = self.verify_otp(self.registration())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"detail": "Email or student number already registered"})
+        self.assertStatements(ctx, 2)
+
+    def initiate(self, student):
+        with mock.patch("users.utils.checks.verify_recaptcha", return_value=True), \
+                CaptureQueriesContext(connection) as ctx:
+            response = self.client.post("/api/users/payment-initiation/", {"student_id": student.id, "recaptcha_token": "t"})
+        self.assertEqual(response.status_code, 200)
+        return response.json(), ctx
+
+    def test_payment_initiation_is_select_insert_and_update(self):
+        student = make_student()
+        order, ctx = self.initiate(student)
+        # student, order history row, student's current order
+        self.assertStatements(ctx, 3)
+        student.refresh_from_db()
+        self.assertEqual(student.razorpay_order_id, order["id"])
+
+        # order cache expired: the open order comes back from the history table
+        again, ctx = self.initiate(student)
+        self.assertEqual(again["id"], order["id"])
+        self.assertStatements(ctx, 2)
+        self.assertEqual(len(payment_gateway.get_gateway().orders), 1)
+
+    def test_webhook_apply_is_insert_update_and_paid_id(self):
+        student = make_student(razorpay_order_id="order_1")
+        with mock.patch.object(payment_status, "publish_order") as publish, \
+                mock.patch.object(tickets, "enqueue") as enqueue, \
+                self.captureOnCommitCallbacks(execute=True), \
+                CaptureQueriesContext(connection) as ctx:
+            result = webhooks.apply_payment_event("payment.captured", "order_1", "pay_1")
+        self.assertEqual(result, webhooks.APPLIED)
+        self.assertStatements(ctx, 3)  # INSERT, UPDATE, SELECT of the id to render the ticket of
+        publish.assert_called_once_with("order_1", "SUCCESS")
+        enqueue.assert_called_once_with([student.pk])
+
+    def test_webhook_batch_is_constant_in_batch_size(self):
+        for n in range(20):
+            make_student(n, razorpay_order_id=f"order_{n}")
+        events = [("payment.captured", f"order_{n}", f"pay_{n}", None) for n in range(20)]
+        with mock.patch.object(payment_status, "publish") as publish, \
+                self.captureOnCommitCallbacks(execute=True), \
+                CaptureQueriesContext(connection) as ctx:
+            applied, unmatched = webhooks.apply_payment_events(events)
+        self.assertEqual((applied, unmatched), (20, set()))
+        # ledger SELECT, holders of the orders, bulk INSERT, one UPDATE for SUCCESS, statuses for the cache
+        self.assertEqual(len(statements(ctx)), 5, "\n".join(statements(ctx)))
+        self.assertEqual(Student.objects.filter(payment_status="SUCCESS").count(), 20)
+        statuses, _ = publish.call_args.args
+        self.assertEqual(set(statuses.values()), {"SUCCESS"})
+        self.assertEqual(len(statuses), 20)
+
+
+class QueryPlanTests(TestCase):
+    """The hot lookups must be answered from an index, not a table scan"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(50):
+            make_student(n, razorpay_order_id=f"order_{n}" if n % 2 else None)
+        # planner statistics, as production has them
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # small test tables make a seq scan the cheapest plan, ask for the index path
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+
+    def assertIndexed(self, queryset, index=None):
+        plan = queryset.explain()
+        if connection.vendor == "postgresql":
+            self.assertNotIn("Seq Scan", plan, plan)
+            self.assertIn("Index", plan, plan)
+        elif connection.vendor == "sqlite":
+            self.assertNotRegex(plan, r"SCAN users_student\b(?! USING)", plan)
+            self.assertRegex(plan, r"USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY", plan)
+        else:
+            self.skipTest(f"no plan check for {connection.vendor}")
+        if index:
+            self.assertIn(index, plan)
+
+    def test_lookup_by_email(self):
+        self.assertIndexed(Student.objects.filter(email="student250001@akgec.ac.in"))
+
+    def test_lookup_by_id(self):
+        self.assertIndexed(Student.objects.filter(id=1).only("id", "payment_status"))
+
+    def test_webhook_lookup_by_order_id(self):
+        self.assertIndexed(
+            Student.objects.filter(razorpay_order_id="order_1", payment_status__in=["PENDING", "FAILED"]),
+            "student_order_id_idx",
+        )
+
+    def test_unpaid_orders_keyset_page(self):
+        self.assertIndexed(
+            Student.objects.exclude(payment_status="SUCCESS").filter(razorpay_order_id__isnull=False, id__gt=10)
+            .order_by("id")[:20],
+            "student_unpaid_order_idx",
+        )
+
+    def test_admin_list_by_status(self):
+        self.assertIndexed(
+            Student.objects.filter(payment_status="SUCCESS").order_by("-created_at")[:100],
+            "student_status_created_idx",
+        )
+
+    def test_admin_keyset_page_by_branch(self):
+        now = timezone.now()
+        self.assertIndexed(
+            Student.objects.filter(branch="CSE", created_at__lte=now).exclude(created_at=now, pk__gte=10)
+            .order_by("-created_at", "-id")[:51],
+            "student_branch_created_idx",
+        )
+
+
+# (email, name, student number, error or None) - None means accepted
+IDENTITY_CORPUS = [
+    ("aman250001@akgec.ac.in", "Aman Kumar", "250001", None),
+    ("Aman250001@akgec.ac.in", "aman kumar", "250001", None),
+    ("AMAN25012345@AKGEC.AC.IN", "Aman", "25012345", None),
+    ("riya2512345@akgec.ac.in", "  Riya   Singh ", "2512345", None),
+    ("aman240001@akgec.ac.in", "Aman Kumar", "240001", "Use your college email"),
+    ("aman25001@akgec.ac.in", "Aman Kumar", "25001", "Use your college email"),
+    ("aman250123456@akgec.ac.in", "Aman Kumar", "250123456", "Use your college email"),
+    ("aman250001@gmail.com", "Aman Kumar", "250001", "Use your college email"),
+    ("aman250001@akgec.ac.in.evil.com", "Aman Kumar", "250001", "Use your college email"),
+    ("aman.k250001@akgec.ac.in", "Aman Kumar", "250001", "Use your college email"),
+    ("250001@akgec.ac.in", "Aman Kumar", "250001", "Use your college email"),
+    ("aman250001@akgecXac.in", "Aman Kumar", "250001", "Use your college email"),
+    ("aman250001@akgec.ac.in\n", "Aman Kumar", "250001", "Use your college email"),
+    ("amaan250001@akgec.ac.in", "Aman Kumar", "250001", "Email must start with your first name"),
+    ("aman250001@akgec.ac.in", "Kumar Aman", "250001", "Email must start with your first name"),
+    ("aman250001@akgec.ac.in", "", "250001", "Email must start with your first name"),
+    ("aman250001@akgec.ac.in", None, "250001", "Email must start with your first name"),
+    ("aman250001@akgec.ac.in", "Aman Kumar", "250002", "Student number does not match the email"),
+    ("aman250001@akgec.ac.in", "Aman Kumar", "", "Student number does not match the email"),
+    ("", "Aman Kumar", "250001", "Use your college email"),
+    (None, "Aman Kumar", "250001", "Use your college email"),
+]
+
+
+@override_settings(**TEST_SETTINGS)
+class IdentityValidationTests(SimpleTestCase):
+    def test_corpus(self):
+        for email, name, number, expected in IDENTITY_CORPUS:
+            with self.subTest(email=email, name=name, number=number):
+                error = verification.identity_error(email, name, number)
+                if expected is None:
+                    self.assertIsNone(error)
+                else:
+                    self.assertTrue(error and error.startswith(expected), error)
+
+    def test_model_and_serializer_agree_with_the_view(self):
+        for email, name, number, expected in IDENTITY_CORPUS:
+            if not isinstance(email, str) or name is None:
+                continue
+            with self.subTest(email=email, name=name, number=number):
+                student = Student(email=email, name=name, student_number=number)
+                try:
+                    student.clean()
+                    student.clean_fields(exclude=["phone", "branch", "gender"])
+                    model_ok = True
+                except ValidationError:
+                    model_ok = False
+                serializer = StudentSerializer(data={
+                    "email": email, "name": name, "student_number": number,
+                    "phone": "9800000001", "branch": "CSE", "gender": "MALE",
+                })
+                self.assertEqual(model_ok, expected is None)
+                if email == email.strip():  # DRF trims whitespace before validating
+                    self.assertEqual(serializer.is_valid(), expected is None, serializer.errors)
+
+    def test_student_number(self):
+        for number, ok in [("250001", True), ("25012345", True), ("25001", False), ("250123456", False),
+                           ("240001", False), ("25a001", False), ("２５0001", False), (250001, False)]:
+            with self.subTest(number=number):
+                self.assertEqual(verification.student_number_error(number) is None, ok)
+
+    @override_settings(STUDENT_BATCH_YEARS=["24", "25"])
+    def test_batch_years_from_settings(self):
+        self.assertEqual(verification.parse_email("aman240001@akgec.ac.in"),
+                         verification.Identity("aman", "240001", "24"))
+        self.assertIsNone(verification.student_number_error("240001"))
+        self.assertIsNone(verification.parse_email("aman230001@akgec.ac.in"))
+
+    def test_send_otp_rejects_before_redis(self):
+        with mock.patch("users.views.OTPManager.send_otp") as send_otp:
+            response = self.client.post("/api/users/send-otp/", {"email": "someone@gmail.com"})
+        self.assertEqual(response.status_code, 400)
+        send_otp.assert_not_called()
+
+
+@override_settings(**TEST_SETTINGS)
+class CheckPipelineTests(TestCase):
+    def setUp(self):
+        self.gate = mock_redis_gate(self)
+
+    def rejections(self, endpoint, stage):
+        return sum(
+            value for (e, s, _), value in metrics.validation_rejections.values.items()
+            if e == endpoint and s == stage
+        )
+
+    def test_checks_run_cheapest_stage_first(self):
+        stages = [check.stage for check in checks.Pipeline("x", [
+            checks.recaptcha(), checks.payable_student(), checks.redis_gate(), checks.college_email(), checks.required("a"),
+        ]).checks]
+        self.assertEqual(stages, sorted(stages))
+
+    def test_unknown_student_never_reaches_recaptcha(self):
+        before = self.rejections("payment-initiation", "database")
+        with mock.patch("users.utils.checks.verify_recaptcha") as verify:
+            response = self.client.post("/api/users/payment-initiation/", {"student_id": 999, "recaptcha_token": "t"})
+        self.assertEqual(response.status_code, 404)
+        verify.assert_not_called()
+        self.assertEqual(self.rejections("payment-initiation", "database"), before + 1)
+
+    def test_malformed_request_never_reaches_redis_or_database(self):
+        for student_id in ("1; drop", "²", "١٢"):
+            with self.subTest(student_id=student_id), self.assertNumQueries(0):
+                response = self.client.post("/api/users/payment-initiation/", {"student_id": student_id, "recaptcha_token": "t"})
+                self.assertEqual(response.status_code, 400)
+        self.gate.assert_not_called()
+
+    def test_cooldown_rejects_before_otp_manager(self):
+        self.gate.return_value = [rate_limit.COOLDOWN, 119200]
+        with mock.patch("users.views.OTPManager.send_otp") as send_otp:
+            response = self.client.post("/api/users/send-otp/", {"email": "aman250001@akgec.ac.in"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json(), {"success": False, "message": "Wait 120 seconds before requesting again"})
+        send_otp.assert_not_called()
+
+    def test_blocklisted_ip(self):
+        self.gate.return_value = [rate_limit.BLOCKED, 0]
+        with mock.patch("users.views.OTPManager.verify_otp") as verify_otp:
+            response = self.client.post("/api/users/verify-otp/", {"email": "aman250001@akgec.ac.in", "otp": "123456"})
+        self.assertEqual(response.status_code, 403)
+        verify_otp.assert_not_called()
+
+    def test_redis_down_fails_open(self):
+        self.gate.side_effect = ConnectionError("down")
+        with mock.patch("users.views.OTPManager.send_otp", return_value=(True, "OTP sent successfully")):
+            response = self.client.post("/api/users/send-otp/", {"email": "aman250001@akgec.ac.in"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rate_limited_answers_retry_after(self):
+        self.gate.return_value = [rate_limit.LIMITED, 4500]
+        response = self.client.post("/api/users/verify-otp/", {"email": "Aman250001@akgec.ac.in", "otp": "123456"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "5")
+        keys = self.gate.call_args.kwargs["keys"]
+        self.assertIn("RateLimit:verify-otp:ip:127.0.0.1", keys)
+        self.assertIn("RateLimit:verify-otp:email:aman250001@akgec.ac.in", keys)
+
+
+@override_settings(TRUSTED_PROXIES=["10.0.0.0/8"])
+class ClientIPTests(SimpleTestCase):
+    def test_client_ip(self):
+        factory = RequestFactory()
+        cases = [
+            # (REMOTE_ADDR, X-Forwarded-For, client)
+            ("203.0.113.7", "", "203.0.113.7"),
+            ("203.0.113.7", "1.1.1.1", "203.0.113.7"),  # not from our proxy, header ignored
+            ("10.0.0.2", "198.51.100.1", "198.51.100.1"),
+            ("10.0.0.2", "6.6.6.6, 198.51.100.1", "198.51.100.1"),  # spoofed left entry
+            ("10.0.0.2", "198.51.100.1, 10.0.0.9", "198.51.100.1"),  # two proxy hops
+            ("10.0.0.2", "", "10.0.0.2"),
+            ("10.0.0.2", "junk, 198.51.100.1", "198.51.100.1"),
+            ("10.0.0.2", "198.51.100.1, junk", "10.0.0.2"),
+            ("10.0.0.2", "2001:db8::1", "2001:db8::1"),
+        ]
+        for remote, forwarded, expected in cases:
+            with self.subTest(remote=remote, forwarded=forwarded):
+                request = factory.get("/", REMOTE_ADDR=remote, HTTP_X_FORWARDED_FOR=forwarded)
+                self.assertEqual(rate_limit.client_ip(request), expected)
+
+    def test_rates(self):
+        self.assertEqual(rate_limit.limit("ip", "10/m"), rate_limit.Limit("ip", 10, 60))
+        self.assertEqual(rate_limit.limit("email", "3/10m"), rate_limit.Limit("email", 3, 600))
+        with self.assertRaises(ValueError):
+            rate_limit.limit("ip", "10 per minute")
+
+
+@override_settings(RATE_LIMIT_ENABLED=True)
+class RateLimitGateTests(SimpleTestCase):
+    """GATE_LUA on fakeredis: GCRA limits, blocklists and the OTP cooldown"""
+
+    def setUp(self):
+        self.redis = fake_redis(self, rate_limit)
+        self.ctx = {"ip": "203.0.113.7", "data": {"email": "Student250001@akgec.ac.in"}}
+
+    def gate(self, limits, cooldown_key=None):
+        return rate_limit.gate("test", limits, self.ctx, cooldown_key)
+
+    def test_burst_then_retry_after(self):
+        limits = [rate_limit.Limit("ip", 2, 60)]
+        self.assertEqual([self.gate(limits) for _ in range(2)], [(rate_limit.ALLOWED, 0)] * 2)
+        self.assertEqual(self.gate(limits), (rate_limit.LIMITED, 30))
+        keys, args = rate_limit._call("test", limits, self.ctx, None)
+        result, wait_ms = rate_limit.gate_script(keys=keys, args=args, client=self.redis)
+        self.assertEqual(result, rate_limit.LIMITED)
+        self.assertTrue(29000 < wait_ms <= 30000, wait_ms)
+
+    def test_allowance_returns_after_the_emission_interval(self):
+        limits = [rate_limit.Limit("ip", 2, 0.2)]  # a token every 100 ms
+        self.gate(limits)
+        self.gate(limits)
+        self.assertEqual(self.gate(limits)[0], rate_limit.LIMITED)
+        time.sleep(0.12)
+        self.assertEqual(self.gate(limits), (rate_limit.ALLOWED, 0))
+        self.assertEqual(self.gate(limits)[0], rate_limit.LIMITED)
+
+    def test_refusal_spends_no_token_of_the_other_limit(self):
+        limits = [rate_limit.Limit("ip", 1, 60), rate_limit.Limit("email", 2, 60)]
+        email_key = "RateLimit:test:email:student250001@akgec.ac.in"
+        self.assertEqual(self.gate(limits)[0], rate_limit.ALLOWED)
+        spent = self.redis.get(email_key)
+        self.assertEqual(self.gate(limits)[0], rate_limit.LIMITED)
+        self.assertEqual(self.redis.get(email_key), spent)
+        # from another address the email still has its second token
+        self.ctx["ip"] = "198.51.100.1"
+        self.assertEqual(self.gate(limits)[0], rate_limit.ALLOWED)
+        self.assertEqual(self.gate(limits)[0], rate_limit.LIMITED)
+
+    def test_blocklisted_ip_and_email(self):
+        limits = [rate_limit.Limit("ip", 5, 60)]
+        self.redis.sadd(rate_limit.BLOCKED_IPS_KEY, "203.0.113.7")
+        self.assertEqual(self.gate(limits), (rate_limit.BLOCKED, 0))
+        self.assertIsNone(self.redis.get("RateLimit:test:ip:203.0.113.7"))
+        self.redis.delete(rate_limit.BLOCKED_IPS_KEY)
+        self.redis.sadd(rate_limit.BLOCKED_EMAILS_KEY, "student250001@akgec.ac.in")
+        self.assertEqual(self.gate(limits), (rate_limit.BLOCKED, 0))
+
+    def test_cooldown_answers_its_remaining_ttl(self):
+        self.redis.set("Cooldown:student250001@akgec.ac.in", 1, px=4500)
+        result, wait = self.gate([rate_limit.Limit("ip", 5, 60)], "Cooldown:student250001@akgec.ac.in")
+        self.assertEqual((result, wait), (rate_limit.COOLDOWN, 5))
+        self.assertEqual(self.gate([], "Cooldown:nobody"), (rate_limit.ALLOWED, 0))
+
+
+@override_settings(**TEST_SETTINGS)
+class StandInTests(SimpleTestCase):
+    """The local services manage.py loadtest runs against"""
+
+    def test_smtp_captures_otp_mail(self):
+        with CapturingSMTPServer() as smtp:
+            connection = mail.get_connection(
+                "django.core.mail.backends.smtp.EmailBackend",
+                host="127.0.0.1", port=smtp.port, use_tls=False, username="", password="",
+            )
+            mail.EmailMessage("Your OTP Code", "Your OTP is: 042917", "loadtest@localhost",
+                              ["Aman250001@akgec.ac.in"], connection=connection).send()
+            self.assertEqual(smtp.outbox.wait_for_otp("aman250001@akgec.ac.in", timeout=5), "042917")
+            self.assertIsNone(smtp.outbox.wait_for("aman250001@akgec.ac.in", count=2, timeout=0.05))
+
+    def test_siteverify_stub(self):
+        with SiteverifyStub() as siteverify, mock.patch.object(recaptcha, "SITEVERIFY_URL", siteverify.url):
+            self.assertTrue(recaptcha.verify_recaptcha("loadtest-token", "create_order"))
+            self.assertFalse(recaptcha.verify_recaptcha("invalid-token", "create_order"))
+
+
+@override_settings(**TEST_SETTINGS)
+class TimingTests(TestCase):
+    def setUp(self):
+        mock_redis_gate(self)
+
+    def test_server_timing_breaks_request_down(self):
+        student = make_student()
+        before = metrics.request_seconds.values.get(("verify-otp", "POST", "2xx"), [0, 0])[-2]
+        response = self.client.post("/api/users/verify-otp/", {"email": student.email, "otp": "123456"})
+        self.assertEqual(response.status_code, 200)
+        spans = {part.split(";")[0]: part for part in response["Server-Timing"].split(", ")}
+        self.assertEqual(set(spans), {"redis", "db", "total"})
+        self.assertIn('desc="1 call"', spans["db"])
+        self.assertEqual(metrics.request_seconds.values[("verify-otp", "POST", "2xx")][-2], before + 1)
+
+    @override_settings(SERVER_TIMING=False)
+    def test_header_can_be_turned_off(self):
+        response = self.client.get("/api/users/payment-status/999/")
+        self.assertNotIn("Server-Timing", response)
+
+    def test_hooks_record_nothing_outside_a_request(self):
+        with timing.span("redis"):
+            pass
+        token = timing.start()
+        with timing.span("redis"):
+            pass
+        timing.record("redis", 0.5)
+        breakdown = timing.finish(token)
+        self.assertEqual(breakdown["redis"][1], 2)
+        self.assertGreaterEqual(breakdown["redis"][0], 0.5)
+
+
+class MetricsAggregationTests(SimpleTestCase):
+    def test_render_sums_every_process(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory), \
+                mock.patch.object(metrics, "_process_file", None):
+            counter = metrics.Counter("test_aggregated_total", "test", ("kind",))
+            histogram = metrics.Histogram("test_aggregated_seconds", "test", buckets=(0.1, 1))
+            self.addCleanup(metrics.REGISTRY.remove, counter)
+            self.addCleanup(metrics.REGISTRY.remove, histogram)
+            counter.inc(2, kind="a")
+            histogram.observe(0.05)
+            # another worker's file
+            with open(os.path.join(directory, "1-1.json"), "w") as f:
+                json.dump({
+                    "test_aggregated_total": [[["a"], 3], [["b"], 1]],
+                    "test_aggregated_seconds": [[[], [0, 1, 1, 0.5]]],
+                }, f)
+
+            rendered = metrics.render()
+        self.assertIn('test_aggregated_total{kind="a"} 5', rendered)
+        self.assertIn('test_aggregated_total{kind="b"} 1', rendered)
+        self.assertIn('test_aggregated_seconds_bucket{le="0.1"} 1', rendered)
+        self.assertIn('test_aggregated_seconds_bucket{le="1"} 2', rendered)
+        self.assertIn("test_aggregated_seconds_count 2", rendered)
+
+    def test_gauges_of_stale_files_are_left_out(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory), \
+                mock.patch.object(metrics, "_process_file", None):
+            gauge = metrics.Gauge("test_aggregated_in_use", "test")
+            self.addCleanup(metrics.REGISTRY.remove, gauge)
+            gauge.set(2)
+            for name, age in (("1-1.json", 0), ("2-2.json", metrics.GAUGE_MAX_AGE + 1)):
+                path = os.path.join(directory, name)
+                with open(path, "w") as f:
+                    json.dump({"test_aggregated_in_use": [[[], 3]]}, f)
+                os.utime(path, (time.time() - age, time.time() - age))
+
+            rendered = metrics.render()
+        self.assertIn("# TYPE test_aggregated_in_use gauge", rendered)
+        self.assertIn("test_aggregated_in_use 5", rendered)
+
+    def test_exited_workers_are_archived(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory), \
+                mock.patch.object(metrics, "_process_file", None):
+            counter = metrics.Counter("test_archived_total", "test")
+            histogram = metrics.Histogram("test_archived_seconds", "test", buckets=(1,))
+            gauge = metrics.Gauge("test_archived_in_use", "test")
+            for metric in (counter, histogram, gauge):
+                self.addCleanup(metrics.REGISTRY.remove, metric)
+            for pid in (101, 102):
+                with open(os.path.join(directory, f"{pid}-1.json"), "w") as f:
+                    json.dump({
+                        "test_archived_total": [[[], 2]],
+                        "test_archived_seconds": [[[], [1, 1, 0.5]]],
+                        "test_archived_in_use": [[[], 4]],
+                        metrics.GAUGES_KEY: ["test_archived_in_use"],
+                    }, f)
+
+            metrics.mark_process_dead(101)
+            metrics.mark_process_dead(102)
+            self.assertEqual(sorted(os.listdir(directory)), [metrics.ARCHIVE_FILE])
+            rendered = metrics.render()
+            self.assertIn("test_archived_total 4", rendered)  # counters do not go backwards
+            self.assertIn("test_archived_seconds_count 2", rendered)
+            self.assertNotIn("test_archived_in_use 4", rendered)
+
+            metrics.clear()
+            self.assertEqual(os.listdir(directory), [])
+
+
+class DatabasePoolTests(SimpleTestCase):
+    def test_exhausted_database_is_a_503(self):
+        middleware = DatabaseBusyMiddleware(lambda request: None)
+        request = RequestFactory().post("/api/users/send-otp/")
+        response = middleware.process_exception(request, OperationalError("FATAL:  sorry, too many clients already"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(db_pool.RETRY_AFTER))
+        self.assertIsNone(middleware.process_exception(request, OperationalError("canceling statement due to statement timeout")))
+        self.assertIsNone(middleware.process_exception(request, ValueError("too many clients already")))
+        if db_pool.PoolTimeout is not None:
+            error = OperationalError("pool")
+            error.__cause__ = db_pool.PoolTimeout("couldn't get a connection after 5.00 sec")
+            self.assertEqual(middleware.process_exception(request, error).status_code, 503)
+
+    def test_pool_stats_become_metrics(self):
+        pool = mock.Mock()
+        pool.pop_stats.return_value = {
+            "pool_size": 4, "pool_available": 1, "pool_max": 10, "requests_waiting": 2,
+            "requests_num": 7, "requests_wait_ms": 1500, "requests_errors": 1, "connections_lost": 1,
+        }
+        with mock.patch.object(db_pool, "pools", return_value={"default": pool}), \
+                mock.patch.object(db_pool.pool_checkouts, "values", {}), \
+                mock.patch.object(db_pool.pool_checkout_wait, "values", {}):
+            rendered = metrics.render()
+        self.assertIn('db_pool_connections{alias="default",state="in_use"} 3', rendered)
+        self.assertIn('db_pool_waiting{alias="default"} 2', rendered)
+        self.assertIn('db_pool_checkouts_total{alias="default"} 7', rendered)
+        self.assertIn('db_pool_checkout_wait_seconds_total{alias="default"} 1.5', rendered)
+
+
+@override_settings(**TEST_SETTINGS, CHECKIN_TOKEN="gate-secret", CHECKIN_MAX_BATCH=10)
+class CheckinTests(TestCase):
+    def setUp(self):
+        self.redis = fake_redis(self, checkin)
+
+    def present(self):
+        return {int(student_id) for student_id in self.redis.smembers(checkin.PRESENT_KEY)}
+
+    def scan(self, tokens):
+        return self.client.post("/api/users/checkin/", {"tokens": tokens}, content_type="application/json",
+                                HTTP_AUTHORIZATION="Bearer gate-secret")
+
+    def test_batch_in_one_update(self):
+        paid = make_student(1, payment_status='SUCCESS')
+        unpaid = make_student(2)
+        token = checkin.issue_token(paid.id)
+        tokens = [token, checkin.issue_token(unpaid.id), token, checkin.issue_token(999), token[:-1] + "x", "junk"]
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.scan(tokens)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["result"] for r in response.json()["results"]],
+                         ["checked_in", "not_paid", "duplicate", "unknown", "invalid", "invalid"])
+        self.assertEqual(response.json()["results"][0]["student_number"], paid.student_number)
+        self.assertEqual(len(statements(ctx)), 2)  # UPDATE, SELECT
+        paid.refresh_from_db()
+        self.assertTrue(paid.is_present)
+        self.assertIsNotNone(paid.checked_in_at)
+        self.assertEqual(self.present(), {paid.id})
+        self.assertLessEqual(self.redis.ttl(checkin.PRESENT_KEY), settings.CHECKIN_PRESENT_TTL)
+        self.assertGreater(self.redis.ttl(checkin.PRESENT_KEY), 0)
+
+    def test_rescan_answered_from_redis(self):
+        paid = make_student(1, payment_status='SUCCESS')
+        self.scan([checkin.issue_token(paid.id)])
+        with self.assertNumQueries(0):
+            response = self.scan([checkin.issue_token(paid.id)])
+        self.assertEqual(response.json()["results"][0]["result"], "duplicate")
+
+    def test_undone_scan_leaves_the_set(self):
+        paid = make_student(1, payment_status='SUCCESS')
+        self.scan([checkin.issue_token(paid.id)])
+        paid.refresh_from_db()
+        paid.is_present = False
+        paid.save()
+        self.assertEqual(self.present(), set())
+        self.assertEqual(self.scan([checkin.issue_token(paid.id)]).json()["results"][0]["result"], "checked_in")
+
+        self.scan([checkin.issue_token(paid.id)])
+        token = checkin.issue_token(paid.id)
+        paid.delete()
+        self.assertEqual(self.present(), set())
+        self.assertEqual(self.scan([token]).json()["results"][0]["result"], "unknown")
+
+    def test_database_decides_without_redis(self):
+        paid = make_student(1, payment_status='SUCCESS', is_present=True)
+        with mock.patch.object(self.redis, "smismember", side_effect=ConnectionError("down")):
+            response = self.scan([checkin.issue_token(paid.id)])
+        self.assertEqual(response.json()["results"][0]["result"], "duplicate")
+
+    def test_needs_gate_token_and_bounded_batch(self):
+        response = self.client.post("/api/users/checkin/", {"tokens": ["a"]}, content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.scan(["a"] * 11).status_code, 400)
+        self.assertEqual(self.scan("a").status_code, 400)
+
+
+@override_settings(**TEST_SETTINGS, CHECKIN_TOKEN="gate-secret")
+class CheckinSyncTests(TestCase):
+    def setUp(self):
+        fake_redis(self, checkin)
+
+    def sync(self, **params):
+        headers = {key: params.pop(key) for key in list(params) if key.startswith("HTTP_")}
+        return self.client.get("/api/users/checkin/sync/", params, HTTP_AUTHORIZATION="Bearer gate-secret", **headers)
+
+    def test_snapshot_then_delta(self):
+        paid = [make_student(n, payment_status='SUCCESS') for n in (1, 2)]
+        make_student(3)
+        response = self.sync()
+        self.assertEqual(response.status_code, 200)
+        feed = response.json()
+        self.assertTrue(feed["full"])
+        self.assertEqual([row[0] for row in feed["students"]], [s.id for s in paid])
+        expected = hashlib.sha256(checkin.issue_token(paid[0].id).encode()).hexdigest()[:checkin.TOKEN_HASH_LENGTH]
+        self.assertEqual(dict(zip(feed["fields"], feed["students"][0]))["token_hash"], expected)
+
+        Student.objects.filter(id=paid[0].id).update(payment_status='FAILED', updated_at=timezone.now())
+        delta = self.sync(since=feed["cursor"]).json()
+        self.assertFalse(delta["full"])
+        # rows written within CHECKIN_SYNC_LAG of the cursor come again, devices upsert by id
+        self.assertIn(paid[0].id, delta["removed"])
+        self.assertEqual([row[0] for row in delta["students"]], [paid[1].id])
+
+    def test_deleted_student_is_removed(self):
+        paid = [make_student(n, payment_status='SUCCESS') for n in (1, 2)]
+        response = self.sync()
+        feed, etag = response.json(), response["ETag"]
+        deleted_id = paid[0].id
+        paid[0].delete()
+        self.assertEqual(self.sync(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        delta = self.sync(since=feed["cursor"]).json()
+        self.assertIn(deleted_id, delta["removed"])
+        self.assertNotIn(deleted_id, [row[0] for row in delta["students"]])
+
+    def test_unchanged_is_304_after_two_lookups(self):
+        make_student(1, payment_status='SUCCESS')
+        etag = self.sync()["ETag"]
+        with self.assertNumQueries(2):
+            response = self.sync(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        make_student(2, payment_status='SUCCESS')
+        self.assertEqual(self.sync(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_gzipped_and_guarded(self):
+        for n in range(1, 6):
+            make_student(n, payment_status='SUCCESS')
+        response = self.sync(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))["students"]), 5)
+        self.assertEqual(self.sync(since="yesterday").status_code, 400)
+        self.assertEqual(self.client.get("/api/users/checkin/sync/").status_code, 404)
+
+
+@override_settings(**TEST_SETTINGS)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("organizer", is_staff=True))
+        make_student(1, payment_status='SUCCESS', name="=HYPERLINK(1)")
+        make_student(2, payment_status='SUCCESS', hostler=True)
+        make_student(3)
+
+    def test_csv_streams_filtered_rows(self):
+        response = self.client.get("/api/users/export/", {"payment_status": "SUCCESS", "hostler": "false"})
+        self.assertTrue(response.streaming)
+        lines = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(lines[0][:3], ["id", "name", "email"])
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1][1], "'=HYPERLINK(1)")  # stays text in a spreadsheet
+
+    def test_xlsx_is_a_valid_package(self):
+        response = self.client.get("/api/users/export/", {"format": "xlsx"})
+        package = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertIsNone(package.testzip())
+        sheet = package.read("xl/worksheets/sheet1.xml").decode()
+        self.assertEqual(sheet.count("<row>"), 4)
+        self.assertIn("=HYPERLINK(1)", sheet)
+
+    def test_bad_filter_and_staff_only(self):
+        self.assertEqual(self.client.get("/api/users/export/", {"present": "maybe"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/users/export/", {"format": "pdf"}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get("/api/users/export/").status_code, 302)
+
+
+@override_settings(**TEST_SETTINGS, RAZORPAY_WEBHOOK_SECRET="test")
+class StudentAdminTests(TestCase):
+    url = "/admin/users/student/"
+
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.addCleanup(payment_gateway.reset_gateway)
+        self.client.force_login(User.objects.create_superuser("admin", "admin@akgec.ac.in", "password"))
+        self.students = [make_student(n) for n in range(1, 6)]
+        # two rows share a created_at, the id breaks the tie
+        Student.objects.filter(pk=self.students[3].pk).update(created_at=self.students[2].created_at)
+        patcher = mock.patch.object(StudentAdmin, "list_per_page", 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keyset_pages_cover_every_row_once(self):
+        expected = list(Student.objects.order_by("-created_at", "-id").values_list("id", flat=True))
+        seen, params = [], {}
+        while True:
+            cl = self.client.get(self.url, params).context["cl"]
+            seen += [student.pk for student in cl.result_list]
+            if not cl.next_cursor:
+                break
+            params = {"cursor": cl.next_cursor}
+        self.assertEqual(seen, expected)
+        self.assertEqual(cl.result_count, 5)
+
+    def test_count_is_cached_and_filters_apply(self):
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, {"cursor": self.client.get(self.url).context["cl"].next_cursor})
+        self.assertFalse([sql for sql in statements(ctx) if "COUNT(" in sql.upper()])
+        self.assertContains(response, "Newest")
+
+        Student.objects.filter(pk=self.students[0].pk).update(payment_status='SUCCESS')
+        cl = self.client.get(self.url, {"payment_status__exact": "SUCCESS"}).context["cl"]
+        self.assertEqual([student.pk for student in cl.result_list], [self.students[0].pk])
+        self.assertEqual(cl.result_count, 1)
+        self.assertEqual(self.client.get(self.url, {"cursor": "yesterday"}).status_code, 302)
+
+    def test_resync_action_applies_gateway_state(self):
+        gateway = payment_gateway.get_gateway()
+        paid = gateway.create_order(50000, "paid")
+        failed = gateway.create_order(50000, "failed")
+        gateway.pay(paid["id"])
+        gateway.pay(failed["id"], captured=False)
+        Student.objects.filter(pk=self.students[0].pk).update(razorpay_order_id=paid["id"])
+        Student.objects.filter(pk=self.students[1].pk).update(razorpay_order_id=failed["id"])
+        # the webhook was recorded but never reached the row
+        WebhookEvent.objects.create(event="payment.captured", payment_id=gateway.payments[paid["id"]][0]["id"], order_id=paid["id"])
+
+        self.client.post(self.url, {
+            "action": "resync_payment_status",
+            "_selected_action": [student.pk for student in self.students],
+        })
+        statuses = dict(Student.objects.values_list("id", "payment_status"))
+        self.assertEqual(statuses[self.students[0].pk], "SUCCESS")
+        self.assertEqual(statuses[self.students[1].pk], "FAILED")
+        self.assertEqual(statuses[self.students[2].pk], "PENDING")
+
+    @override_settings(STUDENT_ADMIN_RESYNC_MAX=1)
+    def test_resync_refuses_what_would_outlast_the_request(self):
+        Student.objects.filter(pk=self.students[0].pk).update(razorpay_order_id="order_a")
+        Student.objects.filter(pk=self.students[1].pk).update(razorpay_order_id="order_b")
+        with mock.patch.object(reconcile, "resync") as resync:
+            response = self.client.post(self.url, {
+                "action": "resync_payment_status",
+                "_selected_action": [student.pk for student in self.students],
+            }, follow=True)
+        resync.assert_not_called()
+        self.assertContains(response, "more than 1 orders to check")
+
+    def test_resend_confirmation_is_one_pipeline(self):
+        Student.objects.filter(pk__in=[self.students[0].pk, self.students[1].pk]).update(payment_status='SUCCESS')
+        with mock.patch.object(mail_queue, "redis_client") as redis_client:
+            self.client.post(self.url, {
+                "action": "resend_confirmation",
+                "_selected_action": [student.pk for student in self.students],
+            })
+        pipe = redis_client.pipeline.return_value
+        pipe.execute.assert_called_once()
+        jobs = [json.loads(job) for job in pipe.lpush.call_args.args[1:]]
+        self.assertEqual(sorted(job["email"] for job in jobs), sorted([self.students[0].email, self.students[1].email]))
+        self.assertIn(checkin.issue_token(self.students[0].pk), next(job["message"] for job in jobs if job["email"] == self.students[0].email))
+
+
+@override_settings(**TEST_SETTINGS, WAITING_ROOM_ENABLED=True, WAITING_ROOM_RATE=2, WAITING_ROOM_BURST=0)
+class WaitingRoomTests(TestCase):
+    def setUp(self):
+        mock_redis_gate(self)
+        self.redis = fake_redis(self, waiting_room)
+
+    def test_ticket_waits_then_gets_an_admission(self):
+        joined = self.client.post("/api/users/waiting-room/").json()
+        self.assertEqual((joined["position"], joined["admitted"], joined["retry_after"]), (1, False, 1))
+        self.assertNotIn("admission_token", joined)
+
+        time.sleep(0.6)  # 2 admissions per second
+        state = self.client.get("/api/users/waiting-room/status/", {"token": joined["token"]}).json()
+        self.assertTrue(state["admitted"])
+        self.assertTrue(waiting_room.is_admitted(state["admission_token"], "127.0.0.1"))
+
+        # a reset room knows neither the ticket nor the admission
+        waiting_room.reset()
+        self.assertEqual(self.client.get("/api/users/waiting-room/status/", {"token": joined["token"]}).status_code, 404)
+        self.assertEqual(self.client.get("/api/users/waiting-room/status/", {"token": "7:forged"}).status_code, 404)
+        waiting_room.join("127.0.0.1")
+        self.assertFalse(waiting_room.is_admitted(state["admission_token"], "127.0.0.1"))
+
+    @override_settings(WAITING_ROOM_BURST=5, WAITING_ROOM_ADMISSION_USES=2)
+    def test_admission_is_bound_to_the_client_and_its_uses(self):
+        token = waiting_room.join("10.0.0.1")["admission_token"]
+        self.assertFalse(waiting_room.is_admitted(token, "10.0.0.2"))
+        self.assertTrue(waiting_room.is_admitted(token, "10.0.0.1"))
+        self.assertTrue(waiting_room.is_admitted(token, "10.0.0.1"))
+        self.assertFalse(waiting_room.is_admitted(token, "10.0.0.1"))
+
+        with override_settings(WAITING_ROOM_ADMISSION_TTL=-1):
+            self.assertFalse(waiting_room.is_admitted(waiting_room.join("10.0.0.1")["admission_token"], "10.0.0.1"))
+
+        # the room runs on Redis too: without it the signature decides
+        with mock.patch.object(waiting_room, "admit_script", side_effect=ConnectionError("down")):
+            self.assertTrue(waiting_room.is_admitted(token, "10.0.0.1"))
+
+    @override_settings(WAITING_ROOM_BURST=5)
+    def test_otp_and_payment_need_an_admission(self):
+        with mock.patch("users.views.OTPManager.send_otp", return_value=(True, "OTP sent")) as send_otp:
+            response = self.client.post("/api/users/send-otp/", {"email": "aman250001@akgec.ac.in"})
+            self.assertEqual(response.status_code, 429)
+            send_otp.assert_not_called()
+
+            response = self.client.post(
+                "/api/users/send-otp/", {"email": "aman250001@akgec.ac.in"},
+                headers={"X-Admission-Token": waiting_room.join("127.0.0.1")["admission_token"]},
+            )
+            self.assertEqual(response.status_code, 200)
+            send_otp.assert_called_once()
+
+        with self.assertNumQueries(0):
+            response = self.client.post("/api/users/payment-initiation/", {"student_id": 1, "recaptcha_token": "t"})
+        self.assertEqual(response.status_code, 429)
+
+
+class TicketTests(TestCase):
+    def setUp(self):
+        mock_redis_gate(self)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = {"BACKEND": "django.core.files.storage.FileSystemStorage", "OPTIONS": {"location": directory.name}}
+        overrides = override_settings(**TEST_SETTINGS, STORAGES={**settings.STORAGES, "tickets": storage})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(tickets, "redis_client")
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.paid = make_student(1, payment_status='SUCCESS')
+        self.row = tickets.paid_rows([self.paid.pk]).get()
+
+    def test_render_is_deterministic_and_cached_by_content(self):
+        fields = tickets.fields(*self.row)
+        pdf = ticket_render.render(fields, "pdf")
+        self.assertTrue(pdf.startswith(b"%PDF-"))
+        self.assertEqual(pdf, ticket_render.render(fields, "pdf"))
+        self.assertTrue(ticket_render.render(fields, "png").startswith(b"\x89PNG"))
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            counts, fresh = tickets.render_many([self.row], executor=executor)
+            self.assertEqual((counts[tickets.RENDERED], fresh), (2, {self.paid.pk}))
+            counts, fresh = tickets.render_many([self.row], executor=executor)
+            self.assertEqual((counts[tickets.CACHED], counts[tickets.RENDERED], fresh), (2, 0, set()))
+
+        # a changed name is a new file, not a stale one
+        renamed = (self.row[0], "Someone Else", *self.row[2:])
+        self.assertNotEqual(tickets.locate(renamed, "pdf"), tickets.locate(self.row, "pdf"))
+
+    def test_download_waits_for_the_worker_then_serves_the_file(self):
+        token = checkin.issue_token(self.paid.pk)
+        response = self.client.get("/api/users/ticket/", {"token": token})
+        self.assertEqual((response.status_code, response["Retry-After"]), (202, "5"))
+        self.redis.sadd.assert_called_once_with(tickets.QUEUE_KEY, self.paid.pk)
+
+        with mock.patch.object(tickets, "send_confirmations") as send_confirmations:
+            self.redis.spop.side_effect = [[str(self.paid.pk).encode()], []]
+            call_command("render_tickets", "--once", "--processes=1", stdout=io.StringIO())
+        send_confirmations.assert_called_once_with({self.paid.pk})
+
+        response = self.client.get("/api/users/ticket/", {"token": token, "type": "png"})
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"\x89PNG"))
+        response = self.client.get("/api/users/ticket/", {"token": token}, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 200)  # the pdf has its own ETag
+        response = self.client.get("/api/users/ticket/", {"token": token}, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        unpaid = make_student(2)
+        self.assertEqual(self.client.get("/api/users/ticket/", {"token": checkin.issue_token(unpaid.pk)}).status_code, 404)
+        self.assertEqual(self.client.get("/api/users/ticket/", {"token": "junk"}).status_code, 404)
+
+    def test_payment_success_queues_the_ticket(self):
+        Student.objects.filter(pk=self.paid.pk).update(payment_status='PENDING', razorpay_order_id="order_1")
+        with mock.patch.object(payment_status, "publish"), self.captureOnCommitCallbacks(execute=True):
+            webhooks.apply_payment_events([("payment.captured", "order_1", "pay_1", None)])
+        self.redis.sadd.assert_called_once_with(tickets.QUEUE_KEY, self.paid.pk)
+
+
+def webhook_body(event, order_id, payment_id):
+    return json.dumps({"event": event, "payload": {"payment": {"entity": {"order_id": order_id, "id": payment_id}}}})
+
+
+@override_settings(**TEST_SETTINGS)
+class WebhookConsumerTests(TestCase):
+    def setUp(self):
+        self.redis = fake_redis(self, webhook_stream, consume_webhooks)
+        self.student = make_student(razorpay_order_id="order_1")
+
+    def consume(self, *args):
+        with mock.patch.object(payment_status, "publish"):
+            call_command("consume_webhooks", "--once", *args, stdout=io.StringIO())
+
+    def test_event_of_an_unknown_order_stays_pending_then_dead_letters(self):
+        webhook_stream.append(webhook_body("payment.captured", "order_1", "pay_1"))
+        webhook_stream.append(webhook_body("payment.captured", "order_2", "pay_2"))
+        self.consume()
+        self.assertEqual(Student.objects.get(pk=self.student.pk).payment_status, "SUCCESS")
+        self.assertEqual(list(WebhookEvent.objects.values_list("payment_id", flat=True)), ["pay_1"])
+        self.assertEqual(self.redis.xpending(webhook_stream.STREAM_KEY, webhook_stream.GROUP)["pending"], 1)
+
+        # the order shows up, the redelivery applies it
+        other = make_student(2, razorpay_order_id="order_2")
+        self.consume("--retry-after=0")
+        self.assertEqual(Student.objects.get(pk=other.pk).payment_status, "SUCCESS")
+        self.assertEqual(self.redis.xpending(webhook_stream.STREAM_KEY, webhook_stream.GROUP)["pending"], 0)
+
+        webhook_stream.append(webhook_body("payment.captured", "order_3", "pay_3"))
+        self.consume("--retry-after=0", "--max-deliveries=2")
+        self.assertEqual(self.redis.xlen(webhook_stream.DEAD_LETTER_KEY), 1)
+        self.assertFalse(WebhookEvent.objects.filter(payment_id="pay_3").exists())
+
+    def test_events_of_a_crashed_consumer_are_claimed(self):
+        webhook_stream.ensure_group()
+        webhook_stream.append(webhook_body("payment.captured", "order_1", "pay_1"))
+        self.redis.xreadgroup(webhook_stream.GROUP, "crashed", {webhook_stream.STREAM_KEY: ">"})
+
+        self.consume("--name=other")  # not idle long enough yet
+        self.assertEqual(Student.objects.get(pk=self.student.pk).payment_status, "PENDING")
+        self.consume("--name=other", "--retry-after=0")
+        self.assertEqual(Student.objects.get(pk=self.student.pk).payment_status, "SUCCESS")
+        self.assertEqual(self.redis.xpending(webhook_stream.STREAM_KEY, webhook_stream.GROUP)["pending"], 0)
+        self.assertEqual(self.redis.xlen(webhook_stream.STREAM_KEY), 0)  # acknowledged entries are trimmed
+
+    def test_bad_events_go_to_the_dead_letter_stream(self):
+        make_student(2, razorpay_order_id="order_2")
+        webhook_stream.append("not json")
+        webhook_stream.append(webhook_body("payment.captured", "order_1", "pay_1"))
+        webhook_stream.append(webhook_body("payment.captured", "order_2", "pay_2"))
+        real_apply = webhooks.apply_payment_event
+
+        def apply(event, order_id, *args):
+            if order_id == "order_2":
+                raise OperationalError("row lock timeout")
+            return real_apply(event, order_id, *args)
+
+        with mock.patch.object(consume_webhooks, "apply_payment_events", side_effect=OperationalError("deadlock")), \
+                mock.patch.object(consume_webhooks, "apply_payment_event", side_effect=apply):
+            self.consume("--retry-after=0", "--max-deliveries=3")
+
+        dead = {fields[b"reason"]: fields for _, fields in self.redis.xrange(webhook_stream.DEAD_LETTER_KEY)}
+        self.assertEqual(set(dead), {b"unparseable body", b"row lock timeout"})
+        self.assertEqual(json.loads(dead[b"row lock timeout"][b"body"])["payload"]["payment"]["entity"]["id"], "pay_2")
+        self.assertEqual(Student.objects.get(pk=self.student.pk).payment_status, "SUCCESS")
+        self.assertEqual(self.redis.xpending(webhook_stream.STREAM_KEY, webhook_stream.GROUP)["pending"], 0)
+
+
+@override_settings(**TEST_SETTINGS, RAZORPAY_WEBHOOK_SECRET="test", RECONCILE_RATE=0)
+class ReconcilePaymentsTests(TestCase):
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.addCleanup(payment_gateway.reset_gateway)
+        self.gateway = payment_gateway.get_gateway()
+        patcher = mock.patch.object(reconcile, "redis_client")
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis.hgetall.return_value = {}
+
+        self.students = {}
+        for n, (status, outcome) in enumerate([
+            ("PENDING", "captured"), ("PENDING", "failed"), ("FAILED", "captured"), ("PENDING", None), ("FAILED", "failed"),
+        ], 1):
+            order = self.gateway.create_order(50000, f"student_{n}")
+            if outcome:
+                self.gateway.pay(order["id"], captured=outcome == "captured")
+            self.students[n] = make_student(n, payment_status=status, razorpay_order_id=order["id"])
+        make_student(9)  # no order, nothing to ask
+        Student.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        with mock.patch.object(payment_status, "publish"), self.captureOnCommitCallbacks(execute=True):
+            call_command("reconcile_payments", "--batch=2", "--allow-fake-gateway", *args, stdout=out)
+        return out.getvalue()
+
+    def statuses(self):
+        return {n: Student.objects.get(pk=student.pk).payment_status for n, student in self.students.items()}
+
+    def test_dry_run_then_apply(self):
+        before = self.statuses()
+        out = self.reconcile("--dry-run")
+        self.assertIn("would move 2 to SUCCESS, 1 to FAILED, 2 unchanged", out)
+        self.assertEqual(self.statuses(), before)
+        self.redis.hset.assert_not_called()
+
+        self.gateway.rate_limited = 2  # answered with 429, retried at a slower pace
+        out = self.reconcile()
+        self.assertIn("5 orders checked", out)
+        self.assertNotIn("could not be fetched", out)
+        self.assertEqual(self.statuses(), {1: "SUCCESS", 2: "FAILED", 3: "SUCCESS", 4: "PENDING", 5: "FAILED"})
+        self.assertEqual(WebhookEvent.objects.count(), 3)
+        self.redis.delete.assert_called_with(reconcile.CHECKPOINT_KEY)
+
+    def test_resumes_after_the_checkpoint(self):
+        self.redis.hgetall.return_value = {
+            b"after": str(self.students[2].pk).encode(), b"statuses": b"FAILED,PENDING", b"checked": b"2",
+        }
+        out = self.reconcile()
+        self.assertIn("5 orders checked", out)
+        self.assertEqual(self.statuses(), {1: "PENDING", 2: "PENDING", 3: "SUCCESS", 4: "PENDING", 5: "FAILED"})
+        saved = self.redis.hset.call_args_list[0].kwargs["mapping"]
+        self.assertEqual((saved["after"], saved["checked"]), (self.students[4].pk, 4))
+
+        with self.assertRaises(CommandError):
+            self.reconcile("--status=PENDING")
+        # recently updated students may still get their webhook
+        self.assertIn("0 orders checked", self.reconcile("--restart", "--min-age=7200"))
+
+    @override_settings(RAZORPAY_MAX_RETRIES=0)
+    def test_failed_students_stay_in_the_checkpoint(self):
+        unreachable = self.students[1].razorpay_order_id
+        real_fetch = self.gateway.fetch_order_payments
+
+        def fetch(order_id):
+            if order_id == unreachable:
+                raise payment_gateway.GatewayError("timed out")
+            return real_fetch(order_id)
+
+        with mock.patch.object(self.gateway, "fetch_order_payments", side_effect=fetch):
+            out = self.reconcile()
+        self.assertIn(f"could not be fetched, run again to retry them: {unreachable}", out)
+        saved = [call.kwargs["mapping"] for call in self.redis.hset.call_args_list]
+        self.assertEqual([(state["after"], state["failed"]) for state in saved], [
+            (self.students[2].pk, str(self.students[1].pk)),
+            (self.students[4].pk, str(self.students[1].pk)),
+            (self.students[5].pk, str(self.students[1].pk)),
+        ])
+        self.assertEqual(self.statuses()[1], "PENDING")
+
+        # an interrupted run picks the failed student up before going on
+        self.redis.hgetall.return_value = {
+            b"after": str(self.students[5].pk).encode(), b"statuses": b"FAILED,PENDING",
+            b"failed": str(self.students[1].pk).encode(), b"checked": b"4", b"errors": b"1",
+        }
+        self.redis.hset.reset_mock()
+        out = self.reconcile()
+        self.assertIn("5 orders checked", out)
+        self.assertNotIn("could not be fetched", out)
+        self.assertEqual(self.statuses()[1], "SUCCESS")
+        self.assertEqual(self.redis.hset.call_args_list[0].kwargs["mapping"]["failed"], "")
+
+    def test_refuses_the_fake_gateway(self):
+        with self.assertRaises(CommandError):
+            call_command("reconcile_payments", stdout=io.StringIO())
+        self.assertIn("would move", self.reconcile("--dry-run"))
+
+
+@override_settings(**TEST_SETTINGS, ORDER_LOCK_WAIT=0.2)
+class OrderReuseTests(TestCase):
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.addCleanup(payment_gateway.reset_gateway)
+        self.gateway = payment_gateway.get_gateway()
+        patcher = mock.patch.object(orders, "redis_client")
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis.get.return_value = None
+        self.redis.set.return_value = True
+        for module in (payment_status, tickets):
+            patcher = mock.patch.object(module, "redis_client")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.student = make_student(1)
+
+    def test_open_order_is_reused_until_the_amount_changes(self):
+        order, created = orders.order_for(self.student)
+        self.assertTrue(created)
+        self.assertEqual(json.loads(self.redis.set.call_args_list[-1].args[1])["id"], order["id"])
+
+        self.redis.get.return_value = json.dumps(order).encode()
+        with self.assertNumQueries(0):
+            self.assertEqual(orders.order_for(self.student), (order, False))
+
+        with override_settings(REGISTRATION_AMOUNT=20000):
+            repriced, created = orders.order_for(self.student)
+        self.assertTrue(created)
+        self.assertEqual(repriced["amount"], 20000)
+        self.assertEqual(PaymentOrder.objects.filter(student=self.student).count(), 2)
+        self.assertEqual(Student.objects.get(pk=self.student.pk).razorpay_order_id, repriced["id"])
+
+    def test_concurrent_initiation_waits_for_the_first(self):
+        order = self.gateway.create_order(settings.REGISTRATION_AMOUNT, "receipt_1")
+        self.redis.set.return_value = False  # another request holds the lock
+        self.redis.get.side_effect = [None, None, json.dumps(order).encode()]
+        self.assertEqual(orders.order_for(self.student), (order, False))
+        self.assertEqual(len(self.gateway.orders), 1)
+
+        self.redis.get.side_effect = None
+        with mock.patch("users.utils.checks.verify_recaptcha", return_value=True):
+            response = self.client.post("/api/users/payment-initiation/", {"student_id": self.student.id, "recaptcha_token": "t"})
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "1"))
+
+    def test_webhook_for_an_earlier_order_finds_the_student(self):
+        first, _ = orders.order_for(self.student)
+        PaymentOrder.objects.filter(order_id=first["id"]).update(created_at=timezone.now() - timedelta(hours=2))
+        second, created = orders.order_for(self.student)
+        self.assertTrue(created)
+
+        # a failure of the earlier order leaves the current one alone
+        self.assertEqual(webhooks.apply_payment_event("payment.failed", first["id"], "pay_1"), webhooks.UNCHANGED)
+        with self.captureOnCommitCallbacks(execute=True):
+            webhooks.apply_payment_events([("payment.captured", first["id"], "pay_2", None)])
+        student = Student.objects.get(pk=self.student.pk)
+        self.assertEqual((student.payment_status, student.razorpay_order_id, student.razorpay_payment_id), ("SUCCESS", first["id"], "pay_2"))
+        self.assertEqual(webhooks.apply_payment_event("payment.captured", second["id"], "pay_3"), webhooks.UNCHANGED)
+
+
+class MailWorkerTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fake_redis(self, otp_manager, mail_queue, send_otp_mails)
+        self.worker = send_otp_mails.Command()
+        self.worker.max_retries = 2
+        self.worker.backoff = 10
+        self.worker.connection = None
+
+    def work(self):
+        self.worker.process(self.redis.rpop(mail_queue.QUEUE_KEY))
+
+    def test_failed_send_backs_off_then_gives_up(self):
+        mail_queue.enqueue("student250001@akgec.ac.in", "Your OTP Code", "123456", ttl=300)
+        self.assertEqual(mail_queue.get_status("student250001@akgec.ac.in")["state"], mail_queue.QUEUED)
+
+        with mock.patch.object(send_otp_mails.Command, "send", side_effect=OSError("smtp down")):
+            self.work()
+            (raw, due), = self.redis.zrange(mail_queue.RETRY_KEY, 0, -1, withscores=True)
+            self.assertAlmostEqual(due, time.time() + 10, delta=2)
+            self.assertEqual(mail_queue.get_status("student250001@akgec.ac.in")["state"], mail_queue.RETRYING)
+
+            # not due yet, stays in the retry set
+            self.worker.promote_due_retries()
+            self.assertEqual(self.redis.llen(mail_queue.QUEUE_KEY), 0)
+            self.redis.zadd(mail_queue.RETRY_KEY, {raw: 0})
+            self.worker.promote_due_retries()
+            self.work()
+            (_, due), = self.redis.zrange(mail_queue.RETRY_KEY, 0, -1, withscores=True)
+            self.assertAlmostEqual(due, time.time() + 20, delta=2)
+
+            self.redis.zadd(mail_queue.RETRY_KEY, {self.redis.zrange(mail_queue.RETRY_KEY, 0, -1)[0]: 0})
+            self.worker.promote_due_retries()
+            self.work()
+        status = mail_queue.get_status("student250001@akgec.ac.in")
+        self.assertEqual((status["state"], status["attempts"], status["error"]), (mail_queue.FAILED, "3", "smtp down"))
+        self.assertEqual(self.redis.zcard(mail_queue.RETRY_KEY), 0)
+
+    def test_worker_sends_the_latest_mail_only(self):
+        mail_queue.enqueue("student250001@akgec.ac.in", "Your OTP Code", "111111", ttl=300)
+        mail_queue.enqueue("student250001@akgec.ac.in", "Your OTP Code", "222222", ttl=300)
+        mail_queue.enqueue("student250002@akgec.ac.in", "Your OTP Code", "333333", ttl=300)
+        stale = json.loads(self.redis.lindex(mail_queue.QUEUE_KEY, 0))
+        self.redis.lset(mail_queue.QUEUE_KEY, 0, json.dumps({**stale, "expires_at": time.time() - 1}))
+        call_command("send_otp_mails", "--once", "--name=test", stdout=io.StringIO())
+        self.assertEqual([message.body for message in mail.outbox], ["222222"])
+        self.assertEqual(mail_queue.get_status("student250001@akgec.ac.in")["state"], mail_queue.SENT)
+        self.assertEqual(mail_queue.get_status("student250002@akgec.ac.in")["state"], mail_queue.EXPIRED)
+
+    def test_confirmation_and_otp_mails_do_not_supersede_each_other(self):
+        email = "student250001@akgec.ac.in"
+        mail_queue.enqueue(email, "Your OTP Code", "111111", ttl=300)
+        otp_job = mail_queue.get_status(email)["job_id"]
+        mail_queue.enqueue_many([(email, "Registration Successful", "ticket")], 300, mail_queue.CONFIRMATION)
+        mail_queue.enqueue(email, "Your OTP Code", "222222", ttl=300)
+        self.assertNotEqual(mail_queue.get_status(email)["job_id"], otp_job)
+        call_command("send_otp_mails", "--once", "--name=test", stdout=io.StringIO())
+        self.assertEqual(sorted(message.body for message in mail.outbox), ["222222", "ticket"])
+        self.assertEqual(mail_queue.get_status(email)["state"], mail_queue.SENT)
+        self.assertEqual(mail_queue.get_status(email, mail_queue.CONFIRMATION)["state"], mail_queue.SENT)
+
+    def test_restarted_worker_requeues_its_job_in_flight(self):
+        mail_queue.enqueue("student250001@akgec.ac.in", "Your OTP Code", "123456", ttl=300)
+        self.redis.lmove(mail_queue.QUEUE_KEY, mail_queue.processing_key("test"), "RIGHT", "LEFT")
+        self.worker.processing_key = mail_queue.processing_key("test")
+        self.worker.recover()
+        self.assertEqual((self.redis.llen(mail_queue.QUEUE_KEY), self.redis.llen(self.worker.processing_key)), (1, 0))
+
+
+class OTPScriptTests(SimpleTestCase):
+    email = "student250001@akgec.ac.in"
+
+    def setUp(self):
+        self.redis = fake_redis(self, otp_manager, mail_queue)
+
+    def otp(self):
+        return self.redis.get(f"OTP:{self.email}").decode()
+
+    def test_issue_queues_the_mail_and_starts_the_cooldown(self):
+        self.assertEqual(otp_manager.OTPManager.send_otp(self.email, "127.0.0.1"), (True, "OTP sent successfully"))
+        job = json.loads(self.redis.lindex(mail_queue.QUEUE_KEY, 0))
+        self.assertIn(self.otp(), job["message"])
+        self.assertEqual(mail_queue.get_status(self.email)["job_id"], job["id"])
+        self.assertAlmostEqual(self.redis.ttl(f"OTP:{self.email}"), otp_manager.OTPManager.OTP_EXPIRY, delta=2)
+
+        sent, message = otp_manager.OTPManager.send_otp(self.email, "127.0.0.1")
+        self.assertFalse(sent)
+        self.assertRegex(message, r"^Wait 1[78]\d seconds before requesting again$")
+        self.assertEqual(self.redis.llen(mail_queue.QUEUE_KEY), 1)
+        self.assertGreater(otp_manager.OTPManager.cooldown_remaining(self.email), 170)
+
+    def test_verify_limits_attempts(self):
+        otp_manager.OTPManager.send_otp(self.email, "127.0.0.1")
+        otp = self.otp()
+        wrong = "000000" if otp != "000000" else "111111"
+        results = [otp_manager.OTPManager.verify_otp(self.email, wrong)[1] for _ in range(3)]
+        self.assertEqual(results, [f"Invalid OTP. {n} attempts left" for n in (2, 1, 0)])
+        # the right one is too late now
+        self.assertEqual(otp_manager.OTPManager.verify_otp(self.email, otp), (False, "Max attempts reached. Request new OTP"))
+
+    def test_verify_consumes_the_otp(self):
+        otp_manager.OTPManager.send_otp(self.email, "127.0.0.1")
+        otp = self.otp()
+        self.assertEqual(otp_manager.OTPManager.verify_otp(self.email, otp), (True, "OTP verified successfully"))
+        self.assertEqual(self.redis.get(f"Verified:{self.email}"), b"1")
+        self.assertEqual(self.redis.exists(f"OTP:{self.email}", f"Attempts:{self.email}", f"Cooldown:{self.email}"), 0)
+        self.assertEqual(otp_manager.OTPManager.verify_otp(self.email, otp), (False, "OTP expired or invalid"))
+
+    def test_expired_otp(self):
+        otp_manager.OTPManager.send_otp(self.email, "127.0.0.1")
+        otp = self.otp()
+        self.redis.pexpire(f"OTP:{self.email}", 1)
+        time.sleep(0.01)
+        self.assertEqual(otp_manager.OTPManager.verify_otp(self.email, otp), (False, "OTP expired or invalid"))
+
+    async def test_async_calls_run_the_same_scripts(self):
+        self.assertEqual(await otp_manager.OTPManager.asend_otp(self.email, "127.0.0.1"), (True, "OTP sent successfully"))
+        self.assertFalse((await otp_manager.OTPManager.asend_otp(self.email, "127.0.0.1"))[0])
+        self.assertEqual(await otp_manager.OTPManager.averify_otp(self.email, self.otp()), (True, "OTP verified successfully"))
+
+
+@override_settings(REDIS_MAX_CONNECTIONS=2, REDIS_POOL_TIMEOUT=0.1, REDIS_HEALTH_CHECK_INTERVAL=0)
+class RedisPoolTests(SimpleTestCase):
+    """The pools as redis_pool builds them, on fakeredis connections (which answer no health check PING)"""
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        patchers = [
+            mock.patch.object(redis_pool, "_pool", None),
+            mock.patch.object(redis_pool, "_async_pools", weakref.WeakKeyDictionary()),
+            mock.patch.object(
+                redis_pool.BlockingConnectionPool, "from_url",
+                lambda url, **kwargs: redis_pool.BlockingConnectionPool(connection_class=fakeredis.FakeConnection, server=server, **kwargs),
+            ),
+            mock.patch.object(
+                redis_pool.redis.asyncio.BlockingConnectionPool, "from_url",
+                lambda url, **kwargs: redis_pool.redis.asyncio.BlockingConnectionPool(
+                    connection_class=fakeredis.FakeAsyncConnection, server=server, **kwargs,
+                ),
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_one_bounded_pool_per_process(self):
+        first, second = redis_pool.get_redis(), redis_pool.get_redis()
+        self.assertIs(first.connection_pool, second.connection_pool)
+        self.assertIs(redis_pool.SharedConnectionFactory({}).get_or_create_connection_pool({"url": settings.REDIS_URL}), redis_pool.get_pool())
+        first.set("k", "v")
+        self.assertEqual(second.get("k"), b"v")
+
+        # every connection out: the next caller waits REDIS_POOL_TIMEOUT, then fails
+        pool = redis_pool.get_pool()
+        held = [pool.get_connection() for _ in range(2)]
+        self.assertEqual(redis_pool.pool_stats()["in_use"], 2)
+        start = time.monotonic()
+        with self.assertRaisesMessage(redis.ConnectionError, "No connection available"):
+            first.get("k")
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        for held_connection in held:
+            pool.release(held_connection)
+        self.assertEqual(first.get("k"), b"v")
+
+    def test_one_async_pool_per_event_loop(self):
+        async def pools():
+            first, second = redis_pool.get_async_redis(), redis_pool.get_async_redis()
+            await first.set("k", "v")
+            self.assertEqual(await second.get("k"), b"v")
+            return first.connection_pool, second.connection_pool
+
+        first, second = asyncio.run(pools())
+        self.assertIs(first, second)
+        self.assertEqual(first.max_connections, 2)
+        self.assertIsNot(asyncio.run(pools())[0], first)
+
+
+@override_settings(**TEST_SETTINGS)
+class AsyncViewTests(TestCase):
+    """The ASGI views end to end, on fakeredis and the fake gateway"""
+    email = "aman250001@akgec.ac.in"
+
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.redis = fake_redis(self, otp_manager, mail_queue, rate_limit, orders, payment_status)
+        self.factory = AsyncRequestFactory()
+
+    async def post(self, view, data):
+        request = self.factory.post("/", data=json.dumps(data), content_type="application/json")
+        response = await view.as_view()(request)
+        return response.status_code, json.loads(response.content)
+
+    async def test_otp_then_registration(self):
+        self.assertEqual(await self.post(async_views.SendOTPAsyncView, {"email": self.email}), (200, {"success": True, "message": "OTP sent successfully"}))
+        status, body = await self.post(async_views.SendOTPAsyncView, {"email": self.email})
+        self.assertEqual(status, 429)
+        self.assertRegex(body["message"], r"^Wait \d+ seconds before requesting again$")
+
+        data = {
+            "name": "Aman Kumar", "email": self.email, "student_number": "250001", "phone": "9800000001",
+            "branch": "CSE", "gender": "MALE", "otp": "000000",
+        }
+        otp = self.redis.get(f"OTP:{self.email}").decode()
+        if otp == data["otp"]:
+            data["otp"] = "111111"
+        self.assertEqual(await self.post(async_views.VerifyOTPAsyncView, data), (400, {"detail": "Invalid OTP. 2 attempts left"}))
+        status, body = await self.post(async_views.VerifyOTPAsyncView, {**data, "otp": otp})
+        self.assertEqual(status, 200, body)
+        self.assertTrue((await Student.objects.aget(pk=body["id"])).is_email_verified)
+
+    async def test_payment_initiation_reuses_the_open_order(self):
+        student = await sync_to_async(make_student)()
+        with mock.patch.object(checks, "averify_recaptcha", return_value=True):
+            status, order = await self.post(async_views.PaymentInitiationAsyncView, {"student_id": student.pk, "recaptcha_token": "t"})
+            self.assertEqual(status, 200, order)
+            self.assertEqual(await self.post(async_views.PaymentInitiationAsyncView, {"student_id": student.pk, "recaptcha_token": "t"}), (200, order))
+        self.assertEqual(self.redis.get(f"{payment_status.ORDER_PREFIX}{order['id']}"), str(student.pk).encode())
+
+
+@override_settings(**TEST_SETTINGS, RECAPTCHA_ACTION="create_order")
+class RecaptchaTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(recaptcha, "breaker", CircuitBreaker("recaptcha", failure_threshold=2, reset_timeout=0.05))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(recaptcha.session, "post")
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.answer({"success": True, "action": "create_order", "score": 0.9})
+
+    def answer(self, result):
+        self.post.return_value.json.return_value = result
+        self.post.side_effect = None
+
+    def test_token_is_single_use(self):
+        self.assertTrue(recaptcha.verify_recaptcha("token-1", "create_order"))
+        before = metrics.recaptcha_replays.values.get((), 0)
+        self.assertFalse(recaptcha.verify_recaptcha("token-1", "create_order"))
+        self.assertEqual(self.post.call_count, 1)
+        self.assertEqual(metrics.recaptcha_replays.values.get((), 0), before + 1)
+
+    def test_action_and_score_must_match(self):
+        self.assertFalse(recaptcha.verify_recaptcha("token-1", "login"))
+        self.answer({"success": True, "action": "create_order", "score": 0.1})
+        self.assertFalse(recaptcha.verify_recaptcha("token-2", "create_order"))
+        self.answer({"success": True, "score": 0.9})
+        self.assertFalse(recaptcha.verify_recaptcha("token-3", "create_order"))
+
+    def test_breaker_opens_then_lets_a_trial_through(self):
+        self.post.side_effect = requests.ConnectionError("unreachable")
+        self.assertFalse(recaptcha.verify_recaptcha("token-1", "create_order"))
+        self.assertFalse(recaptcha.verify_recaptcha("token-2", "create_order"))
+        self.assertEqual(recaptcha.breaker.state, CircuitBreaker.OPEN)
+        with override_settings(RECAPTCHA_FAIL_OPEN=True):
+            self.assertTrue(recaptcha.verify_recaptcha("token-3", "create_order"))
+        self.assertEqual(self.post.call_count, 2)
+
+        time.sleep(0.06)
+        self.answer({"success": True, "action": "create_order", "score": 0.9})
+        self.assertTrue(recaptcha.verify_recaptcha("token-4", "create_order"))
+        self.assertEqual(recaptcha.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_async_verification(self):
+        calls = []
+
+        def siteverify(request):
+            calls.append(request)
+            return httpx.Response(200, json={"success": True, "action": "create_order", "score": 0.9})
+
+        async def verify(*tokens):
+            client = httpx.AsyncClient(transport=httpx.MockTransport(siteverify))
+            with mock.patch.object(recaptcha, "async_client", return_value=client):
+                return [await recaptcha.averify_recaptcha(token, "create_order") for token in tokens]
+
+        self.assertEqual(asyncio.run(verify("token-1", "token-1", "token-2")), [True, False, True])
+        self.assertEqual(len(calls), 2)
+
+
+class RazorpayAnswers(requests.adapters.BaseAdapter):
+    """Transport of a requests session answering from a script: exceptions are raised, (status, body) returned"""
+
+    def __init__(self, *answers):
+        super().__init__()
+        self.answers = list(answers)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request.method, request.url))
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        response = requests.Response()
+        response.status_code, body = answer
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = "application/json"
+        response.request, response.url = request, request.url
+        return response
+
+    def close(self):
+        pass
+
+
+ORDER = {"id": "order_1", "entity": "order", "amount": 50000, "receipt": "receipt_1"}
+
+
+@override_settings(RAZORPAY_KEY_ID="rzp_test", RAZORPAY_KEY_SECRET="secret", RAZORPAY_MAX_RETRIES=2, RAZORPAY_RETRY_BACKOFF=0)
+class RazorpayGatewayTests(SimpleTestCase):
+    def create(self, *answers):
+        gateway = payment_gateway.RazorpayGateway()
+        transport = RazorpayAnswers(*answers)
+        gateway.client.session.mount("https://", transport)
+        try:
+            return gateway.create_order(50000, "receipt_1"), [method for method, _ in transport.requests]
+        finally:
+            self.assertEqual(transport.answers, [], "every scripted answer is used")
+
+    def test_timeout_retries_by_receipt_lookup(self):
+        # the timed out attempt did create the order, the lookup finds it
+        order, calls = self.create(requests.ReadTimeout("slow"), (200, {"items": [ORDER]}))
+        self.assertEqual((order, calls), (ORDER, ["POST", "GET"]))
+
+    def test_server_error_retries(self):
+        order, calls = self.create((502, {"error": {"code": "SERVER_ERROR"}}), (200, {"items": []}), (200, ORDER))
+        self.assertEqual((order, calls), (ORDER, ["POST", "GET", "POST"]))
+
+        with self.assertRaises(payment_gateway.GatewayError):
+            self.create(
+                requests.ConnectionError("refused"),
+                requests.ConnectionError("refused"), requests.ConnectionError("refused"),
+            )
+
+    def test_answered_errors_are_final(self):
+        for status, code in ((401, "UNAUTHORIZED"), (429, "TOO_MANY_REQUESTS"), (400, "BAD_REQUEST_ERROR")):
+            with self.subTest(status=status), self.assertRaises(Exception) as raised:
+                self.create((status, {"error": {"code": code, "description": "no"}}))
+            self.assertNotIsInstance(raised.exception, payment_gateway.RetryableGatewayError)
+
+    def test_async_retries_only_unknown_outcomes(self):
+        def acreate(*answers):
+            calls = []
+
+            def razorpay_api(request):
+                calls.append(request.method)
+                answer = answers[len(calls) - 1]
+                if isinstance(answer, Exception):
+                    raise answer
+                return httpx.Response(answer[0], json=answer[1])
+
+            async def run():
+                client = httpx.AsyncClient(transport=httpx.MockTransport(razorpay_api))
+                with mock.patch.object(payment_gateway, "async_client", return_value=client):
+                    return await payment_gateway.RazorpayGateway().acreate_order(50000, "receipt_1")
+            try:
+                return asyncio.run(run()), calls
+            finally:
+                self.assertEqual(len(calls), len(answers))
+
+        self.assertEqual(acreate(httpx.ConnectError("refused"), (200, {"items": [ORDER]})), (ORDER, ["POST", "GET"]))
+        self.assertEqual(acreate((503, {}), (200, {"items": []}), (200, ORDER)), (ORDER, ["POST", "GET", "POST"]))
+        with self.assertRaisesMessage(payment_gateway.GatewayError, "no") as raised:
+            acreate((401, {"error": {"description": "no"}}))
+        self.assertNotIsInstance(raised.exception, payment_gateway.RetryableGatewayError)
+
+
+@override_settings(**TEST_SETTINGS, RAZORPAY_WEBHOOK_SECRET="test")
+class WebhookLedgerTests(TestCase):
+    def setUp(self):
+        payment_gateway.reset_gateway()
+        self.student = make_student(razorpay_order_id="order_1")
+        patcher = mock.patch.object(payment_status, "publish_order")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def status(self):
+        return Student.objects.values_list("payment_status", flat=True).get(pk=self.student.pk)
+
+    def test_redelivery_is_a_duplicate(self):
+        self.assertEqual(webhooks.apply_payment_event("payment.captured", "order_1", "pay_1", "evt_1"), webhooks.APPLIED)
+        self.assertEqual(webhooks.apply_payment_event("payment.captured", "order_1", "pay_1", "evt_1"), webhooks.DUPLICATE)
+        with mock.patch.object(payment_status, "publish"):
+            self.assertEqual(webhooks.apply_payment_events([("payment.captured", "order_1", "pay_1", "evt_1")] * 2), (0, set()))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_failed_never_downgrades_success(self):
+        webhooks.apply_payment_event("payment.captured", "order_1", "pay_1")
+        self.assertEqual(webhooks.apply_payment_event("payment.failed", "order_1", "pay_2"), webhooks.UNCHANGED)
+        with mock.patch.object(payment_status, "publish"):
+            webhooks.apply_payment_events([("payment.failed", "order_1", "pay_3", None)])
+        self.assertEqual(self.status(), "SUCCESS")
+        self.assertEqual(Student.objects.values_list("razorpay_payment_id", flat=True).get(pk=self.student.pk), "pay_1")
+
+    def test_batch_with_failure_and_capture_ends_in_success(self):
+        with mock.patch.object(payment_status, "publish"):
+            webhooks.apply_payment_events([
+                ("payment.captured", "order_1", "pay_2", None),
+                ("payment.failed", "order_1", "pay_1", None),
+            ])
+        self.assertEqual(self.status(), "SUCCESS")
+
+    def test_failure_then_retry_succeeds(self):
+        self.assertEqual(webhooks.apply_payment_event("payment.failed", "order_1", "pay_1"), webhooks.APPLIED)
+        self.assertEqual(self.status(), "FAILED")
+        self.assertEqual(webhooks.apply_payment_event("payment.captured", "order_1", "pay_2"), webhooks.APPLIED)
+        self.assertEqual(self.status(), "SUCCESS")
+
+    def test_single_event_queues_the_ticket(self):
+        redis = fake_redis(self, tickets)
+        with self.captureOnCommitCallbacks(execute=True):
+            webhooks.apply_payment_event("payment.failed", "order_1", "pay_1")
+        self.assertEqual(redis.smembers(tickets.QUEUE_KEY), set())
+        with self.captureOnCommitCallbacks(execute=True):
+            webhooks.apply_payment_event("payment.captured", "order_1", "pay_2")
+        self.assertEqual(redis.smembers(tickets.QUEUE_KEY), {str(self.student.pk).encode()})
+
+    def test_view_queues_or_applies_inline(self):
+        body = webhook_body("payment.captured", "order_1", "pay_1").encode()
+        signature = payment_gateway.get_gateway().sign_webhook(body)
+
+        def post(signature):
+            return self.client.post(
+                "/api/users/razorpay-webhook/", body, content_type="application/json", headers={"X-Razorpay-Signature": signature},
+            )
+
+        self.assertEqual(post("forged").status_code, 400)
+
+        redis = fake_redis(self, webhook_stream)
+        self.assertEqual(post(signature).json(), {"detail": "OK , Queued"})
+        self.assertEqual(redis.xlen(webhook_stream.STREAM_KEY), 1)
+        self.assertEqual(self.status(), "PENDING")
+
+        # Redis down: applied inline, a redelivery is a duplicate
+        with mock.patch.object(webhook_stream, "append", side_effect=ConnectionError("down")):
+            self.assertEqual(post(signature).json(), {"detail": "OK , Payment Verified"})
+            self.assertEqual(post(signature).json(), {"detail": "OK , Already processed"})
+        self.assertEqual(self.status(), "SUCCESS")
+
+
+@override_settings(**TEST_SETTINGS, PAYMENT_STATUS_MAX_WAIT=5)
+class PaymentStatusPushTests(TestCase):
+    def setUp(self):
+        self.redis = fake_redis(self, payment_status, rate_limit)
+        self.student = make_student(razorpay_order_id="order_1")
+        self.factory = AsyncRequestFactory()
+
+    def test_read_through_fill_never_overwrites_a_published_status(self):
+        payment_status.publish({self.student.pk: "SUCCESS"})
+        payment_status.remember(self.student.pk, "PENDING", "order_1")  # a row read before the webhook committed
+        self.assertEqual(payment_status.get_status(self.student.pk), "SUCCESS")
+        self.assertEqual(self.redis.get(f"{payment_status.ORDER_PREFIX}order_1"), str(self.student.pk).encode())
+
+        self.redis.delete(payment_status._key(self.student.pk))
+        self.assertEqual(payment_status.get_status(self.student.pk), "PENDING")  # filled from the row
+
+    async def stop_listener(self):
+        payment_status._listener().task.cancel()
+
+    async def test_long_poll_answers_on_change(self):
+        async def change():
+            await asyncio.sleep(0.1)
+            payment_status.publish({self.student.pk: "SUCCESS"})
+
+        request = self.factory.get("/", {"wait": 5})
+        start = time.monotonic()
+        response, _ = await asyncio.gather(
+            async_views.PaymentStatusAsyncView.as_view()(request, student_id=self.student.pk), change(),
+        )
+        self.assertEqual(json.loads(response.content), {"id": self.student.pk, "payment_status": "SUCCESS"})
+        self.assertLess(time.monotonic() - start, 3)
+
+        # nothing to wait for once paid
+        response = await async_views.PaymentStatusAsyncView.as_view()(self.factory.get("/", {"wait": 5}), student_id=self.student.pk)
+        self.assertEqual(json.loads(response.content)["payment_status"], "SUCCESS")
+        await self.stop_listener()
+
+    async def test_event_stream_pushes_each_change_until_final(self):
+        response = await async_views.PaymentStatusEventsAsyncView.as_view()(self.factory.get("/"), student_id=self.student.pk)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = aiter(response.streaming_content)
+        self.assertIn(b'"payment_status": "PENDING"', await anext(events))
+        for status in ("FAILED", "SUCCESS"):
+            payment_status.publish({self.student.pk: status})
+            chunk = await anext(events)
+            while chunk.startswith(b": keepalive"):
+                chunk = await anext(events)
+            self.assertEqual(chunk.decode(), async_views.sse("status", {"id": self.student.pk, "payment_status": status}))
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+        await self.stop_listener()
 
-# Create your tests here.
@@ -1,10 +1,18 @@
 from django.urls import path
-from .views import SendOTPView, VerifyOTPAPIView , PaymentInitiationAPIView ,RazorpayWebhookAPIView , PaymentStatusAPIView #, test_email
+from .views import SendOTPView, OTPStatusView, VerifyOTPAPIView , PaymentInitiationAPIView ,RazorpayWebhookAPIView , PaymentStatusAPIView, MetricsView, CheckinView, CheckinSyncView, WaitingRoomView, WaitingRoomStatusView, TicketView, export_students #, test_email
 urlpatterns = [
     #path("test-email/", test_email, name="test_email"),
     path('send-otp/', SendOTPView.as_view(), name='send-otp'),
+    path('otp-status/', OTPStatusView.as_view(), name='otp-status'),
     path('verify-otp/', VerifyOTPAPIView.as_view(), name='verify-otp'),
     path('payment-initiation/', PaymentInitiationAPIView.as_view(), name='payment-initiation'),
     path('razorpay-webhook/', RazorpayWebhookAPIView.as_view(), name='razorpay-webhook'),   
-    path('payment-status/', PaymentStatusAPIView.as_view(), name='payment-status'),
+    path('payment-status/<int:student_id>/', PaymentStatusAPIView.as_view(), name='payment-status'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('checkin/', CheckinView.as_view(), name='checkin'),
+    path('checkin/sync/', CheckinSyncView.as_view(), name='checkin-sync'),
+    path('export/', export_students, name='export-students'),
+    path('waiting-room/', WaitingRoomView.as_view(), name='waiting-room'),
+    path('waiting-room/status/', WaitingRoomStatusView.as_view(), name='waiting-room-status'),
+    path('ticket/', TicketView.as_view(), name='ticket'),
 ]
\ No newline at end of file
@@ -0,0 +1,221 @@
+import hashlib
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+from ..models import Student, StudentTombstone
+from . import metrics, timing
+from .redis_pool import get_redis
+
+# Event day check-in.
+#
+# Every paid student gets a signed token (their QR code): "<student id>:<signature>",
+# short enough for a small QR and verified without a lookup. Gates send
+# scans in batches, check_in() answers the whole batch with:
+#   - one Redis SMISMEMBER on the set of checked-in ids, repeated scans stop here
+#   - one conditional UPDATE (paid and not present yet) for the rest
+#   - one SELECT telling apart what the UPDATE took and what it refused
+# The database stays the source of truth, the Redis set only saves round
+# trips and is refilled from the batch results. It expires CHECKIN_PRESENT_TTL
+# after its last write, and a student saved as not present (an admin undoing
+# a scan) or deleted leaves it, so a rescan asks the database again.
+#
+# Gate devices on bad Wi-Fi keep the paid list locally instead: sync_feed()
+# serves a snapshot, then deltas since an updated_at cursor, with a hash of
+# each token so a device verifies scans offline and uploads them later.
+# Deleted students leave a StudentTombstone, which deltas list as removed.
+
+logger = logging.getLogger(__name__)
+
+PRESENT_KEY = "Checkin:present"
+TOKEN_SALT = "users.checkin"
+
+# scan results
+CHECKED_IN = "checked_in"
+DUPLICATE = "duplicate"
+NOT_PAID = "not_paid"
+UNKNOWN = "unknown"
+INVALID = "invalid"
+
+TOKEN_HASH_LENGTH = 16  # hex digits, 64 bits tell a forged token apart
+SYNC_FIELDS = ("id", "student_number", "name", "token_hash", "present")
+
+redis_client = get_redis()
+_signer = signing.Signer(salt=TOKEN_SALT)
+
+
+def issue_token(student_id):
+    return _signer.sign(str(student_id))
+
+
+def token_hash(student_id):
+    """What a gate device compares sha256(scanned token) against, without the signing key"""
+    return hashlib.sha256(issue_token(student_id).encode()).hexdigest()[:TOKEN_HASH_LENGTH]
+
+
+def read_token(token):
+    """Student id inside a check-in token, None if it is not one of ours"""
+    try:
+        return int(_signer.unsign(str(token)))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+@timing.timed("redis")
+def _known_present(student_ids):
+    try:
+        flags = redis_client.smismember(PRESENT_KEY, student_ids)
+    except Exception as e:
+        logger.warning(f"Check-in set unavailable, asking the database: {str(e)}")
+        return set()
+    return {student_id for student_id, flag in zip(student_ids, flags) if flag}
+
+
+@timing.timed("redis")
+def _remember_present(student_ids):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.sadd(PRESENT_KEY, *student_ids)
+        pipe.expire(PRESENT_KEY, settings.CHECKIN_PRESENT_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not add {len(student_ids)} ids to the check-in set: {str(e)}")
+
+
+@timing.timed("redis")
+def forget_present(student_ids):
+    """Drop ids from the check-in set, their next scan is decided by the database"""
+    try:
+        redis_client.srem(PRESENT_KEY, *student_ids)
+    except Exception as e:
+        # expires with the set, until then a rescan reads duplicate
+        logger.warning(f"Could not remove {len(student_ids)} ids from the check-in set: {str(e)}")
+
+
+def _student_saved(sender, instance, created, update_fields=None, **kwargs):
+    # update_fields first: a partially loaded row would fetch is_present
+    if created or (update_fields is not None and 'is_present' not in update_fields):
+        return
+    if not instance.is_present:
+        forget_present([instance.id])
+
+
+def _student_deleted(sender, instance, **kwargs):
+    forget_present([instance.id])
+    StudentTombstone.objects.update_or_create(student_id=instance.id, defaults={"deleted_at": timezone.now()})
+
+
+def connect_signals():
+    """Called from UsersConfig.ready(). QuerySet.update() sends no signal, so
+    check_in()'s own UPDATE and payment updates cost nothing here"""
+    post_save.connect(_student_saved, sender=Student, dispatch_uid="users.checkin.saved")
+    post_delete.connect(_student_deleted, sender=Student, dispatch_uid="users.checkin.deleted")
+
+
+def check_in(tokens):
+    """Check a batch of scanned tokens in, one result per token in order
+
+    A result is {"token", "result"} plus "id" for readable tokens and "name"
+    and "student_number" for the ones the database was asked about.
+    """
+    ids = [read_token(token) for token in tokens]
+    candidates = list(dict.fromkeys(student_id for student_id in ids if student_id is not None))
+    present = _known_present(candidates) if candidates else set()
+
+    rows = {}
+    now = None
+    ask = [student_id for student_id in candidates if student_id not in present]
+    if ask:
+        now = timezone.now()
+        with transaction.atomic():
+            Student.objects.filter(id__in=ask, payment_status='SUCCESS', is_present=False).update(
+                is_present=True, checked_in_at=now, updated_at=now,
+            )
+            # checked_in_at == now marks the rows this UPDATE took, a concurrent gate's differ
+            rows = {
+                row[0]: row for row in Student.objects.filter(id__in=ask)
+                .values_list('id', 'name', 'student_number', 'payment_status', 'is_present', 'checked_in_at')
+            }
+        found = [student_id for student_id, row in rows.items() if row[4]]
+        if found:
+            _remember_present(found)
+
+    results = []
+    seen = set()
+    for token, student_id in zip(tokens, ids):
+        result = {"token": token}
+        if student_id is None:
+            result["result"] = INVALID
+        else:
+            result["id"] = student_id
+            row = rows.get(student_id)
+            if row is not None:
+                result.update(name=row[1], student_number=row[2])
+            if student_id in seen:
+                result["result"] = DUPLICATE
+            elif row is None:
+                result["result"] = DUPLICATE if student_id in present else UNKNOWN
+            elif row[5] == now and row[4]:
+                result["result"] = CHECKED_IN
+            elif row[4]:
+                result["result"] = DUPLICATE
+            else:
+                result["result"] = NOT_PAID
+            seen.add(student_id)
+        metrics.checkins.inc(result=result["result"])
+        results.append(result)
+    return results
+
+
+# Gate device sync
+
+def sync_version():
+    """Changes whenever any student row is written or deleted, the feed's ETag source
+
+    Two index lookups (student_updated_idx and the tombstones' deleted_at),
+    no count of the table.
+    """
+    last = Student.objects.aggregate(last=Max('updated_at'))['last']
+    deleted = StudentTombstone.objects.aggregate(last=Max('deleted_at'))['last']
+    return f"{last.timestamp() if last else 0}-{deleted.timestamp() if deleted else 0}"
+
+
+def sync_feed(since=None):
+    """Paid students for gate devices: all of them, or what changed after `since`
+
+    Rows are lists in SYNC_FIELDS order. A delta also lists the ids that are
+    no longer eligible under "removed" (refunds, admin edits, deletions). The cursor
+    trails now by CHECKIN_SYNC_LAG so a transaction still in flight when the
+    feed was read is picked up by the next delta; devices upsert by id, so
+    the overlap is harmless.
+    """
+    now = timezone.now()
+    rows = Student.objects.values_list('id', 'student_number', 'name', 'payment_status', 'is_present')
+    if since is None:
+        rows = rows.filter(payment_status='SUCCESS')
+    else:
+        rows = rows.filter(updated_at__gt=since)
+
+    students, removed = [], []
+    for student_id, number, name, status, present in rows.order_by('id').iterator(chunk_size=2000):
+        if status == 'SUCCESS':
+            students.append([student_id, number, name, token_hash(student_id), present])
+        else:
+            removed.append(student_id)
+    if since is not None:
+        removed += StudentTombstone.objects.filter(deleted_at__gt=since).order_by('student_id').values_list('student_id', flat=True)
+
+    cursor = now - timedelta(seconds=settings.CHECKIN_SYNC_LAG)
+    if since is not None:
+        cursor = max(cursor, since)
+    return {
+        "full": since is None,
+        "cursor": cursor.isoformat(),
+        "fields": SYNC_FIELDS,
+        "students": students,
+        "removed": removed,
+    }
@@ -0,0 +1,196 @@
+import logging
+import re
+from typing import Callable, NamedTuple, Optional
+from django.conf import settings
+from ..models import Student
+from . import metrics, rate_limit, verification, waiting_room
+from .recaptcha import averify_recaptcha, verify_recaptcha
+
+# Request checks of the users endpoints, run cheapest first.
+#
+# Every check belongs to a stage and a Pipeline runs its checks sorted by
+# stage, so a bot flood is turned away by the shape and format checks before
+# it costs a Redis round trip, a query or an outbound call. The first failing
+# check answers the request and counts a rejection for its stage.
+#
+# A check gets the request context (a dict: "data", "ip", plus whatever
+# earlier checks stored, e.g. "student") and returns None to pass or
+# (message, status) or (message, status, retry after seconds) to reject.
+
+SHAPE, FORMAT, REDIS, DATABASE, OUTBOUND = range(5)
+STAGE_NAMES = ("shape", "format", "redis", "database", "outbound")
+
+OTP_PATTERN = re.compile(r"\d{6}", re.ASCII)
+
+logger = logging.getLogger(__name__)
+
+
+class Check(NamedTuple):
+    stage: int
+    name: str
+    fn: Callable
+    afn: Optional[Callable] = None  # async version, needed for every check doing I/O
+
+
+class Pipeline:
+    def __init__(self, endpoint, checks, reply=lambda message: {"detail": message}):
+        self.endpoint = endpoint
+        self.checks = sorted(checks, key=lambda check: check.stage)  # stable, declaration order within a stage
+        self.reply = reply
+
+    def run(self, ctx):
+        """None if every check passed, otherwise (response body, status, headers) of the first failure"""
+        ctx["endpoint"] = self.endpoint
+        for check in self.checks:
+            rejection = check.fn(ctx)
+            if rejection is not None:
+                return self.reject(check, rejection)
+        return None
+
+    async def arun(self, ctx):
+        ctx["endpoint"] = self.endpoint
+        for check in self.checks:
+            rejection = await check.afn(ctx) if check.afn else check.fn(ctx)
+            if rejection is not None:
+                return self.reject(check, rejection)
+        return None
+
+    def reject(self, check, rejection):
+        message, status, *retry_after = rejection
+        metrics.validation_rejections.inc(endpoint=self.endpoint, stage=STAGE_NAMES[check.stage], check=check.name)
+        headers = {"Retry-After": str(retry_after[0])} if retry_after else {}
+        return self.reply(message), status, headers
+
+
+# shape: fields present and of the right type, no I/O
+
+def required(*fields, message=None):
+    message = message or f"{' and '.join(fields)} {'is' if len(fields) == 1 else 'are'} required"
+
+    def check(ctx):
+        if any(not ctx["data"].get(field) for field in fields):
+            return message, 400
+    return Check(SHAPE, "required", check)
+
+
+def integer(field):
+    def check(ctx):
+        value = ctx["data"].get(field)
+        # isdigit alone takes "²" or Arabic-Indic digits, which int() then refuses
+        if isinstance(value, bool) or not (str(value).isascii() and str(value).isdigit()):
+            return f"{field} must be a number", 400
+    return Check(SHAPE, "integer", check)
+
+
+def otp_format():
+    def check(ctx):
+        if not OTP_PATTERN.fullmatch(str(ctx["data"].get("otp"))):
+            return "Invalid OTP", 400
+    return Check(SHAPE, "otp_format", check)
+
+
+# format: precompiled patterns, no I/O
+
+def college_email(message=None):
+    def check(ctx):
+        error = verification.email_error(ctx["data"].get("email"))
+        if error:
+            return message or error, 400
+    return Check(FORMAT, "college_email", check)
+
+
+# redis: one script call for blocklist, rate limits and cooldown, see rate_limit
+
+TOO_MANY_REQUESTS = "Too many requests. Please try again later."
+
+
+def _gate_result(result, retry_after):
+    if result == rate_limit.BLOCKED:
+        return "Not allowed", 403
+    if result == rate_limit.LIMITED:
+        return TOO_MANY_REQUESTS, 429, retry_after
+    if result == rate_limit.COOLDOWN:
+        return f"Wait {retry_after} seconds before requesting again", 429, retry_after
+    return None
+
+
+def redis_gate(*limits, cooldown=False):
+    """Blocklisted IP or email, the endpoint's rate limits and, with
+    cooldown=True, an OTP still cooling down
+
+    Fails open: without Redis the view's own calls decide.
+    """
+    def cooldown_key(ctx):
+        return f"Cooldown:{ctx['data'].get('email')}" if cooldown else None
+
+    def check(ctx):
+        try:
+            return _gate_result(*rate_limit.gate(ctx["endpoint"], limits, ctx, cooldown_key(ctx)))
+        except Exception as e:
+            logger.warning(f"Redis gate skipped: {str(e)}")
+
+    async def acheck(ctx):
+        try:
+            return _gate_result(*await rate_limit.agate(ctx["endpoint"], limits, ctx, cooldown_key(ctx)))
+        except Exception as e:
+            logger.warning(f"Redis gate skipped: {str(e)}")
+    return Check(REDIS, "gate", check, acheck)
+
+
+def admitted():
+    """While the waiting room is on, an admission token in ctx["admission"]
+    issued to ctx["ip"], with uses left, see waiting_room
+
+    Declared after redis_gate, a rate limited request does not spend a use.
+    """
+    message = "Join the waiting room first"
+
+    def check(ctx):
+        if settings.WAITING_ROOM_ENABLED and not waiting_room.is_admitted(ctx.get("admission"), ctx["ip"]):
+            return message, 429
+
+    async def acheck(ctx):
+        if settings.WAITING_ROOM_ENABLED and not await waiting_room.ais_admitted(ctx.get("admission"), ctx["ip"]):
+            return message, 429
+    return Check(REDIS, "admitted", check, acheck)
+
+
+# database: one SELECT, the row is kept in ctx["student"] for the view
+
+PAYABLE_FIELDS = ('id', 'is_email_verified', 'payment_status', 'razorpay_order_id')
+
+def _payable(student):
+    if student is None:
+        return "Student not found", 404
+    if not student.is_email_verified:
+        return "Email not verified", 400
+    if student.payment_status == 'SUCCESS':
+        return "Payment already completed, You are registered", 400
+    return None
+
+
+def payable_student():
+    """Student exists, verified the email and has not paid yet"""
+    def check(ctx):
+        ctx["student"] = Student.objects.filter(id=ctx["data"].get("student_id")).only(*PAYABLE_FIELDS).first()
+        return _payable(ctx["student"])
+
+    async def acheck(ctx):
+        ctx["student"] = await Student.objects.filter(id=ctx["data"].get("student_id")).only(*PAYABLE_FIELDS).afirst()
+        return _payable(ctx["student"])
+    return Check(DATABASE, "payable_student", check, acheck)
+
+
+# outbound: network calls to third parties, always last
+
+def recaptcha():
+    """A fresh reCAPTCHA token for settings.RECAPTCHA_ACTION"""
+    def check(ctx):
+        if not verify_recaptcha(ctx["data"].get("recaptcha_token"), settings.RECAPTCHA_ACTION):
+            return "Invalid reCAPTCHA", 400
+
+    async def acheck(ctx):
+        if not await averify_recaptcha(ctx["data"].get("recaptcha_token"), settings.RECAPTCHA_ACTION):
+            return "Invalid reCAPTCHA", 400
+    return Check(OUTBOUND, "recaptcha", check, acheck)
+
@@ -0,0 +1,85 @@
+from django.db import OperationalError, connections
+from . import metrics
+
+try:
+    from psycopg_pool import PoolTimeout
+except ImportError:  # psycopg2, or psycopg without the pool extra
+    PoolTimeout = None
+
+# Database connection pool (settings.DATABASE_POOL):
+#   - "psycopg": Django's psycopg 3 pool, DATABASE_POOL_MAX_SIZE connections
+#     per process, connections are checked before they are handed out
+#   - "pgbouncer": persistent, health checked connections to a pgbouncer in
+#     transaction pooling mode
+#   - unset: one persistent, health checked connection per thread
+#
+# A request that finds no connection in time gets a 503 from
+# users.middleware.DatabaseBusyMiddleware instead of a 500. The pool's own
+# counters are turned into metrics whenever metrics are rendered or flushed.
+
+RETRY_AFTER = 2  # seconds, what a 503 asks the client to wait
+
+# what Postgres and pgbouncer say when they are out of connections
+EXHAUSTED_MESSAGES = (
+    "too many clients already",
+    "remaining connection slots are reserved",
+    "no more connections allowed",
+    "query_wait_timeout",
+)
+
+
+def is_exhausted(exception):
+    """True for a database error that means "no connection free", retrying later may work"""
+    if not isinstance(exception, OperationalError):
+        return False
+    if PoolTimeout is not None and isinstance(exception.__cause__, PoolTimeout):
+        return True
+    message = str(exception)
+    return any(marker in message for marker in EXHAUSTED_MESSAGES)
+
+
+def pools():
+    """{alias: pool} of the pools this process opened, none for unpooled databases"""
+    return {
+        alias: pool
+        for alias in connections
+        if (pool := getattr(connections[alias], "_connection_pools", {}).get(alias)) is not None
+    }
+
+
+pool_connections = metrics.Gauge(
+    "db_pool_connections", "Connections of the database pool, in use (or being opened) and idle", ("alias", "state"),
+)
+pool_max_connections = metrics.Gauge(
+    "db_pool_max_connections", "Largest size the database pool may grow to", ("alias",),
+)
+pool_waiting = metrics.Gauge(
+    "db_pool_waiting", "Requests waiting for a database connection", ("alias",),
+)
+pool_checkouts = metrics.Counter(
+    "db_pool_checkouts_total", "Connections handed out by the database pool", ("alias",),
+)
+pool_checkout_wait = metrics.Counter(
+    "db_pool_checkout_wait_seconds_total", "Time requests waited for a database connection", ("alias",),
+)
+pool_checkout_errors = metrics.Counter(
+    "db_pool_checkout_errors_total", "Connection requests that timed out or failed", ("alias",),
+)
+pool_bad_connections = metrics.Counter(
+    "db_pool_bad_connections_total", "Connections dropped by a health check or returned broken", ("alias",),
+)
+
+
+@metrics.collector
+def collect_pool_stats():
+    for alias, pool in pools().items():
+        stats = pool.pop_stats()  # counters restart at zero, added to ours
+        in_use = stats.get("pool_size", 0) - stats.get("pool_available", 0)
+        pool_connections.set(in_use, alias=alias, state="in_use")
+        pool_connections.set(stats.get("pool_available", 0), alias=alias, state="idle")
+        pool_max_connections.set(stats.get("pool_max", 0), alias=alias)
+        pool_waiting.set(stats.get("requests_waiting", 0), alias=alias)
+        pool_checkouts.inc(stats.get("requests_num", 0), alias=alias)
+        pool_checkout_wait.inc(stats.get("requests_wait_ms", 0) / 1000, alias=alias)
+        pool_checkout_errors.inc(stats.get("requests_errors", 0), alias=alias)
+        pool_bad_connections.inc(stats.get("connections_lost", 0) + stats.get("returns_bad", 0), alias=alias)
@@ -0,0 +1,195 @@
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+from ..models import Student
+
+# Registration export for organizers, streamed: rows come off a server-side
+# cursor (values_list, no model instances) and leave as CSV or XLSX chunks,
+# so memory stays flat whatever the row count and the first bytes go out
+# before the query has finished.
+
+COLUMNS = (
+    'id', 'name', 'email', 'phone', 'student_number', 'branch', 'gender', 'hostler',
+    'payment_status', 'is_present', 'checked_in_at', 'razorpay_order_id', 'razorpay_payment_id', 'created_at',
+)
+CHUNK_SIZE = 2000  # rows per cursor fetch
+ROWS_PER_WRITE = 500  # rows per chunk handed to the response
+
+# query parameter -> (field, parser); a parser returns None for a bad value
+FILTERS = {
+    'payment_status': ('payment_status', lambda value: value if value in dict(Student.PAYMENT_STATUS_CHOICES) else None),
+    'branch': ('branch', lambda value: value if value in dict(Student.BRANCH_CHOICES) else None),
+    'hostler': ('hostler', lambda value: {'true': True, 'false': False}.get(value.lower())),
+    'present': ('is_present', lambda value: {'true': True, 'false': False}.get(value.lower())),
+}
+
+
+def parse_filters(params):
+    """({field: value}, None) from query parameters, or (None, error)"""
+    filters = {}
+    for name, (field, parse) in FILTERS.items():
+        raw = params.get(name)
+        if raw is None or raw == '':
+            continue
+        value = parse(raw)
+        if value is None:
+            return None, f"Invalid {name}: {raw}"
+        filters[field] = value
+    return filters, None
+
+
+def rows(filters):
+    return (
+        Student.objects.filter(**filters)
+        .order_by('id')
+        .values_list(*COLUMNS)
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == ROWS_PER_WRITE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# CSV
+
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _csv_cell(value):
+    value = _cell(value)
+    # a name like "=HYPERLINK(...)" must stay text when the file is opened in a spreadsheet
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_stream(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+    for batch in _batches(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_cell(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+
+
+# XLSX: a minimal SpreadsheetML package written straight into a streamed zip,
+# no spreadsheet library; cells are inline strings and numbers
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Registrations" sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>'
+)
+WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '</Relationships>'
+)
+SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+SHEET_END = '</sheetData></worksheet>'
+
+# control characters XML 1.0 cannot carry, even escaped
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _xlsx_cell(value):
+    value = _cell(value)
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, int):
+        return f'<c><v>{value}</v></c>'
+    return f'<c t="inlineStr"><is><t>{escape(XML_ILLEGAL.sub("", str(value)))}</t></is></c>'
+
+
+def _xlsx_row(row):
+    return '<row>' + ''.join(_xlsx_cell(value) for value in row) + '</row>'
+
+
+class _Drain(io.RawIOBase):
+    """Write-only, unseekable file: zipfile writes into it, the stream takes what was written"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def xlsx_stream(rows):
+    drain = _Drain()
+    with zipfile.ZipFile(drain, 'w', compression=zipfile.ZIP_DEFLATED) as package:
+        for name, content in (
+            ('[Content_Types].xml', CONTENT_TYPES),
+            ('_rels/.rels', ROOT_RELS),
+            ('xl/workbook.xml', WORKBOOK),
+            ('xl/_rels/workbook.xml.rels', WORKBOOK_RELS),
+        ):
+            package.writestr(name, content)
+        # force_zip64: the sheet's size is unknown until the last row
+        with package.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((SHEET_START + _xlsx_row(COLUMNS)).encode())
+            yield drain.take()
+            for batch in _batches(rows):
+                sheet.write(''.join(_xlsx_row(row) for row in batch).encode())
+                data = drain.take()
+                if data:  # the compressor holds small writes back
+                    yield data
+            sheet.write(SHEET_END.encode())
+    yield drain.take()
+
+
+FORMATS = {
+    'csv': (csv_stream, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_stream, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
@@ -0,0 +1,32 @@
+import asyncio
+import weakref
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive HTTP clients for outbound calls, one per process (sync) or per
+# event loop (async), so every request reuses warm TLS connections instead of
+# opening a new one.
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def pooled_session(pool_size):
+    """requests.Session with a bounded keep-alive pool, no automatic retries"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def async_client(name, pool_size, timeout):
+    """httpx.AsyncClient for the running event loop, created on first use"""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    if name not in clients:
+        clients[name] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+    return clients[name]
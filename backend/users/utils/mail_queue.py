@@ -0,0 +1,102 @@
+import json
+import time
+import uuid
+from . import timing
+from .otp_manager import redis_client
+
+# Redis keys used by the OTP mail queue
+QUEUE_KEY = "MailQueue:pending"  # list, LPUSH on enqueue, worker pops from the right
+RETRY_KEY = "MailQueue:retry"  # zset, score = unix time the job is due again
+PROCESSING_PREFIX = "MailQueue:processing:"  # list per worker, holds the job being sent
+STATUS_PREFIX = "MailStatus:"  # hash per email, delivery state for the API
+
+# Job kinds. Only an OTP mail is superseded by a newer one for the same email;
+# other kinds keep a status of their own, MailStatus:<kind>:<email>
+OTP = "otp"
+CONFIRMATION = "confirmation"
+
+# Delivery states
+QUEUED = "queued"
+SENT = "sent"
+RETRYING = "retrying"
+FAILED = "failed"
+EXPIRED = "expired"
+
+
+def status_key(email, kind=OTP):
+    return f"{STATUS_PREFIX}{email}" if kind == OTP else f"{STATUS_PREFIX}{kind}:{email}"
+
+
+def processing_key(worker_name):
+    return f"{PROCESSING_PREFIX}{worker_name}"
+
+
+def build_job(email, subject, message, ttl, kind=OTP):
+    """Build a mail job, jobs older than ttl are dropped instead of sent"""
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "email": email,
+        "subject": subject,
+        "message": message,
+        "attempts": 0,
+        "created_at": now,
+        "expires_at": now + ttl,
+    }
+
+
+def enqueue(email, subject, message, ttl, kind=OTP):
+    """Push a mail job and mark it queued - one round trip"""
+    job = build_job(email, subject, message, ttl, kind)
+    pipe = redis_client.pipeline()
+    pipe.lpush(QUEUE_KEY, json.dumps(job))
+    _write_status(pipe, job, QUEUED, ttl)
+    pipe.execute()
+    return job["id"]
+
+
+def enqueue_many(mails, ttl, kind=OTP):
+    """enqueue() for a list of (email, subject, message), one round trip for all of them"""
+    jobs = [build_job(email, subject, message, ttl, kind) for email, subject, message in mails]
+    if not jobs:
+        return []
+    pipe = redis_client.pipeline()
+    pipe.lpush(QUEUE_KEY, *[json.dumps(job) for job in jobs])
+    for job in jobs:
+        _write_status(pipe, job, QUEUED, ttl)
+    pipe.execute()
+    return [job["id"] for job in jobs]
+
+
+@timing.timed("redis")
+def get_status(email, kind=OTP):
+    """Delivery state of the latest mail of this kind for this email, or None"""
+    status = redis_client.hgetall(status_key(email, kind))
+    return {key.decode(): value.decode() for key, value in status.items()} or None
+
+
+def is_current(job):
+    """False once a newer OTP mail was queued for the same email, other kinds always are"""
+    if job.get("kind", OTP) != OTP:
+        return True
+    return redis_client.hget(status_key(job["email"]), "job_id") == job["id"].encode()
+
+
+def set_status(job, state, error=""):
+    ttl = max(int(job["expires_at"] - time.time()), 1)
+    pipe = redis_client.pipeline()
+    _write_status(pipe, job, state, ttl, error)
+    pipe.execute()
+
+
+def _write_status(pipe, job, state, ttl, error=""):
+    key = status_key(job["email"], job.get("kind", OTP))
+    pipe.hset(key, mapping={
+        "job_id": job["id"],
+        "state": state,
+        "attempts": job["attempts"],
+        "error": error,
+        "updated_at": int(time.time()),
+    })
+    pipe.expire(key, int(ttl))
@@ -0,0 +1,296 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+
+# Minimal in-process metrics, rendered in the Prometheus text format by
+# MetricsView. Recording is a dict lookup and an add under a lock.
+#
+# Every worker process (gunicorn) has its own values, so a scrape would only
+# see the worker that answered it. With settings.METRICS_DIR set, each process
+# writes its values to a file there (at most every METRICS_FLUSH_INTERVAL
+# seconds, from the request middleware) and MetricsView renders the sum of all
+# files. Gauges describe the present and are only summed over files written in
+# the last GAUGE_MAX_AGE seconds.
+#
+# The gunicorn master keeps the directory from growing (gunicorn.conf.py): it
+# empties it on start, and when a worker exits folds that worker's counters and
+# histograms into ARCHIVE_FILE and deletes its file, so counters never go
+# backwards and there is one file per live worker plus the archive.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+GAUGE_MAX_AGE = 60  # seconds
+ARCHIVE_FILE = "archive.json"  # summed counters and histograms of exited processes
+GAUGES_KEY = "_gauges"  # names of a process file's gauges, the master folds without the registry
+
+REGISTRY = []
+COLLECTORS = []  # functions refreshing metrics from elsewhere (pool stats, ...) before they are read
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, values, snapshot):
+        for key, value in snapshot:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted((self.values if values is None else values).items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """A value that goes up and down, set() rather than inc()"""
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self.values[key] = value
+
+    def render(self, values=None):
+        lines = super().render(values)
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(series)] for key, series in self.values.items()]
+
+    def merge(self, values, snapshot):
+        for key, series in snapshot:
+            key = tuple(key)
+            if len(series) != len(self.buckets) + 2:
+                continue  # written with other buckets, cannot be added up
+            total = values.setdefault(key, [0] * len(series))
+            for i, value in enumerate(series):
+                total[i] += value
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted((self.values if values is None else values).items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + ('+Inf',))} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+def collector(fn):
+    """Decorator registering fn to run before metrics are rendered or flushed"""
+    COLLECTORS.append(fn)
+    return fn
+
+
+def run_collectors():
+    for fn in COLLECTORS:
+        try:
+            fn()
+        except Exception as e:
+            logger.warning(f"Metrics collector {fn.__name__} failed: {str(e)}")
+
+
+def render():
+    if settings.METRICS_DIR:
+        flush()  # runs the collectors
+        merged = collect()
+        return _join(metric.render(merged.get(metric.name, {})) for metric in REGISTRY)
+    run_collectors()
+    return _join(metric.render() for metric in REGISTRY)
+
+
+def _join(rendered):
+    return "\n".join(line for lines in rendered for line in lines) + "\n"
+
+
+# Several processes: one file per process in METRICS_DIR
+
+_process_file = None
+_last_flush = 0.0
+
+
+def process_file():
+    global _process_file
+    if _process_file is None:
+        # the start time keeps a restarted worker that got the same pid from overwriting a dead one's counts
+        _process_file = os.path.join(settings.METRICS_DIR, f"{os.getpid()}-{time.time_ns()}.json")
+    return _process_file
+
+
+def flush():
+    """Write this process' values to its file in METRICS_DIR"""
+    global _last_flush
+    _last_flush = time.monotonic()
+    path = process_file()
+    run_collectors()
+    data = {metric.name: metric.snapshot() for metric in REGISTRY}
+    data[GAUGES_KEY] = [metric.name for metric in REGISTRY if isinstance(metric, Gauge)]
+    try:
+        _write(path, data)
+    except OSError as e:
+        logger.warning(f"Metrics flush to {path} failed: {str(e)}")
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)  # readers never see half a file
+
+
+def maybe_flush():
+    if settings.METRICS_DIR and time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def collect():
+    """{metric name: values} summed over every process file"""
+    metrics = {metric.name: metric for metric in REGISTRY}
+    merged = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+        try:
+            stale = time.time() - os.path.getmtime(path) > GAUGE_MAX_AGE
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, snapshot in data.items():
+            if name in metrics and not (stale and isinstance(metrics[name], Gauge)):
+                metrics[name].merge(merged.setdefault(name, {}), snapshot)
+    return merged
+
+
+# gunicorn master hooks (gunicorn.conf.py)
+
+def clear():
+    """Delete every file in METRICS_DIR, counters start from zero with the server"""
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json*")):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Could not delete metrics file {path}: {str(e)}")
+
+
+def mark_process_dead(pid):
+    """Fold the file of an exited process into ARCHIVE_FILE and delete it
+
+    Counters and histograms are added to the archive, gauges are dropped.
+    Runs in the gunicorn master only, the archive's single writer.
+    """
+    paths = glob.glob(os.path.join(settings.METRICS_DIR, f"{pid}-*.json"))
+    if not paths:
+        return
+    archive = os.path.join(settings.METRICS_DIR, ARCHIVE_FILE)
+    merged = {}
+    for path in [archive, *paths]:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        gauges = set(data.pop(GAUGES_KEY, []))
+        for name, snapshot in data.items():
+            if name not in gauges:
+                _add(merged.setdefault(name, {}), snapshot)
+    try:
+        _write(archive, {name: [[list(key), value] for key, value in values.items()] for name, values in merged.items()})
+        for path in paths:
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not archive the metrics of process {pid}: {str(e)}")
+
+
+def _add(values, snapshot):
+    # a counter's value is a number, a histogram's a list of bucket counts, count and sum
+    for key, value in snapshot:
+        key = tuple(key)
+        total = values.get(key)
+        if total is None:
+            values[key] = value
+        elif isinstance(value, list):
+            if len(value) == len(total):  # other buckets cannot be added up
+                values[key] = [a + b for a, b in zip(total, value)]
+        else:
+            values[key] = total + value
+
+
+# Outbound calls (reCAPTCHA, Razorpay, ...)
+outbound_seconds = Histogram(
+    "outbound_request_seconds", "Latency of outbound HTTP calls", ("service", "outcome"),
+)
+outbound_short_circuits = Counter(
+    "outbound_short_circuit_total", "Outbound calls refused by an open circuit breaker", ("service",),
+)
+recaptcha_replays = Counter(
+    "recaptcha_replays_total", "reCAPTCHA tokens refused without an outbound call, presented before",
+)
+
+# Request validation (users.utils.checks)
+validation_rejections = Counter(
+    "validation_rejections_total", "Requests rejected by a validation check", ("endpoint", "stage", "check"),
+)
+
+# Requests (users.middleware.timing_middleware)
+request_seconds = Histogram(
+    "http_request_seconds", "Time to answer a request", ("endpoint", "method", "status"),
+)
+span_seconds = Histogram(
+    "http_request_span_seconds", "Time a request spent per dependency (db, redis, recaptcha, ...)", ("endpoint", "span"),
+)
+
+# Event day check-in (users.utils.checkin)
+checkins = Counter(
+    "checkin_scans_total", "Scanned check-in tokens by result", ("result",),
+)
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import secrets
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from ..models import PaymentOrder, Student
+from . import payment_status, timing
+from .payment_gateway import get_gateway
+from .redis_pool import aeval, get_async_redis, get_redis
+
+# Razorpay order per student for payment-initiation. A double click or a
+# retry gets the student's open order back instead of a new one:
+#
+#   - Order:<student id> caches the order handed out (JSON, ORDER_REUSE_TTL)
+#   - on a miss, the student's latest order is read back from PaymentOrder
+#   - an order is reused while it is younger than ORDER_REUSE_TTL and was
+#     created for the current REGISTRATION_AMOUNT
+#
+# Creating one holds OrderLock:<student id>, so concurrent initiations for
+# a student make one Razorpay call: the others wait for the order to show up
+# in the cache, up to ORDER_LOCK_WAIT seconds. With Redis down there is no
+# cache and no lock, orders are reused from the database only.
+#
+# Every order is recorded in PaymentOrder, webhooks for any of them find
+# the student (users.utils.webhooks).
+
+logger = logging.getLogger(__name__)
+
+ORDER_PREFIX = "Order:"
+LOCK_PREFIX = "OrderLock:"
+POLL_INTERVAL = 0.05  # seconds between cache reads while another request creates the order
+
+redis_client = get_redis()
+
+# KEYS: lock key; ARGV: token. Deletes the lock only if it is still ours
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+release_script = redis_client.register_script(RELEASE_LUA)
+
+
+class OrderBusy(Exception):
+    """Another request is creating this student's order and has not finished in time"""
+
+
+def _reusable(order, student, amount):
+    return bool(order) and order.get("id") == student.razorpay_order_id and order.get("amount") == amount
+
+
+def _as_order(row):
+    order_id, amount, currency, receipt = row
+    return {"id": order_id, "entity": "order", "amount": amount, "currency": currency, "receipt": receipt}
+
+
+def _recent_orders(student, amount):
+    return PaymentOrder.objects.filter(
+        order_id=student.razorpay_order_id,
+        student_id=student.id,
+        amount=amount,
+        created_at__gte=timezone.now() - timedelta(seconds=settings.ORDER_REUSE_TTL),
+    ).values_list('order_id', 'amount', 'currency', 'receipt')
+
+
+def _save(student, order, receipt):
+    with transaction.atomic():
+        PaymentOrder.objects.create(
+            order_id=order["id"], student_id=student.id, amount=order["amount"],
+            currency=order.get("currency", "INR"), receipt=receipt,
+        )
+        Student.objects.filter(id=student.id).update(razorpay_order_id=order["id"], updated_at=timezone.now())
+    student.razorpay_order_id = order["id"]
+
+
+# Sync
+
+@timing.timed("redis")
+def _cached(student_id):
+    try:
+        raw = redis_client.get(f"{ORDER_PREFIX}{student_id}")
+    except Exception as e:
+        logger.warning(f"Order cache unavailable for {student_id}: {str(e)}")
+        return None
+    return json.loads(raw) if raw else None
+
+
+def _lookup(student, amount):
+    order = _cached(student.id)
+    if _reusable(order, student, amount):
+        return order
+    if student.razorpay_order_id:
+        row = _recent_orders(student, amount).first()
+        if row:
+            return _as_order(row)
+    return None
+
+
+@timing.timed("redis")
+def _lock(student_id, token):
+    """True if we hold the lock, None when Redis is down"""
+    try:
+        return bool(redis_client.set(f"{LOCK_PREFIX}{student_id}", token, nx=True, px=int(settings.ORDER_LOCK_TTL * 1000)))
+    except Exception as e:
+        logger.warning(f"Order lock unavailable for {student_id}, creating without it: {str(e)}")
+        return None
+
+
+@timing.timed("redis")
+def _release(student_id, token):
+    try:
+        release_script(keys=[f"{LOCK_PREFIX}{student_id}"], args=[token], client=redis_client)
+    except Exception as e:
+        logger.warning(f"Could not release order lock of {student_id}, it expires: {str(e)}")
+
+
+@timing.timed("redis")
+def _remember(student, order, token):
+    """Cache the new order, then let go of the lock (waiters read the cache)"""
+    try:
+        redis_client.set(f"{ORDER_PREFIX}{student.id}", json.dumps(order), ex=settings.ORDER_REUSE_TTL)
+        release_script(keys=[f"{LOCK_PREFIX}{student.id}"], args=[token], client=redis_client)
+    except Exception as e:
+        logger.warning(f"Could not cache order of {student.id}: {str(e)}")
+
+
+def order_for(student, amount=None):
+    """(order, created): the student's open Razorpay order, or a new one
+
+    student needs id, payment_status and razorpay_order_id. Raises OrderBusy
+    when a concurrent request holds the lock longer than ORDER_LOCK_WAIT.
+    """
+    amount = amount or settings.REGISTRATION_AMOUNT
+    order = _lookup(student, amount)
+    if order:
+        return order, False
+
+    token = secrets.token_hex(8)
+    locked = _lock(student.id, token)
+    if locked is False:
+        deadline = time.monotonic() + settings.ORDER_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            order = _cached(student.id)
+            if order and order.get("amount") == amount:
+                student.razorpay_order_id = order["id"]
+                return order, False
+        raise OrderBusy()
+
+    try:
+        gateway = get_gateway()
+        receipt = gateway.new_receipt(f"receipt_{student.id}")
+        order = gateway.create_order(amount, receipt)
+        _save(student, order, receipt)
+    except Exception:
+        if locked:
+            _release(student.id, token)
+        raise
+    _remember(student, order, token)
+    # lets the webhook push the new status without looking the student up
+    payment_status.remember(student.id, student.payment_status, order["id"])
+    return order, True
+
+
+# Async
+
+@timing.timed("redis")
+async def _acached(student_id):
+    try:
+        raw = await get_async_redis().get(f"{ORDER_PREFIX}{student_id}")
+    except Exception as e:
+        logger.warning(f"Order cache unavailable for {student_id}: {str(e)}")
+        return None
+    return json.loads(raw) if raw else None
+
+
+async def _alookup(student, amount):
+    order = await _acached(student.id)
+    if _reusable(order, student, amount):
+        return order
+    if student.razorpay_order_id:
+        row = await _recent_orders(student, amount).afirst()
+        if row:
+            return _as_order(row)
+    return None
+
+
+@timing.timed("redis")
+async def _alock(student_id, token):
+    try:
+        return bool(await get_async_redis().set(
+            f"{LOCK_PREFIX}{student_id}", token, nx=True, px=int(settings.ORDER_LOCK_TTL * 1000),
+        ))
+    except Exception as e:
+        logger.warning(f"Order lock unavailable for {student_id}, creating without it: {str(e)}")
+        return None
+
+
+@timing.timed("redis")
+async def _arelease(student_id, token):
+    try:
+        await aeval(release_script, [f"{LOCK_PREFIX}{student_id}"], [token])
+    except Exception as e:
+        logger.warning(f"Could not release order lock of {student_id}, it expires: {str(e)}")
+
+
+@timing.timed("redis")
+async def _aremember(student, order, token):
+    try:
+        await get_async_redis().set(f"{ORDER_PREFIX}{student.id}", json.dumps(order), ex=settings.ORDER_REUSE_TTL)
+        await aeval(release_script, [f"{LOCK_PREFIX}{student.id}"], [token])
+    except Exception as e:
+        logger.warning(f"Could not cache order of {student.id}: {str(e)}")
+
+
+async def aorder_for(student, amount=None):
+    """order_for for the async views"""
+    amount = amount or settings.REGISTRATION_AMOUNT
+    order = await _alookup(student, amount)
+    if order:
+        return order, False
+
+    token = secrets.token_hex(8)
+    locked = await _alock(student.id, token)
+    if locked is False:
+        deadline = time.monotonic() + settings.ORDER_LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+            order = await _acached(student.id)
+            if order and order.get("amount") == amount:
+                student.razorpay_order_id = order["id"]
+                return order, False
+        raise OrderBusy()
+
+    try:
+        gateway = get_gateway()
+        receipt = gateway.new_receipt(f"receipt_{student.id}")
+        order = await gateway.acreate_order(amount, receipt)
+        await sync_to_async(_save)(student, order, receipt)
+    except Exception:
+        if locked:
+            await _arelease(student.id, token)
+        raise
+    await _aremember(student, order, token)
+    await payment_status.aremember(student.id, student.payment_status, order["id"])
+    return order, True
@@ -1,94 +1,184 @@
-import redis
-import random
-import string
-import os
-from django.core.mail import send_mail
-from django.conf import settings
+import json
+import logging
+import secrets
+import time
+from . import timing
+from .redis_pool import aeval, get_redis
+
+redis_client = get_redis()
+
+from . import mail_queue  # noqa: E402 - mail_queue uses redis_client
+
+logger = logging.getLogger(__name__)
+
+# Server-side scripts, every OTP operation is one atomic round trip.
+# Loaded with SCRIPT LOAD from UsersConfig.ready(), called with EVALSHA
+# (redis-py reloads a script transparently if the server lost it).
+
+# KEYS: cooldown, otp, attempts, mail queue, mail status
+# ARGV: otp, otp expiry, cooldown, mail job json, job id, now
+ISSUE_OTP_LUA = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl > 0 then
+    return {0, ttl}
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+redis.call('SET', KEYS[1], '1', 'EX', ARGV[3])
+redis.call('SET', KEYS[3], '0', 'EX', ARGV[2])
+redis.call('LPUSH', KEYS[4], ARGV[4])
+redis.call('HSET', KEYS[5], 'job_id', ARGV[5], 'state', 'queued', 'attempts', '0', 'error', '', 'updated_at', ARGV[6])
+redis.call('EXPIRE', KEYS[5], ARGV[2])
+return {1, 0}
+"""
+
+# KEYS: otp, attempts, verified, cooldown
+# ARGV: otp input, max attempts, verified ttl
+# returns {code, remaining attempts}: 1 ok, 0 wrong otp, -1 max attempts, -2 expired
+VERIFY_OTP_LUA = """
+local attempts = tonumber(redis.call('GET', KEYS[2]) or '0')
+local max_attempts = tonumber(ARGV[2])
+if attempts >= max_attempts then
+    return {-1, 0}
+end
+local stored = redis.call('GET', KEYS[1])
+if not stored then
+    return {-2, 0}
+end
+redis.call('INCR', KEYS[2])
+if stored == ARGV[1] then
+    redis.call('SET', KEYS[3], '1', 'EX', ARGV[3])
+    redis.call('DEL', KEYS[1], KEYS[2], KEYS[4])
+    return {1, 0}
+end
+return {0, max_attempts - attempts - 1}
+"""
+
+issue_otp_script = redis_client.register_script(ISSUE_OTP_LUA)
+verify_otp_script = redis_client.register_script(VERIFY_OTP_LUA)
 
-redis_client = redis.from_url(os.getenv('REDIS_URL'), decode_responses=True)
 
 class OTPManager:
     OTP_LENGTH = 6
     OTP_EXPIRY = 300  # 5 minutes
     COOLDOWN = 180 # 3 minutes
     MAX_ATTEMPTS = 3
-    
+    VERIFIED_TTL = 60
+
+    @staticmethod
+    def register_scripts():
+        """Load the Lua scripts on the server once, at startup"""
+        try:
+            for script in (issue_otp_script, verify_otp_script):
+                redis_client.script_load(script.script)
+        except Exception as e:
+            # not fatal, EVALSHA falls back to loading the script on first use
+            logger.warning(f"Could not preload OTP scripts: {str(e)}")
+
+    @staticmethod
+    def _issue_call(email):
+        """Keys and args for the issue script"""
+        # ✅ Generate OTP
+        otp = ''.join(secrets.choice("0123456789") for _ in range(OTPManager.OTP_LENGTH))
+        job = mail_queue.build_job(
+            email,
+            subject="Your OTP Code",
+            message=f"Your OTP is: {otp}\n\nThis OTP will expire in 5 minutes.",
+            ttl=OTPManager.OTP_EXPIRY,
+        )
+        keys = [
+            f"Cooldown:{email}",
+            f"OTP:{email}",
+            f"Attempts:{email}",
+            mail_queue.QUEUE_KEY,
+            mail_queue.status_key(email),
+        ]
+        args = [
+            otp,
+            OTPManager.OTP_EXPIRY,
+            OTPManager.COOLDOWN,
+            json.dumps(job),
+            job["id"],
+            int(time.time()),
+        ]
+        return keys, args
+
+    @staticmethod
+    def _issue_result(result):
+        issued, ttl = result
+        if not issued:
+            return False, f"Wait {ttl} seconds before requesting again"
+        return True, "OTP sent successfully"
+
     @staticmethod
+    def _verify_call(email, otp_input):
+        """Keys and args for the verify script"""
+        keys = [
+            f"OTP:{email}",
+            f"Attempts:{email}",
+            f"Verified:{email}",
+            f"Cooldown:{email}",
+        ]
+        return keys, [str(otp_input), OTPManager.MAX_ATTEMPTS, OTPManager.VERIFIED_TTL]
+
+    @staticmethod
+    def _verify_result(result):
+        code, remaining = result
+        if code == 1:
+            return True, "OTP verified successfully"
+        if code == -1:
+            return False, "Max attempts reached. Request new OTP"
+        if code == -2:
+            return False, "OTP expired or invalid"
+        return False, f"Invalid OTP. {remaining} attempts left"
+
+    @staticmethod
+    @timing.timed("redis")
     def send_otp(email, ip_address):
-        """Send OTP - handles cooldown, email sending"""
-        
+        """Send OTP - cooldown check, OTP store and mail enqueue in one script call"""
+        keys, args = OTPManager._issue_call(email)
         try:
-            # ✅ Cooldown check (3 min wait)
-            cooldown_key = f"Cooldown:{email}"
-            if redis_client.exists(cooldown_key):
-                ttl = redis_client.ttl(cooldown_key)
-                return False, f"Wait {ttl} seconds before requesting again"
-            
-            # ✅ Generate OTP
-            otp = ''.join(random.choices(string.digits, k=OTPManager.OTP_LENGTH))
-            
-            # ✅ Store OTP in Redis
-            otp_key = f"OTP:{email}"
-            redis_client.setex(otp_key, OTPManager.OTP_EXPIRY, otp)
-            
-            # ✅ Set cooldown
-            redis_client.setex(cooldown_key, OTPManager.COOLDOWN, "1")
-            
-            # ✅ Reset attempts
-            attempts_key = f"Attempts:{email}"
-            redis_client.setex(attempts_key, OTPManager.OTP_EXPIRY, "0")
+            # ✅ Cooldown (3 min wait), store OTP, reset attempts, queue email
+            result = issue_otp_script(keys=keys, args=args, client=redis_client)
         except Exception as e:
             return False, f"Failed to send OTP: {str(e)}"
-            # ✅ Send email
+        return OTPManager._issue_result(result)
+
+    @staticmethod
+    @timing.timed("redis")
+    async def asend_otp(email, ip_address):
+        """Async send_otp for the ASGI views"""
+        keys, args = OTPManager._issue_call(email)
         try:
-                send_mail(
-                subject="Your OTP Code",
-                message=f"Your OTP is: {otp}\n\nThis OTP will expire in 5 minutes.",
-                from_email=settings.EMAIL_HOST_USER,
-                recipient_list=[email],
-                fail_silently=False
-            )
+            result = await aeval(issue_otp_script, keys, args)
         except Exception as e:
-            return False, f"Failed to send OTP email: {str(e)}"
-        
-        return True, "OTP sent successfully"
-    
+            return False, f"Failed to send OTP: {str(e)}"
+        return OTPManager._issue_result(result)
+
+    @staticmethod
+    @timing.timed("redis")
+    def cooldown_remaining(email):
+        """Seconds left before a new OTP can be requested, 0 if none"""
+        return max(redis_client.ttl(f"Cooldown:{email}"), 0)
+
+    @staticmethod
+    @timing.timed("redis")
+    def verify_otp(email, otp_input, ip_address=None):
+        """Verify OTP - attempt limiting, verification and cleanup in one script call"""
+        keys, args = OTPManager._verify_call(email, otp_input)
+        try:
+            result = verify_otp_script(keys=keys, args=args, client=redis_client)
+        except Exception as e:
+            return False, f"Verification failed: {str(e)}"
+        return OTPManager._verify_result(result)
+
     @staticmethod
-    def verify_otp(email, otp_input, ip_address):
-        """Verify OTP - handles attempt limiting, verification"""
-        
+    @timing.timed("redis")
+    async def averify_otp(email, otp_input, ip_address=None):
+        """Async verify_otp for the ASGI views"""
+        keys, args = OTPManager._verify_call(email, otp_input)
         try:
-            # ✅ Check email-based attempts
-            attempts_key = f"Attempts:{email}"
-            attempts = int(redis_client.get(attempts_key) or 0)
-            
-            if attempts >= OTPManager.MAX_ATTEMPTS:
-                return False, "Max attempts reached. Request new OTP"
-            
-            # ✅ Get stored OTP
-            otp_key = f"OTP:{email}"
-            stored_otp = redis_client.get(otp_key)
-            
-            if not stored_otp:
-                return False, "OTP expired or invalid"
-            
-            # ✅ Increment attempts
-            redis_client.incr(attempts_key)
-            
-            if stored_otp == otp_input:
-                # Mark as verified
-                verified_key = f"Verified:{email}"
-                redis_client.setex(verified_key, 60, "1")
-                
-                # Cleanup
-                redis_client.delete(otp_key)
-                redis_client.delete(attempts_key)
-                redis_client.delete(f"Cooldown:{email}")
-                
-                return True, "OTP verified successfully"
-            
-            remaining = OTPManager.MAX_ATTEMPTS - attempts
-            return False, f"Invalid OTP. {remaining-1} attempts left"
-        
+            result = await aeval(verify_otp_script, keys, args)
         except Exception as e:
-            return False, f"Verification failed: {str(e)}"
\ No newline at end of file
+            return False, f"Verification failed: {str(e)}"
+        return OTPManager._verify_result(result)
+
@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+import httpx
+import razorpay
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from . import metrics, timing
+from .http_clients import async_client, pooled_session
+
+# Process-wide payment gateway. Views call get_gateway() instead of building a
+# razorpay.Client per request; settings.PAYMENT_GATEWAY picks the class, so
+# tests and load runs can swap in FakeGateway.
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayError(Exception):
+    pass
+
+
+class RetryableGatewayError(GatewayError):
+    """Razorpay answered 5xx: the call may have gone through, ask again"""
+
+
+# errors after which we do not know whether Razorpay created the order; an
+# answered 4xx (bad request, auth, rate limit) is final and never retried
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, RetryableGatewayError)
+ASYNC_RETRYABLE_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError, RetryableGatewayError)
+
+
+def raise_for_server_error(response, *args, **kwargs):
+    """requests response hook: razorpay.Client reports every non-2xx as ServerError, keep 5xx apart"""
+    if response.status_code >= 500:
+        raise RetryableGatewayError(f"Razorpay returned {response.status_code}")
+
+
+def raise_for_status(response):
+    """Same split for the httpx responses of the async path, a 4xx is a final GatewayError"""
+    if response.status_code >= 500:
+        raise RetryableGatewayError(f"Razorpay returned {response.status_code}")
+    if response.status_code >= 400:
+        try:
+            description = response.json().get("error", {}).get("description")
+        except ValueError:
+            description = None
+        raise GatewayError(description or f"Razorpay returned {response.status_code}")
+
+
+class PaymentGateway:
+    """Interface shared by the real and the fake gateway"""
+
+    def new_receipt(self, reference):
+        """Unique receipt per order creation, lets a retry find an order created by a timed out attempt"""
+        return f"{reference}_{secrets.token_hex(4)}"
+
+    def create_order(self, amount, receipt, currency="INR"):
+        raise NotImplementedError
+
+    async def acreate_order(self, amount, receipt, currency="INR"):
+        raise NotImplementedError
+
+    def fetch_order(self, order_id):
+        raise NotImplementedError
+
+    def fetch_order_payments(self, order_id):
+        raise NotImplementedError
+
+    def verify_webhook_signature(self, body, signature):
+        """HMAC-SHA256 of the raw body with the webhook secret, no network call"""
+        if not signature or not settings.RAZORPAY_WEBHOOK_SECRET:
+            return False
+        return hmac.compare_digest(self.sign_webhook(body), signature)
+
+    def sign_webhook(self, body):
+        if isinstance(body, str):
+            body = body.encode()
+        return hmac.new(settings.RAZORPAY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+class RazorpayGateway(PaymentGateway):
+    service = "razorpay"
+
+    def __init__(self):
+        self.auth = (settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
+        session = pooled_session(settings.RAZORPAY_POOL_SIZE)
+        session.hooks["response"].append(raise_for_server_error)
+        self.client = razorpay.Client(session=session, auth=self.auth)
+        self.timeout = (settings.RAZORPAY_CONNECT_TIMEOUT, settings.RAZORPAY_READ_TIMEOUT)
+        self.max_retries = settings.RAZORPAY_MAX_RETRIES
+        self.backoff = settings.RAZORPAY_RETRY_BACKOFF
+
+    def _call(self, operation, fn, *args):
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = fn(*args, timeout=self.timeout)
+            outcome = "ok"
+            return result
+        finally:
+            metrics.outbound_seconds.observe(time.perf_counter() - start, service=f"razorpay.{operation}", outcome=outcome)
+
+    @timing.timed("razorpay")
+    def create_order(self, amount, receipt, currency="INR"):
+        data = {
+            "amount": amount,
+            "currency": currency,
+            "receipt": receipt,
+            "payment_capture": 1
+        }
+        for attempt in range(self.max_retries + 1):
+            try:
+                if attempt:
+                    # the previous attempt may have reached Razorpay, never create twice
+                    existing = self.find_order(receipt)
+                    if existing:
+                        return existing
+                return self._call("create_order", self.client.order.create, data)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise GatewayError(f"Order creation failed: {str(e)}") from e
+                logger.warning(f"Razorpay order {receipt} attempt {attempt + 1} failed: {str(e)}")
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def find_order(self, receipt):
+        orders = self._call("find_order", self.client.order.all, {"receipt": receipt})
+        items = orders.get("items", [])
+        return items[0] if items else None
+
+    @timing.timed("razorpay")
+    async def acreate_order(self, amount, receipt, currency="INR"):
+        client = async_client(
+            "razorpay",
+            settings.RAZORPAY_POOL_SIZE,
+            httpx.Timeout(settings.RAZORPAY_READ_TIMEOUT, connect=settings.RAZORPAY_CONNECT_TIMEOUT),
+        )
+        data = {
+            "amount": amount,
+            "currency": currency,
+            "receipt": receipt,
+            "payment_capture": 1
+        }
+        url = f"{razorpay.Client.DEFAULTS['base_url']}/orders"
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                if attempt:
+                    response = await client.get(url, params={"receipt": receipt}, auth=self.auth)
+                    raise_for_status(response)
+                    items = response.json().get("items", [])
+                    if items:
+                        outcome = "ok"
+                        return items[0]
+                response = await client.post(url, json=data, auth=self.auth)
+                raise_for_status(response)
+                outcome = "ok"
+                return response.json()
+            except ASYNC_RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise GatewayError(f"Order creation failed: {str(e)}") from e
+                logger.warning(f"Razorpay order {receipt} attempt {attempt + 1} failed: {str(e)}")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            finally:
+                metrics.outbound_seconds.observe(time.perf_counter() - start, service="razorpay.create_order", outcome=outcome)
+
+    @timing.timed("razorpay")
+    def fetch_order(self, order_id):
+        return self._call("fetch_order", self.client.order.fetch, order_id)
+
+    @timing.timed("razorpay")
+    def fetch_order_payments(self, order_id):
+        return self._call("fetch_order_payments", self.client.order.payments, order_id).get("items", [])
+
+
+class FakeGateway(PaymentGateway):
+    """In-memory Razorpay stand-in for tests and load runs, never leaves the process"""
+
+    service = "fake"
+
+    def __init__(self):
+        self.orders = {}
+        self.payments = {}  # order id -> [payment]
+        self.latency = settings.FAKE_GATEWAY_LATENCY
+        self.rate_limited = 0  # calls still to answer with Razorpay's 429
+        self._lock = threading.Lock()
+
+    @timing.timed("razorpay")
+    def create_order(self, amount, receipt, currency="INR"):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._create_order(amount, receipt, currency)
+
+    @timing.timed("razorpay")
+    async def acreate_order(self, amount, receipt, currency="INR"):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._create_order(amount, receipt, currency)
+
+    def _create_order(self, amount, receipt, currency):
+        with self._lock:
+            for order in self.orders.values():
+                if order["receipt"] == receipt:
+                    return order
+            order = {
+                "id": f"order_{secrets.token_hex(7)}",
+                "entity": "order",
+                "amount": amount,
+                "amount_paid": 0,
+                "amount_due": amount,
+                "currency": currency,
+                "receipt": receipt,
+                "status": "created",
+                "attempts": 0,
+                "created_at": int(time.time()),
+            }
+            self.orders[order["id"]] = order
+            return order
+
+    def fetch_order(self, order_id):
+        return self.orders[order_id]
+
+    def fetch_order_payments(self, order_id):
+        with self._lock:
+            if self.rate_limited:
+                self.rate_limited -= 1
+                raise GatewayError("Too many requests")
+        return list(self.payments.get(order_id, []))
+
+    def pay(self, order_id, captured=True):
+        """Simulate the customer paying, returns (webhook body, signature)"""
+        with self._lock:
+            order = self.orders[order_id]
+            payment = {
+                "id": f"pay_{secrets.token_hex(7)}",
+                "entity": "payment",
+                "order_id": order_id,
+                "amount": order["amount"],
+                "status": "captured" if captured else "failed",
+                "created_at": int(time.time()),
+            }
+            self.payments.setdefault(order_id, []).append(payment)
+            order["attempts"] += 1
+            if captured:
+                order.update(status="paid", amount_paid=order["amount"], amount_due=0)
+            else:
+                order["status"] = "attempted"
+        body = json.dumps({
+            "entity": "event",
+            "event": "payment.captured" if captured else "payment.failed",
+            "payload": {"payment": {"entity": payment}},
+            "created_at": payment["created_at"],
+        }).encode()
+        return body, self.sign_webhook(body)
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = import_string(settings.PAYMENT_GATEWAY)()
+    return _gateway
+
+
+def reset_gateway():
+    """Forget the gateway, the next get_gateway() builds it from settings again"""
+    global _gateway
+    _gateway = None
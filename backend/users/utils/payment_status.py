@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from django.conf import settings
+from ..models import Student
+from . import timing
+from .redis_pool import get_async_redis, get_redis
+
+# Cached payment status per student, pushed to waiting clients.
+#
+# PaymentStatus:<student id>        status, written by the webhook apply path
+# PaymentStatus:order:<order id>    student id, written when the order is created
+# PaymentStatus:changed             pub/sub channel, messages "<student id>:<status>"
+#
+# Reads fall back to the database on a miss or when Redis is down, and fill
+# the cache with SET NX: a row read before the webhook committed must not
+# overwrite the status the webhook published meanwhile, only the publish path
+# overwrites. Each event loop holds one subscription to the channel and fans
+# messages out to the long-poll and SSE requests waiting on it, so waiting
+# costs no connection per client.
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "PaymentStatus:"
+ORDER_PREFIX = "PaymentStatus:order:"
+CHANNEL = "PaymentStatus:changed"
+
+# statuses after which nothing is left to wait for
+FINAL_STATUSES = ('SUCCESS',)
+
+redis_client = get_redis()
+
+# KEYS: order -> student key
+# ARGV: status, ttl, status key prefix, channel
+# returns the student id, 0 when the order is not known to Redis
+PUBLISH_LUA = """
+local student = redis.call('GET', KEYS[1])
+if not student then
+    return 0
+end
+redis.call('SET', ARGV[3] .. student, ARGV[1], 'EX', ARGV[2])
+redis.call('PUBLISH', ARGV[4], student .. ':' .. ARGV[1])
+return tonumber(student)
+"""
+
+publish_script = redis_client.register_script(PUBLISH_LUA)
+
+
+def _key(student_id):
+    return f"{KEY_PREFIX}{student_id}"
+
+
+def _cache(pipe, student_id, status, order_id=None, fill=False):
+    ttl = settings.PAYMENT_STATUS_CACHE_TTL
+    pipe.set(_key(student_id), status, ex=ttl, nx=fill)
+    if order_id:
+        pipe.set(f"{ORDER_PREFIX}{order_id}", student_id, ex=ttl)
+
+
+@timing.timed("redis")
+def remember(student_id, status, order_id=None):
+    """Cache a status read from the database unless one is cached, and the order it belongs to"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _cache(pipe, student_id, status, order_id, fill=True)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not cache payment status of {student_id}: {str(e)}")
+
+
+@timing.timed("redis")
+async def aremember(student_id, status, order_id=None):
+    try:
+        pipe = get_async_redis().pipeline(transaction=False)
+        _cache(pipe, student_id, status, order_id, fill=True)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not cache payment status of {student_id}: {str(e)}")
+
+
+def get_status(student_id):
+    """Payment status of a student, None if there is no such student"""
+    try:
+        with timing.span("redis"):
+            cached = redis_client.get(_key(student_id))
+        if cached is not None:
+            return cached.decode()
+    except Exception as e:
+        logger.warning(f"Payment status cache unavailable: {str(e)}")
+        return _db_row(student_id)[0]
+    status, order_id = _db_row(student_id)
+    if status is not None:
+        remember(student_id, status, order_id)
+    return status
+
+
+async def aget_status(student_id):
+    client = get_async_redis()
+    try:
+        with timing.span("redis"):
+            cached = await client.get(_key(student_id))
+        if cached is not None:
+            return cached.decode()
+    except Exception as e:
+        logger.warning(f"Payment status cache unavailable: {str(e)}")
+        return (await _adb_row(student_id))[0]
+    status, order_id = await _adb_row(student_id)
+    if status is not None:
+        await aremember(student_id, status, order_id)
+    return status
+
+
+def _db_row(student_id):
+    """(payment status, order id), (None, None) if there is no such student"""
+    row = Student.objects.filter(id=student_id).values_list('payment_status', 'razorpay_order_id').first()
+    return row or (None, None)
+
+
+async def _adb_row(student_id):
+    row = await Student.objects.filter(id=student_id).values_list('payment_status', 'razorpay_order_id').afirst()
+    return row or (None, None)
+
+
+def publish_order(order_id, status):
+    """Cache and push the new status of the student holding order_id
+
+    Called after the webhook transaction committed. One script call when the
+    order is known to Redis, otherwise one SELECT to find the student.
+    """
+    try:
+        student_id = publish_script(
+            keys=[f"{ORDER_PREFIX}{order_id}"],
+            args=[status, settings.PAYMENT_STATUS_CACHE_TTL, KEY_PREFIX, CHANNEL],
+            client=redis_client,
+        )
+        if student_id:
+            return
+        student_id = Student.objects.filter(razorpay_order_id=order_id).values_list('id', flat=True).first()
+        if student_id is not None:
+            publish({student_id: status}, {student_id: order_id})
+    except Exception as e:
+        _forget_order(order_id, e)
+
+
+def publish(statuses, orders=None):
+    """Cache and push {student id: status}, one round trip for the lot"""
+    orders = orders or {}
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for student_id, status in statuses.items():
+            _cache(pipe, student_id, status, orders.get(student_id))
+            pipe.publish(CHANNEL, f"{student_id}:{status}")
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Could not publish payment status of {list(statuses)}: {str(e)}")
+        try:
+            redis_client.delete(*[_key(student_id) for student_id in statuses])
+        except Exception:
+            pass  # Redis is down, readers go to the database anyway
+
+
+def _forget_order(order_id, error):
+    """A stale cached status is worse than none, readers fall back to the database"""
+    logger.error(f"Could not publish payment status of order {order_id}: {str(error)}")
+    try:
+        student_id = redis_client.get(f"{ORDER_PREFIX}{order_id}")
+        if student_id:
+            redis_client.delete(_key(student_id.decode()))
+    except Exception:
+        pass
+
+
+class _Listener:
+    """One subscription per event loop, fanned out to the local waiters"""
+
+    def __init__(self):
+        self.waiters = {}  # student id -> set of queues
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.subscribe(CHANNEL)
+                self.ready.set()
+                while True:
+                    # short reads, the pool's socket timeout would cut a blocking listen()
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message:
+                        self.dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # waiters keep waiting and fall back to their timeout
+                logger.warning(f"Payment status subscription lost, retrying: {str(e)}")
+                self.ready.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def dispatch(self, data):
+        student_id, _, status = data.decode().partition(":")
+        for queue in self.waiters.get(int(student_id), ()):
+            queue.put_nowait(status)
+
+    def add(self, student_id):
+        queue = asyncio.Queue()
+        self.waiters.setdefault(student_id, set()).add(queue)
+        return queue
+
+    def remove(self, student_id, queue):
+        queues = self.waiters.get(student_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.waiters[student_id]
+
+
+_listeners = weakref.WeakKeyDictionary()
+
+
+def _listener():
+    loop = asyncio.get_running_loop()
+    listener = _listeners.get(loop)
+    if listener is None or listener.task.done():
+        listener = _listeners[loop] = _Listener()
+    return listener
+
+
+@asynccontextmanager
+async def watch(student_id, subscribe_timeout=1.0):
+    """Queue of status changes for one student while the block runs
+
+    Subscribe before reading the current status, so a change that lands
+    between the read and the wait is not lost.
+    """
+    listener = _listener()
+    queue = listener.add(student_id)
+    try:
+        try:
+            await asyncio.wait_for(listener.ready.wait(), subscribe_timeout)
+        except TimeoutError:
+            logger.warning("Payment status subscription not ready, waiting on timeout only")
+        yield queue
+    finally:
+        listener.remove(student_id, queue)
+
+
+async def wait_for_change(student_id, since, timeout):
+    """Current status as soon as it differs from since, or when timeout passes"""
+    async with watch(student_id) as changes:
+        status = await aget_status(student_id)
+        if status is None or status != since:
+            return status
+        try:
+            async with asyncio.timeout(timeout):
+                while status == since:
+                    status = await changes.get()
+        except TimeoutError:
+            pass
+        return status
@@ -0,0 +1,171 @@
+import ipaddress
+import logging
+import math
+import re
+from typing import NamedTuple
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from . import timing
+from .redis_pool import aeval, get_redis
+
+# The one rate limiting layer of the users endpoints (django_ratelimit and the
+# DRF throttles are gone). Each request makes a single script call that
+# checks the blocklists, applies every limit of the endpoint and, for
+# send-otp, reads the OTP cooldown - one Redis round trip for all of it.
+#
+# Limits are GCRA (a token bucket that stores one timestamp per key): "10/m"
+# allows a burst of 10 and then one request every 6 seconds, and a refused
+# request knows exactly when the next one would pass (Retry-After).
+#
+# Keys: RateLimit:<endpoint>:<ip|email|field>:<value>
+
+logger = logging.getLogger(__name__)
+
+# Redis sets of blocked emails and IPs, see manage.py blocklist
+BLOCKED_EMAILS_KEY = "Blocklist:emails"
+BLOCKED_IPS_KEY = "Blocklist:ips"
+
+# gate results
+ALLOWED, BLOCKED, LIMITED, COOLDOWN = 0, 1, 2, 3
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+RATE_PATTERN = re.compile(r"(\d+)/(\d*)([smhd])")
+
+redis_client = get_redis()
+
+# KEYS: blocked ips, blocked emails, cooldown key ("" for none), then one key per limit
+# ARGV: ip, email, then count and window (ms) per limit
+# returns {result, retry after ms}; a limit only spends a token when the request passes all of them
+GATE_LUA = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 or (ARGV[2] ~= '' and redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 1) then
+    return {1, 0}
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tats = {}
+local wait = 0
+for i = 4, #KEYS do
+    local count = tonumber(ARGV[2 * (i - 3) + 1])
+    local window = tonumber(ARGV[2 * (i - 3) + 2])
+    local tat = math.max(tonumber(redis.call('GET', KEYS[i]) or 0), now)
+    local next_tat = tat + window / count
+    wait = math.max(wait, next_tat - window - now)
+    tats[i] = next_tat
+end
+if wait > 0 then
+    return {2, math.ceil(wait)}
+end
+for i = 4, #KEYS do
+    redis.call('SET', KEYS[i], string.format('%.0f', tats[i]), 'PX', math.ceil(tats[i] - now))
+end
+if KEYS[3] ~= '' then
+    local ttl = redis.call('PTTL', KEYS[3])
+    if ttl > 0 then
+        return {3, ttl}
+    end
+end
+return {0, 0}
+"""
+
+gate_script = redis_client.register_script(GATE_LUA)
+
+
+class Limit(NamedTuple):
+    key: str  # "ip", or the request field to count per value, e.g. "email"
+    count: int
+    window: float  # seconds
+
+
+def limit(key, rate):
+    """Limit("ip", ...) from "10/m", "3/10m", "100/h" style rates"""
+    match = RATE_PATTERN.fullmatch(rate)
+    if match is None:
+        raise ValueError(f"Bad rate {rate!r}, expected e.g. 10/m or 3/10m")
+    count, multiple, period = match.groups()
+    return Limit(key, int(count), int(multiple or 1) * PERIODS[period])
+
+
+# Client IP
+
+_trusted = ()
+
+
+def load_trusted_proxies():
+    global _trusted
+    _trusted = tuple(ipaddress.ip_network(network, strict=False) for network in settings.TRUSTED_PROXIES)
+
+
+load_trusted_proxies()
+
+
+@receiver(setting_changed)
+def _reload(setting, **kwargs):
+    if setting == "TRUSTED_PROXIES":
+        load_trusted_proxies()
+
+
+def _address(value):
+    try:
+        return ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+
+
+def _is_trusted(address):
+    return any(address in network for network in _trusted)
+
+
+def client_ip(request):
+    """Address of the client, X-Forwarded-For only counts when a trusted proxy added it
+
+    Walks X-Forwarded-For from the right (the entries our own proxies
+    appended) and returns the first address that is not a trusted proxy.
+    Anything left of it was written by the client and is ignored.
+    """
+    remote = _address(request.META.get('REMOTE_ADDR', ''))
+    if remote is None:
+        return request.META.get('REMOTE_ADDR')
+    if not _is_trusted(remote):
+        return str(remote)
+    client = remote
+    for hop in reversed(request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        address = _address(hop)
+        if address is None:
+            break  # garbage from the client, keep the last proxy-written hop
+        client = address
+        if not _is_trusted(address):
+            break
+    return str(client)
+
+
+# The gate
+
+def _call(endpoint, limits, ctx, cooldown_key):
+    ip = ctx.get("ip") or ""
+    email = str(ctx["data"].get("email") or "").lower()
+    keys = [BLOCKED_IPS_KEY, BLOCKED_EMAILS_KEY, cooldown_key or ""]
+    args = [ip, email]
+    if settings.RATE_LIMIT_ENABLED:
+        for rule in limits:
+            value = ip if rule.key == "ip" else email if rule.key == "email" else str(ctx["data"].get(rule.key) or "")
+            if not value:
+                continue
+            keys.append(f"RateLimit:{endpoint}:{rule.key}:{value}")
+            args.extend([rule.count, int(rule.window * 1000)])
+    return keys, args
+
+
+@timing.timed("redis")
+def gate(endpoint, limits, ctx, cooldown_key=None):
+    """(result, retry after in seconds) in one script call"""
+    keys, args = _call(endpoint, limits, ctx, cooldown_key)
+    result, wait_ms = gate_script(keys=keys, args=args, client=redis_client)
+    return result, math.ceil(wait_ms / 1000)
+
+
+@timing.timed("redis")
+async def agate(endpoint, limits, ctx, cooldown_key=None):
+    keys, args = _call(endpoint, limits, ctx, cooldown_key)
+    result, wait_ms = await aeval(gate_script, keys, args)
+    return result, math.ceil(wait_ms / 1000)
@@ -1,18 +1,133 @@
 
+import hashlib
+import logging
+import time
+import httpx
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from . import metrics, timing
+from .circuit_breaker import CircuitBreaker
+from .http_clients import async_client, pooled_session
 
+SITEVERIFY_URL = "https://www.google.com/recaptcha/api/siteverify"
+
+logger = logging.getLogger(__name__)
+
+session = pooled_session(settings.RECAPTCHA_POOL_SIZE)
+breaker = CircuitBreaker(
+    "recaptcha",
+    failure_threshold=settings.RECAPTCHA_BREAKER_THRESHOLD,
+    reset_timeout=settings.RECAPTCHA_BREAKER_RESET,
+)
+
+
+@timing.timed("recaptcha")
 def verify_recaptcha(token, action):
-    response = requests.post(
-        "https://www.google.com/recaptcha/api/siteverify",
-        data={
-            "secret": settings.RECAPTCHA_SECRET_KEY,
-            "response": token,
-        }
-    ).json()
-
-    return (
+    if not token:
+        return False
+
+    # ✅ Tokens are single use: a replay (double click, client retry) is refused without an outbound call
+    if not claim(token):
+        return replayed()
+
+    if not breaker.allow():
+        return unavailable()
+
+    start = time.perf_counter()
+    try:
+        response = session.post(
+            SITEVERIFY_URL,
+            data={
+                "secret": settings.RECAPTCHA_SECRET_KEY,
+                "response": token,
+            },
+            timeout=(settings.RECAPTCHA_CONNECT_TIMEOUT, settings.RECAPTCHA_READ_TIMEOUT),
+        )
+        response.raise_for_status()
+        result = response.json()
+    except (requests.RequestException, ValueError) as e:
+        return failed(start, e)
+
+    succeeded(start)
+    return is_valid(result, action)
+
+
+@timing.timed("recaptcha")
+async def averify_recaptcha(token, action):
+    if not token:
+        return False
+
+    try:
+        claimed = await cache.aadd(cache_key(token), 1, settings.RECAPTCHA_CACHE_TTL)
+    except Exception:
+        claimed = True
+    if not claimed:
+        return replayed()
+
+    if not breaker.allow():
+        return unavailable()
+
+    client = async_client(
+        "recaptcha",
+        settings.RECAPTCHA_POOL_SIZE,
+        httpx.Timeout(settings.RECAPTCHA_READ_TIMEOUT, connect=settings.RECAPTCHA_CONNECT_TIMEOUT),
+    )
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            SITEVERIFY_URL,
+            data={
+                "secret": settings.RECAPTCHA_SECRET_KEY,
+                "response": token,
+            }
+        )
+        response.raise_for_status()
+        result = response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        return failed(start, e)
+
+    succeeded(start)
+    return is_valid(result, action)
+
+
+def is_valid(response, action):
+    return bool(
         response.get("success") and
         response.get("action") == action and
         response.get("score", 0) >= settings.RECAPTCHA_SCORE_THRESHOLD
     )
+
+
+def cache_key(token):
+    return "Recaptcha:" + hashlib.sha256(token.encode()).hexdigest()
+
+
+def claim(token):
+    """False if the token was presented in the last RECAPTCHA_CACHE_TTL seconds"""
+    try:
+        return cache.add(cache_key(token), 1, settings.RECAPTCHA_CACHE_TTL)
+    except Exception:
+        return True  # the cache is an optimisation, siteverify refuses a replay itself
+
+
+def replayed():
+    metrics.recaptcha_replays.inc()
+    return False
+
+
+def succeeded(start):
+    breaker.record_success()
+    metrics.outbound_seconds.observe(time.perf_counter() - start, service="recaptcha", outcome="ok")
+
+
+def failed(start, error):
+    breaker.record_failure()
+    metrics.outbound_seconds.observe(time.perf_counter() - start, service="recaptcha", outcome="error")
+    logger.warning(f"reCAPTCHA siteverify failed: {str(error)}")
+    return settings.RECAPTCHA_FAIL_OPEN
+
+
+def unavailable():
+    metrics.outbound_short_circuits.inc(service="recaptcha")
+    return settings.RECAPTCHA_FAIL_OPEN
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from . import webhooks
+from .payment_gateway import get_gateway
+from .redis_pool import get_redis
+
+# Payment status re-sync from the gateway, for orders whose webhook never
+# arrived or never reached the student row. Razorpay is asked per order, the
+# answers of a batch are applied together: each batch costs its API calls
+# (RAZORPAY_POOL_SIZE at a time, the pooled session's size) plus one
+# webhooks.apply_payment_events, not an UPDATE per student.
+#
+# Calls are spaced to RECONCILE_RATE per second across the threads. A failed
+# call (Razorpay answers 429 when pushed too hard) halves the pace, and the
+# orders that failed are asked again at the slower pace, RAZORPAY_MAX_RETRIES
+# times; successful calls bring the pace back up.
+
+logger = logging.getLogger(__name__)
+
+# outcome counters of resync()
+CHECKED = "checked"
+EVENTS = "events"
+ERRORS = "errors"
+
+# reconcile_payments progress, a hash: after (last student id done),
+# statuses, failed (comma separated ids of students whose orders could not
+# be fetched) and its counters, so an interrupted run continues where it
+# was and asks about the failed students again
+CHECKPOINT_KEY = "Reconcile:checkpoint"
+
+redis_client = get_redis()
+
+
+def payment_event(order_id, payments):
+    """The webhook event a list of the order's payments amounts to, or None
+
+    A captured payment pays the order. Only when every attempt failed is the
+    order failed; an order without payments, or with one still authorized,
+    is left pending.
+    """
+    captured = [payment for payment in payments if payment.get("status") == "captured"]
+    if captured:
+        return ("payment.captured", order_id, captured[0]["id"], None)
+    if payments and all(payment.get("status") == "failed" for payment in payments):
+        return ("payment.failed", order_id, payments[-1]["id"], None)
+    return None
+
+
+def target_status(status, event):
+    """Status the event moves a student in this status to, None if it stays"""
+    transition = webhooks.TRANSITIONS.get(event[0]) if event else None
+    if transition and status in transition[1]:
+        return transition[0]
+    return None
+
+
+class Pacer:
+    """Spaces calls at least 1/rate seconds apart across threads, slower after failures"""
+
+    MAX_INTERVAL = 5  # seconds, the slowest pace
+
+    def __init__(self, rate):
+        self.base = 1 / rate if rate else 0
+        self.interval = self.base
+        self.next_at = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def failed(self):
+        with self._lock:
+            self.interval = min(max(self.interval * 2, 0.1), self.MAX_INTERVAL)
+
+    def succeeded(self):
+        with self._lock:
+            self.interval = max(self.base, self.interval * 0.9)
+
+
+def _fetch(order_id, pacer):
+    pacer.wait()
+    try:
+        payments = get_gateway().fetch_order_payments(order_id)
+    except Exception as e:
+        pacer.failed()
+        logger.warning(f"Could not fetch payments of {order_id}: {str(e)}")
+        return order_id, None
+    pacer.succeeded()
+    return order_id, payments
+
+
+def fetch_events(order_ids, executor, pacer, retries=None):
+    """Ask Razorpay about these orders on executor's threads
+
+    Returns ({order id: payment event or None}, order ids that could not be
+    fetched after retries more attempts).
+    """
+    retries = settings.RAZORPAY_MAX_RETRIES if retries is None else retries
+    events, pending = {}, list(order_ids)
+    for _ in range(retries + 1):
+        failed = []
+        for order_id, payments in executor.map(_fetch, pending, [pacer] * len(pending)):
+            if payments is None:
+                failed.append(order_id)
+            else:
+                events[order_id] = payment_event(order_id, payments)
+        pending = failed
+        if not pending:
+            break
+    return events, pending
+
+
+def resync(order_ids, batch_size=None):
+    """Move the students of these orders to the status Razorpay has for them
+
+    Returns {"checked", "events", "errors"}: orders asked about, payment
+    events recorded in the ledger, orders Razorpay could not be asked about.
+    """
+    batch_size = batch_size or settings.RECONCILE_BATCH_SIZE
+    order_ids = list(dict.fromkeys(order_id for order_id in order_ids if order_id))
+    counts = {CHECKED: 0, EVENTS: 0, ERRORS: 0}
+    pacer = Pacer(settings.RECONCILE_RATE)
+    with ThreadPoolExecutor(max_workers=settings.RAZORPAY_POOL_SIZE) as executor:
+        for start in range(0, len(order_ids), batch_size):
+            found, errors = fetch_events(order_ids[start:start + batch_size], executor, pacer)
+            counts[CHECKED] += len(found)
+            counts[ERRORS] += len(errors)
+            events = [event for event in found.values() if event]
+            if events:
+                counts[EVENTS] += webhooks.apply_payment_events(events, replay=True)[0]
+    return counts
+
+
+def load_checkpoint():
+    return {key.decode(): value.decode() for key, value in redis_client.hgetall(CHECKPOINT_KEY).items()}
+
+
+def save_checkpoint(state):
+    redis_client.hset(CHECKPOINT_KEY, mapping=state)
+
+
+def clear_checkpoint():
+    redis_client.delete(CHECKPOINT_KEY)
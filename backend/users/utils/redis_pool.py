@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+from django_redis.pool import ConnectionFactory
+from redis.connection import BlockingConnectionPool, _HiredisParser, _RESP2Parser
+from redis.exceptions import NoScriptError
+from redis.utils import HIREDIS_AVAILABLE
+
+# One Redis connection pool per process, shared by OTPManager, the mail queue,
+# the rate limiter and the django-redis cache (reCAPTCHA verdicts).
+#
+# Connections do not decode responses because django-redis stores pickled
+# bytes, callers that want text decode it themselves.
+#
+# The async views get their own pool with the same settings, one per event
+# loop since asyncio connections cannot move between loops.
+
+_pool = None
+_pool_lock = threading.Lock()
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def parser_class():
+    if settings.REDIS_USE_HIREDIS and HIREDIS_AVAILABLE:
+        return _HiredisParser
+    return _RESP2Parser
+
+
+def pool_kwargs():
+    return {
+        "max_connections": settings.REDIS_MAX_CONNECTIONS,
+        "timeout": settings.REDIS_POOL_TIMEOUT,
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+        "socket_keepalive": True,
+        "retry_on_timeout": True,
+    }
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BlockingConnectionPool.from_url(
+                    settings.REDIS_URL, parser_class=parser_class(), **pool_kwargs()
+                )
+    return _pool
+
+
+def get_redis():
+    """Redis client on the shared pool (cheap, the pool holds the sockets)"""
+    return redis.Redis(connection_pool=get_pool())
+
+
+def get_async_redis():
+    """redis.asyncio client on the pool of the running event loop"""
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        pool = _async_pools[loop] = redis.asyncio.BlockingConnectionPool.from_url(
+            settings.REDIS_URL, **pool_kwargs()
+        )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+async def aeval(script, keys, args):
+    """Run a script registered on the sync client with the async one (same sha)"""
+    client = get_async_redis()
+    try:
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+    except NoScriptError:
+        await client.script_load(script.script)
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+
+
+def pool_stats():
+    """Connection usage of this process' pool"""
+    pool = get_pool()
+    created = len(pool._connections)
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        "pid": os.getpid(),
+        "max_connections": pool.max_connections,
+        "created": created,
+        "in_use": created - idle,
+        "idle": idle,
+        "parser": parser_class().__name__,
+    }
+
+
+class SharedConnectionFactory(ConnectionFactory):
+    """django-redis connection factory that hands out the shared pool
+
+    Set as CONNECTION_FACTORY in settings.CACHES so the cache stops building
+    its own pool for REDIS_URL.
+    """
+
+    def get_or_create_connection_pool(self, params):
+        if params["url"] == settings.REDIS_URL:
+            return get_pool()
+        return super().get_or_create_connection_pool(params)
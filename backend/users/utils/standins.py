@@ -0,0 +1,147 @@
+import email
+import json
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Local stand-ins for the services the registration funnel calls out to, used
+# by manage.py loadtest so a run never sends a mail or reaches Google. Each
+# one listens on 127.0.0.1 on a free port, in a daemon thread of this process.
+# Razorpay needs no server: settings.PAYMENT_GATEWAY = FakeGateway.
+
+OTP_PATTERN = re.compile(r"\b(\d{6})\b")
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for Django's EmailBackend: no TLS, no AUTH"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost loadtest SMTP")
+        recipients = []
+        for raw in self.rfile:
+            command = raw.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                self.server.outbox.deliver(recipients, email.message_from_bytes(b"".join(lines)))
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:  # RSET, NOOP
+                self.reply("250 OK")
+
+
+class Outbox:
+    """Messages received by the capturing SMTP server, by recipient"""
+
+    def __init__(self):
+        self.messages = {}
+        self._changed = threading.Condition()
+
+    def deliver(self, recipients, message):
+        with self._changed:
+            for recipient in recipients:
+                self.messages.setdefault(recipient.lower(), []).append(message)
+            self._changed.notify_all()
+
+    def wait_for(self, recipient, count=1, timeout=10):
+        """The count-th message to recipient, None if it did not arrive in time"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while len(self.messages.get(recipient.lower(), ())) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+            return self.messages[recipient.lower()][count - 1]
+
+    def wait_for_otp(self, recipient, count=1, timeout=10):
+        message = self.wait_for(recipient, count, timeout)
+        if message is None:
+            return None
+        match = OTP_PATTERN.search(message.get_payload(decode=True).decode())
+        return match.group(1) if match else None
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CapturingSMTPServer:
+    def __init__(self):
+        self.server = _ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+        self.server.outbox = self.outbox = Outbox()
+        self.port = self.server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name="smtp-standin", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SiteverifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like Google
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        token = form.get("response", [""])[0]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = json.dumps({
+            "success": not token.startswith("invalid"),
+            "score": self.server.score,
+            "action": self.server.action,
+            "hostname": "localhost",
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SiteverifyStub:
+    """reCAPTCHA siteverify: every token passes with `score` and `action`, except ones starting with "invalid" """
+
+    def __init__(self, latency=0.0, score=0.9, action="create_order"):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _SiteverifyHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.score = score
+        self.server.action = action
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/recaptcha/api/siteverify"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, name="siteverify-standin", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,115 @@
+import io
+import zlib
+import segno
+
+# Ticket rendering, the CPU-bound half of users.utils.tickets. Plain functions
+# of their arguments, no Django: they run in pool worker processes, and the
+# same fields always give the same bytes, which is what lets tickets be stored
+# under the hash of their fields.
+#
+#   - png: the check-in QR code
+#   - pdf: a one page pass, title, student details and the QR code. Written
+#     by hand like the XLSX export, the PDF needs only the standard fonts and
+#     filled rectangles
+
+FORMATS = ("pdf", "png")
+
+PAGE_WIDTH, PAGE_HEIGHT = 298, 420  # points, A6
+QR_SIZE = 200  # points, the code without its quiet zone
+PNG_SCALE = 8  # pixels per module
+
+
+def qr_code(token):
+    return segno.make(token, error="m")
+
+
+def render(fields, file_format):
+    """Bytes of the ticket, fields is {"token", "name", "student_number", "branch", "title"}"""
+    code = qr_code(fields["token"])
+    if file_format == "png":
+        buffer = io.BytesIO()
+        code.save(buffer, kind="png", scale=PNG_SCALE, border=4)
+        return buffer.getvalue()
+    if file_format == "pdf":
+        return _pdf(fields, code.matrix)
+    raise ValueError(f"Unknown ticket format {file_format!r}")
+
+
+def render_job(job):
+    """render() for ProcessPoolExecutor.map: (key, fields, format) -> (key, bytes or None, error)"""
+    key, fields, file_format = job
+    try:
+        return key, render(fields, file_format), None
+    except Exception as e:
+        return key, None, repr(e)
+
+
+# PDF
+
+def _text(value):
+    # the standard fonts cover Latin-1, anything else shows as "?"
+    value = str(value).encode("latin-1", errors="replace").decode("latin-1")
+    return "(" + value.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def _line(font, size, x, y, value):
+    return f"BT /{font} {size} Tf {x} {y} Td {_text(value)} Tj ET"
+
+
+def _modules(matrix, left, top):
+    """One rectangle per run of dark modules in a row"""
+    module = QR_SIZE / len(matrix)
+    rects = []
+    for row, cells in enumerate(matrix):
+        y = top - (row + 1) * module
+        column = 0
+        while column < len(cells):
+            if not cells[column]:
+                column += 1
+                continue
+            start = column
+            while column < len(cells) and cells[column]:
+                column += 1
+            rects.append(f"{left + start * module:.2f} {y:.2f} {(column - start) * module:.2f} {module:.2f} re")
+    return rects
+
+
+def _pdf(fields, matrix):
+    left = (PAGE_WIDTH - QR_SIZE) / 2
+    top = 250
+    content = "\n".join([
+        _line("F2", 16, 24, 380, fields.get("title") or "Registration Ticket"),
+        _line("F1", 12, 24, 345, fields["name"]),
+        _line("F1", 10, 24, 325, f"Student number: {fields['student_number']}"),
+        _line("F1", 10, 24, 309, f"Branch: {fields['branch']}"),
+        "0 g",
+        *_modules(matrix, left, top),
+        "f",
+        _line("F3", 6, 24, 24, fields["token"]),
+    ]).encode("latin-1")
+    stream = zlib.compress(content, 9)
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            "/Resources << /Font << /F1 5 0 R /F2 6 0 R /F3 7 0 R >> >> /Contents 4 0 R >>"
+        ).encode(),
+        f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode() + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.urls import reverse
+from ..models import Student
+from . import checkin, mail_queue, ticket_render, timing
+from .redis_pool import get_redis
+
+# Registration tickets: a QR code (png) and a printable pass (pdf) per paid
+# student, rendered by the render_tickets worker, never inside a request.
+#
+#   - webhooks.apply_payment_events queues the students it moved to SUCCESS
+#     (a Redis set, so a student queued twice renders once)
+#   - the worker renders a batch on a process pool (ticket_render, one
+#     process per core), stores the files and queues the confirmation mail
+#   - TicketView serves the stored file, a missing one is queued and
+#     answered with 202
+#
+# Files are content addressed: the name is the hash of what is drawn on the
+# ticket (TEMPLATE_VERSION, format, token, name, ...). A stored ticket is
+# never rendered again, and an edited name gets a new file instead of a
+# stale one. Storage is STORAGES["tickets"].
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "Tickets:pending"  # set of student ids
+TEMPLATE_VERSION = 1  # bump when ticket_render's output changes, every ticket renders again
+TITLE = "Registration Ticket"
+CONTENT_TYPES = {"pdf": "application/pdf", "png": "image/png"}
+ROW_FIELDS = ('id', 'name', 'student_number', 'branch')
+
+# render_many counters
+RENDERED = "rendered"
+CACHED = "cached"
+FAILED = "failed"
+
+redis_client = get_redis()
+
+
+def storage():
+    return storages["tickets"]
+
+
+def fields(student_id, name, student_number, branch):
+    return {
+        "token": checkin.issue_token(student_id),
+        "name": name,
+        "student_number": student_number,
+        "branch": branch,
+        "title": TITLE,
+    }
+
+
+def digest(ticket_fields, file_format):
+    content = json.dumps([TEMPLATE_VERSION, file_format, ticket_fields], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def path(ticket_digest, file_format):
+    return f"{ticket_digest[:2]}/{ticket_digest}.{file_format}"
+
+
+def locate(row, file_format):
+    """(digest, storage path) of a (id, name, student_number, branch) row's ticket"""
+    ticket_digest = digest(fields(*row), file_format)
+    return ticket_digest, path(ticket_digest, file_format)
+
+
+def paid_rows(student_ids=None):
+    rows = Student.objects.filter(payment_status='SUCCESS')
+    if student_ids is not None:
+        rows = rows.filter(id__in=student_ids)
+    return rows.order_by('id').values_list(*ROW_FIELDS)
+
+
+# Queue
+
+@timing.timed("redis")
+def enqueue(student_ids):
+    if not student_ids:
+        return
+    try:
+        redis_client.sadd(QUEUE_KEY, *student_ids)
+    except Exception as e:
+        # render_tickets --all picks them up later
+        logger.warning(f"Could not queue tickets of {len(student_ids)} students: {str(e)}")
+
+
+def pop(count):
+    return [int(student_id) for student_id in redis_client.spop(QUEUE_KEY, count) or []]
+
+
+# Rendering
+
+def processes():
+    return settings.TICKET_PROCESSES or os.cpu_count() or 1
+
+
+def render_many(rows, formats=ticket_render.FORMATS, executor=None, force=False, progress=None):
+    """Render and store the tickets of (id, name, student_number, branch) rows
+
+    Tickets already stored are skipped unless force. Rendering runs on
+    executor (a ProcessPoolExecutor of processes() workers if None), storing
+    stays in this process. progress(done, total) is called as results come
+    in. Returns ({"rendered", "cached", "failed"}, ids of the students who
+    have all their tickets now and at least one of them is new).
+    """
+    store = storage()
+    counts = {RENDERED: 0, CACHED: 0, FAILED: 0}
+    jobs, rendered, failed = [], set(), set()
+    for row in rows:
+        ticket_fields = fields(*row)
+        for file_format in formats:
+            name = path(digest(ticket_fields, file_format), file_format)
+            if not force and store.exists(name):
+                counts[CACHED] += 1
+                continue
+            jobs.append(((row[0], name), ticket_fields, file_format))
+
+    total = counts[CACHED] + len(jobs)
+    if progress:
+        progress(counts[CACHED], total)
+    if jobs:
+        own = executor is None
+        executor = executor or ProcessPoolExecutor(max_workers=processes())
+        try:
+            chunksize = max(1, min(64, len(jobs) // (processes() * 4)))
+            for (student_id, name), data, error in executor.map(ticket_render.render_job, jobs, chunksize=chunksize):
+                if data is None:
+                    counts[FAILED] += 1
+                    failed.add(student_id)
+                    logger.error(f"Ticket {name} of student {student_id} failed: {error}")
+                else:
+                    store.save(name, ContentFile(data))
+                    counts[RENDERED] += 1
+                    rendered.add(student_id)
+                if progress:
+                    progress(counts[CACHED] + counts[RENDERED] + counts[FAILED], total)
+        finally:
+            if own:
+                executor.shutdown()
+    return counts, rendered - failed
+
+
+# Confirmation mail
+
+def ticket_url(student_id, file_format="pdf"):
+    """Download link for mails, None without TICKET_BASE_URL"""
+    if not settings.TICKET_BASE_URL:
+        return None
+    query = f"?token={checkin.issue_token(student_id)}&type={file_format}"
+    return settings.TICKET_BASE_URL.rstrip("/") + reverse("ticket") + query
+
+
+def confirmation_mail(name, student_number, student_id):
+    """(subject, message) of the registration confirmation"""
+    link = ticket_url(student_id)
+    return (
+        "Registration Successful",
+        f"Dear {name},\n\nYour registration for the event has been successful. "
+        f"Your student number is {student_number}.\n\n"
+        f"Your check-in code: {checkin.issue_token(student_id)}\n"
+        + (f"Your ticket: {link}\n" if link else "")
+        + "\nThank you for registering!",
+    )
+
+
+def send_confirmations(student_ids):
+    """Queue the confirmation mail of these paid students, one query and one Redis round trip"""
+    rows = Student.objects.filter(id__in=student_ids, payment_status='SUCCESS').values_list('email', 'name', 'student_number', 'id')
+    mails = [(email, *confirmation_mail(name, number, student_id)) for email, name, number, student_id in rows]
+    if mails:
+        mail_queue.enqueue_many(mails, settings.CONFIRMATION_MAIL_TTL, mail_queue.CONFIRMATION)
+    return len(mails)
+
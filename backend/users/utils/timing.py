@@ -0,0 +1,117 @@
+import contextvars
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+# Per-request time breakdown: where a request spent its time, by dependency.
+#
+# users.middleware.timing_middleware opens a breakdown per request, hooks
+# add to it (span, timed, record, and db_wrapper on every database
+# connection for the queries) and the middleware turns it into a
+# Server-Timing header and histograms. Spans are named after what was waited
+# on: "db", "redis", "recaptcha", "razorpay", "serializer".
+#
+# Outside a request (management commands, workers) the hooks cost one
+# ContextVar lookup and record nothing. Inside one, a span is two
+# perf_counter calls and a dict update, no lock: the breakdown belongs to the
+# request. Async views share it with the threads sync_to_async runs the ORM in,
+# since the context (and with it the same dict) is copied there.
+
+_breakdown = contextvars.ContextVar("timing_breakdown", default=None)
+
+
+def start():
+    """Open a breakdown for the current request, returns the token for finish()"""
+    return _breakdown.set({})
+
+
+def finish(token):
+    """{span: [seconds, calls]} of the request, closes the breakdown"""
+    breakdown = _breakdown.get()
+    _breakdown.reset(token)
+    return breakdown
+
+
+def record(name, seconds):
+    breakdown = _breakdown.get()
+    if breakdown is None:
+        return
+    entry = breakdown.get(name)
+    if entry is None:
+        breakdown[name] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+@contextmanager
+def span(name):
+    if _breakdown.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator adding each call of a function (sync or async) to span `name`"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def awrapper(*args, **kwargs):
+                if _breakdown.get() is None:
+                    return await fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    record(name, time.perf_counter() - start)
+            return awrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _breakdown.get() is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def db_wrapper(execute, sql, params, many, context):
+    """execute_wrapper of every database connection, see install_db_wrapper"""
+    if _breakdown.get() is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record("db", time.perf_counter() - start)
+
+
+def install_db_wrapper(sender, connection, **kwargs):
+    """connection_created receiver
+
+    Installed on the connection rather than around the request: connections
+    are per thread, and an async view's queries run on sync_to_async's thread,
+    not on the one the middleware runs on.
+    """
+    if db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_wrapper)
+
+
+def server_timing(breakdown, total):
+    """Server-Timing header value, e.g. db;dur=3.1;desc="2 calls", total;dur=12.0"""
+    parts = [
+        f'{name};dur={seconds * 1000:.1f};desc="{calls} call{"" if calls == 1 else "s"}"'
+        for name, (seconds, calls) in breakdown.items()
+    ]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
@@ -0,0 +1,107 @@
+import re
+from typing import NamedTuple
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# College identity checks, shared by the views, StudentSerializer and the
+# Student model so all three give the same verdict.
+#
+# A college email is <first name><student number>@<domain>, and the student
+# number starts with a batch year from settings.STUDENT_BATCH_YEARS. One
+# precompiled pattern parses all of it; no Redis, no database, no allocation
+# beyond the match, so it runs before anything expensive.
+
+STUDENT_NUMBER_DIGITS = (4, 6)  # after the batch year
+MAX_EMAIL_LENGTH = 254
+
+
+class Identity(NamedTuple):
+    first_name: str
+    student_number: str
+    batch: str
+
+
+_email_pattern = None
+_number_pattern = None
+_years = ""
+
+
+def compile_patterns():
+    global _email_pattern, _number_pattern, _years
+    years = "|".join(re.escape(year) for year in settings.STUDENT_BATCH_YEARS)
+    low, high = STUDENT_NUMBER_DIGITS
+    number = rf"(?P<batch>{years})\d{{{low},{high}}}"
+    # [a-z]++ is possessive: letters never have to give anything back to the
+    # digits, so a non-matching input fails in one pass without backtracking
+    _email_pattern = re.compile(
+        rf"(?P<name>[a-z]++)(?P<number>{number})@{re.escape(settings.COLLEGE_EMAIL_DOMAIN)}",
+        re.IGNORECASE | re.ASCII,
+    )
+    _number_pattern = re.compile(number, re.ASCII)
+    _years = " or ".join(settings.STUDENT_BATCH_YEARS)
+
+
+compile_patterns()
+
+
+@receiver(setting_changed)
+def _recompile(setting, **kwargs):
+    if setting in ("STUDENT_BATCH_YEARS", "COLLEGE_EMAIL_DOMAIN"):
+        compile_patterns()
+
+
+def parse_email(email):
+    """Identity inside a college email, None if it is not one"""
+    if not isinstance(email, str) or len(email) > MAX_EMAIL_LENGTH:
+        return None
+    match = _email_pattern.fullmatch(email)
+    if match is None:
+        return None
+    return Identity(match["name"], match["number"], match["batch"])
+
+
+def _email_message():
+    return f"Use your college email (name + student number @{settings.COLLEGE_EMAIL_DOMAIN})"
+
+
+def email_error(email):
+    if parse_email(email) is None:
+        return _email_message()
+    return None
+
+
+def student_number_error(student_number):
+    if not isinstance(student_number, str) or _number_pattern.fullmatch(student_number) is None:
+        low, high = STUDENT_NUMBER_DIGITS
+        return f"Student number must start with {_years} and be {low + 2} to {high + 2} digits long"
+    return None
+
+
+def identity_error(email, name, student_number):
+    """Email, name and student number belong together, or why they do not"""
+    identity = parse_email(email)
+    if identity is None:
+        return _email_message()
+    if student_number is not None and str(student_number) != identity.student_number:
+        return "Student number does not match the email"
+    first_name = str(name or "").split(maxsplit=1)
+    if not first_name or first_name[0].casefold() != identity.first_name.casefold():
+        return "Email must start with your first name"
+    return None
+
+
+# Django validators, referenced (not copied) by the model fields so migrations
+# stay the same whatever the batch years are
+
+def validate_college_email(value):
+    error = email_error(value)
+    if error:
+        raise ValidationError(error, code="invalid_email")
+
+
+def validate_student_number(value):
+    error = student_number_error(value)
+    if error:
+        raise ValidationError(error, code="invalid_student_number")
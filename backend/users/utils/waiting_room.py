@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import math
+from django.conf import settings
+from django.core import signing
+from . import timing
+from .redis_pool import aeval, get_redis
+
+# Waiting room for registration opening surges (settings.WAITING_ROOM_ENABLED).
+#
+# A visitor joins and gets a numbered ticket, first come first served. The
+# room admits tickets in order at WAITING_ROOM_RATE per second, so the
+# funnel behind it (send-otp, payment-initiation: SMTP, Razorpay, the
+# database) sees at most that many new visitors per second whatever the
+# crowd. No worker moves the queue: every join or status call advances the
+# admitted number by the time passed since the last one, inside one script.
+# Unused capacity piles up to WAITING_ROOM_BURST tickets, so on a quiet day
+# a visitor is admitted at once.
+#
+# Tokens are signed, checking one needs no lookup:
+#   - the ticket token, "<room>-<ticket>:<signature>", asks for the position;
+#     the room id changes on reset, so old tickets cannot jump the queue
+#   - the admission token, handed out once the ticket is admitted, is what
+#     send-otp and payment-initiation accept (X-Admission-Token header). It
+#     names the room and the ticket and is bound to the client's IP, lasts
+#     WAITING_ROOM_ADMISSION_TTL seconds and WAITING_ROOM_ADMISSION_USES
+#     requests; passed on to another address it is worthless, and a reset
+#     room voids it
+#
+# Redis: WaitingRoom {room, issued, admitted, updated}, and
+# WaitingRoom:uses:<room> {ticket: requests admitted}, dropped on reset.
+
+ROOM_KEY = "WaitingRoom"
+USES_PREFIX = "WaitingRoom:uses:"
+ADMISSION_HEADER = "X-Admission-Token"
+
+logger = logging.getLogger(__name__)
+
+redis_client = get_redis()
+_ticket_signer = signing.Signer(salt="users.waiting_room.ticket")
+_admission_signer = signing.TimestampSigner(salt="users.waiting_room.admission")
+
+# ARGV: admissions per millisecond, burst, 1 to issue a ticket
+# returns {room, ticket issued (0 for none), admitted up to}
+ROOM_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'room', 'issued', 'admitted', 'updated')
+local room = state[1] or tostring(now)
+local issued = tonumber(state[2]) or 0
+local admitted = tonumber(state[3]) or tonumber(ARGV[2])  -- a new room starts with its burst
+local updated = tonumber(state[4]) or now
+admitted = math.min(admitted + (now - updated) * tonumber(ARGV[1]), issued + tonumber(ARGV[2]))
+local ticket = 0
+if ARGV[3] == '1' then
+    issued = issued + 1
+    ticket = issued
+end
+redis.call('HSET', KEYS[1], 'room', room, 'issued', issued, 'admitted', string.format('%.3f', admitted), 'updated', now)
+return {room, ticket, math.floor(admitted)}
+"""
+
+room_script = redis_client.register_script(ROOM_LUA)
+
+# KEYS: room hash, uses hash of the token's room
+# ARGV: room, ticket, uses allowed, seconds the uses hash lives
+# returns 1 admitted, 0 out of uses, -1 the room was reset since
+ADMIT_LUA = """
+if redis.call('HGET', KEYS[1], 'room') ~= ARGV[1] then
+    return -1
+end
+local used = redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+if used > tonumber(ARGV[3]) then
+    return 0
+end
+return 1
+"""
+
+admit_script = redis_client.register_script(ADMIT_LUA)
+
+
+@timing.timed("redis")
+def _advance(join):
+    room, ticket, admitted = room_script(
+        keys=[ROOM_KEY],
+        args=[settings.WAITING_ROOM_RATE / 1000, settings.WAITING_ROOM_BURST, 1 if join else 0],
+        client=redis_client,
+    )
+    return room.decode() if isinstance(room, bytes) else room, ticket, admitted
+
+
+def _client(ip):
+    return hashlib.sha256(f"{ip}".encode()).hexdigest()[:16]
+
+
+def issue_admission(room, ticket, ip):
+    return _admission_signer.sign(f"{room}-{ticket}-{_client(ip)}")
+
+
+def _read_admission(token, ip):
+    """(room, ticket) of an admission token issued to ip in the last WAITING_ROOM_ADMISSION_TTL seconds"""
+    if not token:
+        return None
+    try:
+        room, ticket, client = _admission_signer.unsign(
+            str(token), max_age=settings.WAITING_ROOM_ADMISSION_TTL,
+        ).rsplit("-", 2)
+    except (signing.BadSignature, ValueError):
+        return None
+    if client != _client(ip):
+        return None
+    return room, ticket
+
+
+def _admit_args(room, ticket):
+    return (
+        [ROOM_KEY, f"{USES_PREFIX}{room}"],
+        [room, ticket, settings.WAITING_ROOM_ADMISSION_USES, settings.WAITING_ROOM_ADMISSION_TTL],
+    )
+
+
+@timing.timed("redis")
+def is_admitted(token, ip):
+    """Spend one use of an admission token, False if it is not valid for ip or used up"""
+    parsed = _read_admission(token, ip)
+    if parsed is None:
+        return False
+    keys, args = _admit_args(*parsed)
+    try:
+        return admit_script(keys=keys, args=args, client=redis_client) == 1
+    except Exception as e:
+        # the room cannot run without Redis either, the signature has to do
+        logger.warning(f"Waiting room uses not counted: {str(e)}")
+        return True
+
+
+@timing.timed("redis")
+async def ais_admitted(token, ip):
+    """is_admitted for the async views"""
+    parsed = _read_admission(token, ip)
+    if parsed is None:
+        return False
+    keys, args = _admit_args(*parsed)
+    try:
+        return await aeval(admit_script, keys, args) == 1
+    except Exception as e:
+        logger.warning(f"Waiting room uses not counted: {str(e)}")
+        return True
+
+
+def _read_ticket(token):
+    """(room, ticket) inside a ticket token, None if it is not one of ours"""
+    try:
+        room, ticket = _ticket_signer.unsign(str(token)).rsplit("-", 1)
+        return room, int(ticket)
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def _state(token, room, ticket, admitted, ip):
+    position = max(ticket - admitted, 0)
+    state = {"token": token, "position": position, "admitted": position == 0}
+    if position:
+        # poll about twice before the turn comes, at most every second, at least every 30
+        rate = settings.WAITING_ROOM_RATE
+        state["retry_after"] = min(max(math.ceil(position / rate / 2), 1), 30) if rate > 0 else 30
+    else:
+        state["admission_token"] = issue_admission(room, ticket, ip)
+    return state
+
+
+def join(ip):
+    """A new ticket at the end of the queue, with its position"""
+    room, ticket, admitted = _advance(join=True)
+    return _state(_ticket_signer.sign(f"{room}-{ticket}"), room, ticket, admitted, ip)
+
+
+def status(token, ip):
+    """Position of a ticket token, None for a token that is not valid in this room"""
+    parsed = _read_ticket(token)
+    if parsed is None:
+        return None
+    room, _, admitted = _advance(join=False)
+    if parsed[0] != room:
+        return None
+    return _state(token, room, parsed[1], admitted, ip)
+
+
+def reset():
+    """Empty the room: numbering restarts, tickets and admissions issued so far stop working"""
+    room = redis_client.hget(ROOM_KEY, "room")
+    keys = [ROOM_KEY]
+    if room:
+        keys.append(f"{USES_PREFIX}{room.decode()}")
+    redis_client.delete(*keys)
@@ -0,0 +1,58 @@
+import time
+from redis.exceptions import ResponseError
+from . import timing
+from .redis_pool import get_async_redis, get_redis
+
+# Verified Razorpay webhook bodies waiting to be applied. The webhook view
+# appends (one XADD) and answers right away; the consume_webhooks command
+# reads them through a consumer group and applies them in batches. Entries
+# are trimmed only once every consumer acknowledged them, never by length.
+
+STREAM_KEY = "Webhooks:razorpay"
+DEAD_LETTER_KEY = "Webhooks:razorpay:dead"
+GROUP = "webhook-appliers"
+
+redis_client = get_redis()
+
+
+def _fields(body, event_id):
+    return {
+        "body": body,
+        "event_id": event_id or "",
+        "received_at": int(time.time()),
+    }
+
+
+@timing.timed("redis")
+def append(body, event_id=None):
+    return redis_client.xadd(STREAM_KEY, _fields(body, event_id))
+
+
+@timing.timed("redis")
+async def aappend(body, event_id=None):
+    return await get_async_redis().xadd(STREAM_KEY, _fields(body, event_id))
+
+
+def ensure_group():
+    try:
+        redis_client.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def trim_acknowledged():
+    """Drop entries older than anything still pending or undelivered"""
+    groups = {g["name"].decode(): g for g in redis_client.xinfo_groups(STREAM_KEY)}
+    group = groups.get(GROUP)
+    if group is None:
+        return
+    pending = redis_client.xpending(STREAM_KEY, GROUP)
+    oldest = pending["min"] if pending["pending"] else None
+    last_delivered = group["last-delivered-id"]
+    if oldest is None:
+        # everything delivered is acknowledged, keep only what is not delivered yet
+        major, minor = last_delivered.decode().split("-")
+        redis_client.xtrim(STREAM_KEY, minid=f"{major}-{int(minor) + 1}", approximate=False)
+    else:
+        redis_client.xtrim(STREAM_KEY, minid=oldest, approximate=False)
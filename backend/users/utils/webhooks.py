@@ -0,0 +1,185 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from ..models import PaymentOrder, Student, WebhookEvent
+from . import payment_status, tickets
+
+# Payment status only moves forward: event -> (new status, statuses it may replace).
+# A late payment.failed can never overwrite SUCCESS.
+TRANSITIONS = {
+    'payment.captured': ('SUCCESS', ['PENDING', 'FAILED']),
+    'order.paid': ('SUCCESS', ['PENDING', 'FAILED']),
+    'payment.failed': ('FAILED', ['PENDING']),
+}
+
+# apply_payment_event results
+APPLIED = "applied"
+DUPLICATE = "duplicate"
+UNCHANGED = "unchanged"  # recorded, but the transition is not allowed or not a payment event
+NOT_FOUND = "not_found"
+
+
+class _StudentNotFound(Exception):
+    pass
+
+
+def _holders(order_id, status):
+    """Students an event for order_id applies to
+
+    The order they hold now, or for a payment (SUCCESS) any order they were
+    given earlier too, from PaymentOrder. A failure of an earlier order does
+    not touch the status of the one in progress.
+    """
+    current = Q(razorpay_order_id=order_id)
+    if status != 'SUCCESS':
+        return current
+    return current | Q(id__in=PaymentOrder.objects.filter(order_id=order_id).values('student_id'))
+
+
+def parse_payment_event(data):
+    """(event, order id, payment id) from a Razorpay webhook body"""
+    event = data.get('event')
+    payment_entity = data.get('payload', {}).get('payment', {}).get('entity', {})
+    return event, payment_entity.get('order_id'), payment_entity.get('id')
+
+
+def apply_payment_event(event, order_id, payment_id, event_id=None):
+    """Record the delivery in the ledger and move the student's payment status forward
+
+    Costs one insert into the ledger plus at most one conditional UPDATE of
+    Student, and a SELECT of the paid student's id to queue its ticket. A
+    re-delivery fails the insert and returns DUPLICATE without touching Student.
+    """
+    try:
+        with transaction.atomic():
+            WebhookEvent.objects.create(
+                event_id=event_id,
+                event=event or '',
+                payment_id=payment_id or '',
+                order_id=order_id,
+            )
+            transition = TRANSITIONS.get(event)
+            if transition is None or not order_id:
+                return UNCHANGED
+
+            status, replaces = transition
+            updated = Student.objects.filter(
+                _holders(order_id, status),
+                payment_status__in=replaces,
+            ).update(
+                payment_status=status, razorpay_order_id=order_id, razorpay_payment_id=payment_id,
+                updated_at=timezone.now(),
+            )
+
+            if updated:
+                transaction.on_commit(lambda: payment_status.publish_order(order_id, status))
+                if status == 'SUCCESS':
+                    paid = list(Student.objects.filter(razorpay_order_id=order_id, payment_status='SUCCESS').values_list('id', flat=True))
+                    transaction.on_commit(lambda: tickets.enqueue(paid))
+                return APPLIED
+            if not Student.objects.filter(_holders(order_id, 'SUCCESS')).exists():
+                # roll the ledger row back so Razorpay's retry is applied later
+                raise _StudentNotFound()
+            return UNCHANGED
+    except IntegrityError:
+        return DUPLICATE
+    except _StudentNotFound:
+        return NOT_FOUND
+
+
+def apply_payment_events(events, replay=False):
+    """Batch version of apply_payment_event for the webhook stream consumer
+
+    events is a list of (event, order id, payment id, event id). One SELECT on
+    the ledger, one for the students holding the orders, one bulk INSERT, then
+    at most one UPDATE per target status. FAILED transitions run before
+    SUCCESS ones, so a batch holding both a failed and a captured payment for
+    the same order ends in SUCCESS. One more SELECT reads the resulting
+    statuses for the payment status cache.
+
+    Like apply_payment_event's NOT_FOUND, a payment event for an order no
+    student holds is not recorded, so a later delivery still applies it.
+    Returns (events recorded, order ids of those left out).
+
+    replay applies the transitions of events already in the ledger too: a
+    re-sync from the gateway (users.utils.reconcile) must fix a student whose
+    webhook was recorded while the row could not be updated. Transitions only
+    move forward, so applying one twice changes nothing.
+    """
+    fresh = {}
+    for event, order_id, payment_id, event_id in events:
+        fresh.setdefault((payment_id or '', event or ''), (event, order_id, payment_id, event_id))
+    if not fresh:
+        return 0, set()
+
+    with transaction.atomic():
+        seen = set(
+            WebhookEvent.objects.filter(payment_id__in={key[0] for key in fresh})
+            .values_list('payment_id', 'event')
+        )
+        orders = {order_id for event, order_id, _, _ in fresh.values() if order_id and event in TRANSITIONS}
+        owners = list(
+            Student.objects.filter(razorpay_order_id__in=orders).values_list('id', 'razorpay_order_id')
+            .union(PaymentOrder.objects.filter(order_id__in=orders).values_list('student_id', 'order_id'))
+        ) if orders else []
+        unmatched = orders - {order_id for _, order_id in owners}
+        received = {key: value for key, value in fresh.items() if value[1] not in unmatched}
+        fresh = {key: value for key, value in received.items() if key not in seen}
+        apply = received if replay else fresh
+        WebhookEvent.objects.bulk_create(
+            [
+                WebhookEvent(event_id=event_id, event=event or '', payment_id=payment_id or '', order_id=order_id)
+                for event, order_id, payment_id, event_id in fresh.values()
+            ],
+            ignore_conflicts=True,  # a concurrent consumer got there first, the update below is idempotent
+        )
+
+        now = timezone.now()
+        touched, holders = set(), {}
+        for status in ('FAILED', 'SUCCESS'):
+            payment_ids = {}
+            replaces = None
+            for event, order_id, payment_id, _ in apply.values():
+                transition = TRANSITIONS.get(event)
+                if transition and transition[0] == status and order_id:
+                    payment_ids[order_id] = payment_id
+                    replaces = transition[1]
+            if not payment_ids:
+                continue
+            touched.update(payment_ids)
+            if status == 'SUCCESS':
+                # a payment of an order the student was given before the current one, see _holders
+                holders = {student_id: order_id for student_id, order_id in owners if order_id in payment_ids}
+            changes = {
+                'payment_status': status,
+                'razorpay_payment_id': Case(
+                    *[When(id=student_id, then=Value(payment_ids[order_id])) for student_id, order_id in holders.items()],
+                    *[When(razorpay_order_id=order_id, then=Value(payment_id)) for order_id, payment_id in payment_ids.items()],
+                    default=F('razorpay_payment_id'),
+                ),
+                'updated_at': now,
+            }
+            if holders:
+                # the paid order becomes the student's order
+                changes['razorpay_order_id'] = Case(
+                    *[When(id=student_id, then=Value(order_id)) for student_id, order_id in holders.items()],
+                    default=F('razorpay_order_id'),
+                )
+            Student.objects.filter(
+                Q(razorpay_order_id__in=list(payment_ids)) | Q(id__in=list(holders)),
+                payment_status__in=replaces,
+            ).update(**changes)
+
+        if touched:
+            # whatever the statuses are now, a transition may have been refused
+            rows = (
+                Student.objects.filter(Q(razorpay_order_id__in=touched) | Q(id__in=list(holders)))
+                .values_list('id', 'payment_status', 'razorpay_order_id')
+            )
+            statuses = {student_id: status for student_id, status, _ in rows}
+            orders = {student_id: order_id for student_id, _, order_id in rows}
+            paid = [student_id for student_id, status in statuses.items() if status == 'SUCCESS']
+            transaction.on_commit(lambda: payment_status.publish(statuses, orders))
+            # tickets already stored are not rendered again, replays queue them harmlessly
+            transaction.on_commit(lambda: tickets.enqueue(paid))
+    return len(fresh), unmatched
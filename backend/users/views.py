@@ -1,67 +1,145 @@
-from urllib import request
 from django.conf import settings
-import razorpay
-from rest_framework.decorators import  throttle_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.throttling import UserRateThrottle
-from backend.settings import RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET
 from .serializers import StudentSerializer
 from .models import Student
-from .utils.recaptcha import verify_recaptcha
 from .utils.otp_manager import OTPManager
-from django_ratelimit.decorators import ratelimit
-from django.utils.decorators import method_decorator
+from .utils.payment_gateway import get_gateway
+from .utils import webhook_stream, webhooks
+from .utils.webhooks import apply_payment_event, parse_payment_event
+from .utils import checkin, export, mail_queue, metrics, orders, payment_status, tickets, timing, verification, waiting_room
+from .utils.rate_limit import client_ip, limit
+from .utils.checks import Pipeline, admitted, college_email, integer, otp_format, payable_student, recaptcha, redis_gate, required
 import logging
-from django.core.validators import RegexValidator
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
+from django.views.decorators.gzip import gzip_page
+from django.db import IntegrityError, transaction
 
 
-def  verify_mail_fail(email):
-    if RegexValidator(
-        regex=r'^[a-zA-Z]+24\d+@akgec\.ac\.in$',
-        message='Email is incorrect format. Use College Email')(email):
-        return True
-    return False
+# columns VerifyOTP reads or must keep fresh, saving a deferred instance writes only these and the changed ones
+VERIFY_OTP_FIELDS = ('id', 'email', 'name', 'student_number', 'payment_status', 'is_email_verified', 'updated_at')
 
 
+def otp_reply(message):
+    return {'success': False, 'message': message}
 
 
-# Create your views here.
-client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+def rejected(rejection, response_class=Response):
+    body, status, headers = rejection
+    return response_class(body, status=status, headers=headers)
+
+
+# Checks per endpoint, shared with async_views. Pipeline runs them cheapest
+# stage first whatever the order here: shape, format, Redis, database, outbound.
+# redis_gate holds the endpoint's rate limits, per IP and per email, admitted
+# spends a use of the waiting room's admission while it is on.
+SEND_OTP_CHECKS = Pipeline("send-otp", [
+    required('email', message='Email is required'),
+    college_email(message='Invalid email format. Use College Email'),
+    redis_gate(limit('ip', '10/m'), limit('email', '5/h'), cooldown=True),
+    admitted(),
+], reply=otp_reply)
+
+OTP_STATUS_CHECKS = Pipeline("otp-status", [
+    required('email', message='Email is required'),
+    redis_gate(limit('ip', '20/m')),
+], reply=otp_reply)
+
+VERIFY_OTP_CHECKS = Pipeline("verify-otp", [
+    required('email', 'otp'),
+    otp_format(),
+    college_email(),
+    redis_gate(limit('ip', '5/m'), limit('email', '10/10m')),
+])
+
+PAYMENT_INITIATION_CHECKS = Pipeline("payment-initiation", [
+    required('student_id', 'recaptcha_token'),
+    integer('student_id'),
+    redis_gate(limit('ip', '5/m'), limit('student_id', '5/m')),
+    admitted(),
+    payable_student(),
+    recaptcha(),
+])
+
+PAYMENT_STATUS_CHECKS = Pipeline("payment-status", [
+    redis_gate(limit('ip', '30/m')),
+])
+
+PAYMENT_STATUS_EVENTS_CHECKS = Pipeline("payment-status-events", [
+    redis_gate(limit('ip', '10/m')),
+])
+
+TICKET_CHECKS = Pipeline("ticket", [
+    redis_gate(limit('ip', '30/m')),
+])
+
+WAITING_ROOM_CHECKS = Pipeline("waiting-room", [
+    # generous: a campus network puts many students behind one address
+    redis_gate(limit('ip', '30/m')),
+])
+
+
+def admission(request):
+    return request.headers.get(waiting_room.ADMISSION_HEADER)
+
+
+def order_busy(response_class):
+    response = response_class({"detail": "Payment is already being initiated, try again"}, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+
+def student_number(data):
+    """student_number as the serializer names it, student_no from older clients"""
+    return data.get("student_number", data.get("student_no"))
+
 
-class PaymentVerifyThrottle(UserRateThrottle):
-    rate = "5/min"
+def save_student(serializer):
+    """Insert or update a verified student, (student, None) or (None, error)
 
+    No existence checks up front, the unique constraints on email and
+    student_number decide and a duplicate comes back as IntegrityError.
+    """
+    try:
+        with transaction.atomic():
+            return serializer.save(is_email_verified=True), None
+    except IntegrityError:
+        return None, {"detail": "Email or student number already registered"}
 
+
+def webhook_response(result, response_class):
+    """Razorpay only needs a 2xx, a 404 makes it retry later"""
+    if result == webhooks.NOT_FOUND:
+        return response_class({"detail": "Student not found"}, status=404)
+    if result == webhooks.DUPLICATE:
+        return response_class({"detail": "OK , Already processed"}, status=200)
+    if result == webhooks.UNCHANGED:
+        return response_class({"detail": "OK , No change"}, status=200)
+    return response_class({"detail": "OK , Payment Verified"}, status=200)
+
+
+# Create your views here.
 # VERIFY OTP VIEWfrom rest_framework.views import APIView
 
 logger = logging.getLogger(__name__)
 
 
-@method_decorator(ratelimit(key='ip', rate='10/m', method='POST',block=False), name='post')
 class SendOTPView(APIView):
     def post(self, request):
-        if getattr(request, "limited", False):
-            pass
-            return Response({"detail": "Too many requests. Please try again later."}, status=429)
         try:
             email = request.data.get('email')
-            # print(email)
-            
-            if not email:
-                return Response(
-                    {'success': False, 'message': 'Email is required'},
-                    status=400
-                )
-            
-            if verify_mail_fail(email):
-                    return Response(
-                        {'success': False, 'message': 'Invalid email format. Use College Email'},
-                        status=400
-                    )
-            
-            ip_address = self.get_client_ip(request)
-            # print(ip_address)
+            ip_address = client_ip(request)
+            rejection = SEND_OTP_CHECKS.run({"data": request.data, "ip": ip_address, "admission": admission(request)})
+            if rejection:
+                return rejected(rejection)
+
             # OTPManager handles cooldown, attempts, email
             success, message = OTPManager.send_otp(email, ip_address)
             
@@ -76,30 +154,38 @@ class SendOTPView(APIView):
                 {'success': False, 'message': f"Error sending OTP: {str(e)}"},
                 status=500
             )
-    
-    def get_client_ip(self, request):
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
 
 
-@method_decorator(ratelimit(key='ip', rate='5/m', method='POST',block=False), name='post')
+class OTPStatusView(APIView):
+    """Delivery state of the OTP email queued by SendOTPView"""
+    def get(self, request):
+        email = request.query_params.get('email')
+        rejection = OTP_STATUS_CHECKS.run({"data": request.query_params, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection)
+
+        status = mail_queue.get_status(email)
+        if not status:
+            return Response({"detail": "No OTP email pending for this email"}, status=404)
+        return Response({
+            "state": status["state"],
+            "attempts": int(status["attempts"]),
+            "updated_at": int(status["updated_at"]),
+        }, status=200)
+
+
 class VerifyOTPAPIView(APIView):
     def post(self, request):
-        if getattr(request, "limited", False):
-            return Response({"detail": "Too many requests. Please try again later."}, status=429)
         email = request.data.get('email')
         otp = request.data.get('otp')
         data = request.data
 
-        if not email or not otp:
-            return Response({"detail": "email and otp are required"}, status=400)
+        rejection = VERIFY_OTP_CHECKS.run({"data": data, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection)
 
         # if email exists
-        existing = Student.objects.filter(email=email).first()
+        existing = Student.objects.filter(email=email).only(*VERIFY_OTP_FIELDS).first()
         if existing:
             if existing.payment_status == 'SUCCESS':
                 return Response({"detail": "Payment already completed for this email"}, status=400)
@@ -108,116 +194,268 @@ class VerifyOTPAPIView(APIView):
                 return Response({"id": existing.id}, status=200)
 
             # not verified yet -> verify OTP and update record
-            if not OTPManager.verify_otp(email, otp):
-                return Response({"detail": "Invalid OTP"}, status=400)
+            verified, message = OTPManager.verify_otp(email, otp)
+            if not verified:
+                return Response({"detail": message}, status=400)
 
             serializer = StudentSerializer(existing, data=data, partial=True)
-            if serializer.is_valid():
-                serializer.save(is_email_verified=True)
-                return Response({"id": existing.id, "is_email_verified": True}, status=200)
-            return Response(serializer.errors, status=400)
-
-        # new email -> verify OTP, then create
-        if not(str(data["name"]).split()[0]+str(data["student_no"])+"@akgec.ac.in" == str(data["email"])):
+            with timing.span("serializer"):
+                valid = serializer.is_valid()
+            if not valid:
+                return Response(serializer.errors, status=400)
+            student, error = save_student(serializer)
+            if error:
+                return Response(error, status=400)
+            return Response({"id": student.id, "is_email_verified": True}, status=200)
+
+        # new email -> check the identity (no I/O), verify OTP, then create
+        error = verification.identity_error(email, data.get("name"), student_number(data) or "")
+        if error:
             return Response(
-                {"error": "Email is in wrong format"},
+                {"error": error},
                 status=400)
-        if not OTPManager.verify_otp(email, otp):
-            return Response({"detail": "Invalid OTP", }, status=400)
+        verified, message = OTPManager.verify_otp(email, otp)
+        if not verified:
+            return Response({"detail": message}, status=400)
 
         serializer = StudentSerializer(data=data)
-        if serializer.is_valid():
-            student = serializer.save(is_email_verified=True)
-            return Response({"id": student.id}, status=200)
-
-        return Response(serializer.errors, status=400)
+        with timing.span("serializer"):
+            valid = serializer.is_valid()
+        if not valid:
+            return Response(serializer.errors, status=400)
+        student, error = save_student(serializer)
+        if error:
+            return Response(error, status=400)
+        return Response({"id": student.id}, status=200)
 
 
 
-@method_decorator(ratelimit(key='ip', rate='5/m', method='POST',block=False), name='post')
 class PaymentInitiationAPIView(APIView):
     def post(self, request):
-        if getattr(request, "limited", False):
-            return Response({"detail": "Too many requests. Please try again later."}, status=429)
-        student_id = request.data.get('student_id')
-        recaptcha_token = request.data.get('recaptcha_token')
-
-        if not verify_recaptcha(recaptcha_token):
-            return Response({"detail": "Invalid reCAPTCHA"}, status= 400)
-
-        student = Student.objects.filter(id=student_id).first()
-        if not student:
-            return Response({"detail": "Student not found"}, status= 404 )
-
-        if not student.is_email_verified:
-            return Response({"detail": "Email not verified"}, status= 400 )
-
-        if student.payment_status == 'SUCCESS':
-            return Response({"detail": "Payment already completed, You are registered"}, status= 400 )
-
-        client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-
-        order_data = {
-            "amount": settings.REGISTRATION_AMOUNT,
-            "currency": "INR",
-            "receipt": f"receipt_{student_id}",
-            "payment_capture": 1
-        }
+        # shape, blocklist and student state before the reCAPTCHA call
+        ctx = {"data": request.data, "ip": client_ip(request), "admission": admission(request)}
+        rejection = PAYMENT_INITIATION_CHECKS.run(ctx)
+        if rejection:
+            return rejected(rejection)
+        student = ctx["student"]
 
         try:
-            order = client.order.create(data=order_data)
-            student.order_id = order.get('id')
-            student.save(update_fields=['order_id'])
+            # the student's open order if there is one, a double click makes no second order
+            order, _ = orders.order_for(student)
             return Response(order, status= 200)
+        except orders.OrderBusy:
+            return order_busy(Response)
         except Exception as e:
             return Response({"detail": str(e)}, status= 500)
 
 
-@method_decorator(ratelimit(key='ip', rate='7/m', method='POST',block=False), name='post')
 class RazorpayWebhookAPIView(APIView):
+    """Verify the signature, queue the event, answer right away
+
+    Not rate limited: Razorpay sends from a few IPs and re-sends anything that
+    is not a 2xx, the signature check is what keeps others out.
+    consume_webhooks applies the queued events.
+    """
+    authentication_classes = []
+
     def post(self, request):
-        if getattr(request, "limited", False):
-            return Response({"detail": "Too many requests. Please try again later."}, status=429)
         payload = request.body
         signature = request.headers.get('X-Razorpay-Signature')
 
         # verify signature
-        try:
-            client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-            client.utility.verify_webhook_signature(payload, signature, settings.RAZORPAY_WEBHOOK_SECRET)
-        except Exception:
+        if not get_gateway().verify_webhook_signature(payload, signature):
             return Response({"detail": "Invalid signature"}, status= 400 )
 
-        event = request.data.get('event')
-        payment_entity = request.data.get('payload', {}).get('payment', {}).get('entity', {})
-        order_id = payment_entity.get('order_id')
-        payment_id = payment_entity.get('id')
-
-        student = Student.objects.filter(order_id=order_id).first()
-        if not student:
-            return Response({"detail": "Student not found"}, status= 404 )
-
-        if event == 'payment.captured':
-            student.payment_status = 'SUCCESS'
-        elif event == 'payment.failed':
-            student.payment_status = 'FAILED'
+        event_id = request.headers.get('X-Razorpay-Event-Id')
+        try:
+            webhook_stream.append(payload, event_id)
+            return Response({"detail": "OK , Queued"}, status=200)
+        except Exception as e:
+            # Redis down: apply inline rather than lose the event
+            logger.error(f"Webhook queue unavailable, applying inline: {str(e)}")
 
-        student.payment_id = payment_id
-        student.save(update_fields=['payment_status', 'payment_id'])
-        return Response({"detail": "OK , Payment Verified"}, status=200)
+        event, order_id, payment_id = parse_payment_event(request.data)
+        result = apply_payment_event(event, order_id, payment_id, event_id)
+        return webhook_response(result, Response)
 
 
-@method_decorator(ratelimit(key='ip', rate='5/m', method='GET',block=False), name='get')
 class PaymentStatusAPIView(APIView):
-    
+    """Payment status from the Redis cache the webhook keeps current
+
+    The async deployment also long-polls (?wait=) and streams (events/),
+    prefer those over polling this one.
+    """
     def get(self, request, student_id):
-        if getattr(request, "limited", False):
-            return Response({"detail": "Too many requests. Please try again later."}, status=429)   \
-            
-        student = Student.objects.filter(id=student_id).first()
-        if not student:
+        rejection = PAYMENT_STATUS_CHECKS.run({"data": {}, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection)
+
+        status = payment_status.get_status(student_id)
+        if status is None:
             return Response({"detail": "Student not found"}, status= 404 )
-        return Response({"id": student.id, "payment_status": student.payment_status}, status= 200)
+        return Response({"id": student_id, "payment_status": status}, status= 200)
+
+class MetricsView(APIView):
+    """Prometheus metrics of this process, only with the METRICS_TOKEN bearer token"""
+    authentication_classes = []  # the bearer token is ours, not a JWT
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        auth = request.headers.get('Authorization', '')
+        if not token or not constant_time_compare(auth, f"Bearer {token}"):
+            return Response({"detail": "Not found"}, status=404)
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
+@staff_member_required
+def export_students(request):
+    """Registrations as CSV (default) or ?format=xlsx, streamed
+
+    Filters: payment_status, branch, hostler=true|false, present=true|false.
+    Staff only, log in through the admin.
+    """
+    filters, error = export.parse_filters(request.GET)
+    if error:
+        return JsonResponse({"detail": error}, status=400)
+    file_format = request.GET.get('format', 'csv')
+    if file_format not in export.FORMATS:
+        return JsonResponse({"detail": "format must be csv or xlsx"}, status=400)
+
+    stream, content_type = export.FORMATS[file_format]
+    response = StreamingHttpResponse(stream(export.rows(filters)), content_type=content_type)
+    filename = f"registrations-{timezone.localtime():%Y%m%d-%H%M}.{file_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def gate_authorized(request):
+    token = settings.CHECKIN_TOKEN
+    return bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {token}")
+
+
+class WaitingRoomView(APIView):
+    """Join the waiting room: POST returns a ticket token and its position
+
+    Poll WaitingRoomStatusView with the token every retry_after seconds until
+    "admitted" is true, then send the admission_token in the
+    X-Admission-Token header to send-otp and payment-initiation. See
+    users.utils.waiting_room.
+    """
+    authentication_classes = []
+
+    def post(self, request):
+        ip_address = client_ip(request)
+        rejection = WAITING_ROOM_CHECKS.run({"data": {}, "ip": ip_address})
+        if rejection:
+            return rejected(rejection)
+        if not settings.WAITING_ROOM_ENABLED:
+            return Response({"token": None, "position": 0, "admitted": True, "admission_token": None}, status=200)
+        return Response(waiting_room.join(ip_address), status=200)
+
+
+class WaitingRoomStatusView(APIView):
+    """Position of a waiting room ticket, ?token=<ticket token>; one Redis script call, no database"""
+    authentication_classes = []
+
+    def get(self, request):
+        token = request.query_params.get('token')
+        if not token:
+            return Response({"detail": "token is required"}, status=400)
+        state = waiting_room.status(token, client_ip(request))
+        if state is None:
+            return Response({"detail": "Unknown ticket, join the waiting room again"}, status=404)
+        return Response(state, status=200)
+
+
+class CheckinView(APIView):
+    """Event day check-in, a gate posts {"tokens": [...]} with the CHECKIN_TOKEN bearer token
+
+    Answers one result per scanned token, in order: checked_in, duplicate,
+    not_paid, unknown or invalid. See users.utils.checkin.
+    """
+    authentication_classes = []  # the bearer token is ours, not a JWT
+
+    def post(self, request):
+        if not gate_authorized(request):
+            return Response({"detail": "Not found"}, status=404)
+
+        tokens = request.data.get('tokens')
+        if not isinstance(tokens, list) or not tokens or not all(isinstance(t, str) for t in tokens):
+            return Response({"detail": "tokens must be a non-empty list of strings"}, status=400)
+        if len(tokens) > settings.CHECKIN_MAX_BATCH:
+            return Response({"detail": f"At most {settings.CHECKIN_MAX_BATCH} tokens per request"}, status=400)
+        return Response({"results": checkin.check_in(tokens)}, status=200)
+
+
+@method_decorator(gzip_page, name='dispatch')
+class CheckinSyncView(APIView):
+    """Paid students for offline gate devices: snapshot, then ?since=<cursor> deltas
+
+    Answers 304 to a matching If-None-Match after two index lookups, so a
+    device can poll cheaply. Gzipped when the device accepts it.
+    """
+    authentication_classes = []
+
+    def get(self, request):
+        if not gate_authorized(request):
+            return Response({"detail": "Not found"}, status=404)
+
+        since = request.query_params.get('since')
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None:
+                return Response({"detail": "since must be a cursor from an earlier response"}, status=400)
+
+        etag = quote_etag(f"{request.query_params.get('since', '')}/{checkin.sync_version()}")
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        response = Response(checkin.sync_feed(since), status=200)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class TicketView(APIView):
+    """Download a registration ticket, ?token=<check-in token>&type=pdf|png
+
+    The file is rendered by the render_tickets worker; until it is there
+    the student is queued and the answer is 202 with Retry-After. Stored
+    files are named by the hash of their content, which is also the ETag.
+    """
+    authentication_classes = []  # the signed check-in token is the credential
+
+    def get(self, request):
+        rejection = TICKET_CHECKS.run({"data": {}, "ip": client_ip(request)})
+        if rejection:
+            return rejected(rejection)
+        file_format = request.query_params.get('type', 'pdf')  # ?format= is DRF's renderer switch
+        if file_format not in tickets.CONTENT_TYPES:
+            return Response({"detail": f"type must be one of {', '.join(tickets.CONTENT_TYPES)}"}, status=400)
+        student_id = checkin.read_token(request.query_params.get('token', ''))
+        row = tickets.paid_rows([student_id]).first() if student_id is not None else None
+        if row is None:
+            return Response({"detail": "Not found"}, status=404)
+
+        digest, name = tickets.locate(row, file_format)
+        etag = quote_etag(digest)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        store = tickets.storage()
+        if not store.exists(name):
+            tickets.enqueue([student_id])
+            response = Response({"detail": "Ticket is being prepared, try again shortly"}, status=202)
+            response['Retry-After'] = '5'
+            return response
+        response = FileResponse(
+            store.open(name), content_type=tickets.CONTENT_TYPES[file_format],
+            filename=f"ticket-{row[2]}.{file_format}",
+        )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
 
 # # view to create razorpay order
 
@@ -259,7 +497,6 @@ class PaymentStatusAPIView(APIView):
 # @ratelimit(key="ip", rate="3/m", block=False)
 # @ratelimit(key="post:email", rate="2/m", block=False)
 # @api_view(["POST"])
-# @throttle_classes([PaymentVerifyThrottle])
 # def verify_and_save(request):
 #     if getattr(request, "limited", False):
 #         return Response(